@@ -0,0 +1,70 @@
+"""
+Benchmark DataCollatorForSeq2Seq on packed NumPy batches.
+
+Compares the array fast path against padding through `tokenizer.pad`.
+
+    python scripts/benchmarks/bench_collator.py --batch_size=8 --sequence_len=4096
+"""
+import time
+
+import fire
+import numpy as np
+from tokenizers import Tokenizer
+from tokenizers.models import WordLevel
+from transformers import PreTrainedTokenizerFast
+
+from axolotl.utils.collators import DataCollatorForSeq2Seq
+
+
+class TokenizerPadCollator(DataCollatorForSeq2Seq):
+    """always takes the python list / `tokenizer.pad` path"""
+
+    def _use_array_fast_path(self, features, return_tensors):
+        return False
+
+
+def packed_features(batch_size: int, sequence_len: int, rng):
+    features = []
+    for _ in range(batch_size):
+        # leave some room at the end so every row needs padding
+        lengths = rng.integers(16, 512, size=sequence_len // 128)
+        lengths = lengths[np.cumsum(lengths) <= sequence_len - 8]
+        total = int(lengths.sum())
+        input_ids = rng.integers(4, 32000, size=total)
+        features.append(
+            {
+                "input_ids": input_ids,
+                "attention_mask": np.repeat(np.arange(1, len(lengths) + 1), lengths),
+                "labels": input_ids.copy(),
+                "position_ids": np.concatenate([np.arange(n) for n in lengths]),
+            }
+        )
+    return features
+
+
+def timeit(collator, features, iters: int):
+    collator([dict(f) for f in features])
+    start = time.perf_counter()
+    for _ in range(iters):
+        collator([dict(f) for f in features])
+    return (time.perf_counter() - start) / iters
+
+
+def run(batch_size: int = 8, sequence_len: int = 4096, iters: int = 20, seed: int = 42):
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=Tokenizer(WordLevel({"<pad>": 0, "<unk>": 1}, "<unk>")),
+        pad_token="<pad>",
+        unk_token="<unk>",
+    )
+    features = packed_features(batch_size, sequence_len, np.random.default_rng(seed))
+    kwargs = {"pad_to_multiple_of": 64, "return_tensors": "pt"}
+
+    baseline = timeit(TokenizerPadCollator(tokenizer, **kwargs), features, iters)
+    fast = timeit(DataCollatorForSeq2Seq(tokenizer, **kwargs), features, iters)
+    print(f"batch {batch_size}x{sequence_len}")
+    print(f"  tokenizer.pad: {baseline * 1e3:8.2f}ms")
+    print(f"  array path:    {fast * 1e3:8.2f}ms ({baseline / fast:.1f}x)")
+
+
+if __name__ == "__main__":
+    fire.Fire(run)
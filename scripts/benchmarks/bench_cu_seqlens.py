@@ -0,0 +1,115 @@
+"""
+Benchmark cu_seqlens construction for packed batches on CPU.
+
+Compares the batched get_cu_seqlens / get_cu_seqlens_from_pos_ids against the
+previous per-row loop implementations.
+
+    python scripts/benchmarks/bench_cu_seqlens.py --batch_sizes=1,8,32
+"""
+import time
+
+import fire
+import torch
+
+from axolotl.monkeypatch.utils import get_cu_seqlens, get_cu_seqlens_from_pos_ids
+
+
+def rowwise_cu_seqlens_from_pos_ids(position_ids):
+    results = []
+    max_seq_lens = []
+    for row in position_ids:
+        padding_length = (row == 0).int().flip(dims=[0]).cumprod(dim=0).sum().item()
+        adjusted_row = row[:-padding_length] if padding_length else row.clone()
+        seq_starts = torch.cat([torch.tensor([True]), adjusted_row[1:] == 0])
+        start_indices = torch.cat(
+            [seq_starts.nonzero(as_tuple=True)[0], torch.tensor([len(adjusted_row)])]
+        )
+        cu_seqlens = torch.cat(
+            [torch.tensor([0]), (start_indices[1:] - start_indices[:-1]).cumsum(0)]
+        )
+        if padding_length:
+            cu_seqlens = torch.cat([cu_seqlens, torch.tensor([len(row)])])
+        results.append(cu_seqlens)
+        max_seq_lens.append((cu_seqlens[1:] - cu_seqlens[:-1]).max())
+    return torch.stack(results).to(dtype=torch.int32), torch.stack(max_seq_lens)
+
+
+def rowwise_cu_seqlens(attn_mask):
+    results = []
+    max_seq_lens = []
+    for row in attn_mask:
+        t_non_zeros = row[row != 0]
+        seq_change = torch.cat([torch.tensor([1]), t_non_zeros[1:] != t_non_zeros[:-1]])
+        change_indices = torch.cat(
+            [
+                (seq_change == 1).nonzero(as_tuple=True)[0],
+                torch.tensor([len(t_non_zeros)]),
+            ]
+        )
+        seq_lengths = change_indices[1:] - change_indices[:-1]
+        final_seq_length = len(row) - change_indices[-1]
+        if final_seq_length.item():
+            seq_lengths = torch.cat([seq_lengths, final_seq_length.view(1)])
+        cu_seqlens = torch.cat([torch.tensor([0]), seq_lengths.cumsum(0)])
+        results.append(cu_seqlens)
+        max_seq_lens.append((cu_seqlens[1:] - cu_seqlens[:-1]).max())
+    return torch.stack(results).to(dtype=torch.int32), torch.stack(max_seq_lens)
+
+
+def packed_batch(batch_size: int, sequence_len: int, num_seqs: int, padding: int):
+    """every row packs num_seqs sequences followed by padding zeros"""
+    lengths = torch.full((num_seqs,), (sequence_len - padding) // num_seqs)
+    lengths[-1] += sequence_len - padding - lengths.sum()
+    seq_ids = torch.repeat_interleave(torch.arange(1, num_seqs + 1), lengths)
+    starts = torch.repeat_interleave(lengths.cumsum(0) - lengths, lengths)
+    position_ids = torch.arange(sequence_len - padding) - starts
+    pad = torch.zeros(padding, dtype=torch.long)
+    position_ids = torch.cat([position_ids, pad]).repeat(batch_size, 1)
+    attn_mask = torch.cat([seq_ids, pad]).repeat(batch_size, 1)
+    return position_ids, attn_mask
+
+
+def timeit(func, arg, iters: int):
+    func(arg)
+    start = time.perf_counter()
+    for _ in range(iters):
+        func(arg)
+    return (time.perf_counter() - start) / iters
+
+
+def run(
+    batch_sizes=(1, 8, 32),
+    sequence_len: int = 4096,
+    num_seqs: int = 16,
+    padding: int = 100,
+    iters: int = 50,
+):
+    if isinstance(batch_sizes, int):
+        batch_sizes = (batch_sizes,)
+
+    print(f"{'bsz':>5} {'padding':>8} {'function':>28} {'rowwise':>10} {'batched':>10}")
+    for batch_size in batch_sizes:
+        for pad in (0, padding):
+            position_ids, attn_mask = packed_batch(
+                batch_size, sequence_len, num_seqs, pad
+            )
+            for name, rowwise, batched, arg in (
+                (
+                    "get_cu_seqlens_from_pos_ids",
+                    rowwise_cu_seqlens_from_pos_ids,
+                    get_cu_seqlens_from_pos_ids,
+                    position_ids,
+                ),
+                ("get_cu_seqlens", rowwise_cu_seqlens, get_cu_seqlens, attn_mask),
+            ):
+                assert torch.equal(rowwise(arg)[0], batched(arg)[0])
+                rowwise_time = timeit(rowwise, arg, iters)
+                batched_time = timeit(batched, arg, iters)
+                print(
+                    f"{batch_size:>5} {pad:>8} {name:>28} "
+                    f"{rowwise_time * 1e3:>8.3f}ms {batched_time * 1e3:>8.3f}ms"
+                )
+
+
+if __name__ == "__main__":
+    fire.Fire(run)
@@ -0,0 +1,60 @@
+"""
+Tokens/sec benchmark for the pretraining packer used by encode_pretraining.
+
+Times the packing step alone on synthetic pre-tokenized batches, and the full
+encode_pretraining map function when a tokenizer is given.
+
+    python scripts/benchmarks/bench_encode_pretraining.py --tokenizer=huggyllama/llama-7b
+"""
+import time
+
+import fire
+import numpy as np
+
+from axolotl.utils.data import encode_pretraining, pack_pretraining_sequences
+
+
+def run(
+    max_tokens: int = 2048,
+    batch_size: int = 1000,
+    num_batches: int = 20,
+    mean_len: int = 300,
+    tokenizer: str = None,
+    seed: int = 42,
+):
+    rng = np.random.default_rng(seed)
+    batches = []
+    for _ in range(num_batches):
+        lengths = np.clip(rng.exponential(mean_len, size=batch_size), 1, max_tokens - 2)
+        batches.append(
+            [rng.integers(3, 32000, size=int(n)).tolist() for n in lengths.astype(int)]
+        )
+    num_tokens = sum(len(ids) for batch in batches for ids in batch)
+
+    start = time.perf_counter()
+    for batch in batches:
+        pack_pretraining_sequences(
+            batch, [[1] * len(ids) for ids in batch], max_tokens, 2, 0
+        )
+    elapsed = time.perf_counter() - start
+    print(f"pack only: {num_tokens / elapsed:,.0f} tokens/sec")
+
+    if tokenizer:
+        from transformers import AutoTokenizer
+
+        tok = AutoTokenizer.from_pretrained(tokenizer)
+        if tok.pad_token_id is None:
+            tok.pad_token = tok.eos_token
+        texts = [[" ".join(map(str, ids)) for ids in batch] for batch in batches[:5]]
+        start = time.perf_counter()
+        num_tokens = 0
+        for batch in texts:
+            num_tokens += int(
+                encode_pretraining(tok, max_tokens, batch)["attention_mask"].sum()
+            )
+        elapsed = time.perf_counter() - start
+        print(f"encode_pretraining: {num_tokens / elapsed:,.0f} tokens/sec")
+
+
+if __name__ == "__main__":
+    fire.Fire(run)
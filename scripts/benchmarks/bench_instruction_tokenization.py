@@ -0,0 +1,129 @@
+"""
+Tokens/sec benchmark for the instruction prompt strategies, per-row vs batched.
+
+Runs each strategy over synthetic rows through `tokenize_prompt` one row at a
+time and through `tokenize_batch` in batches of 100, the way
+TokenizedPromptDataset maps them. Without a tokenizer a whitespace word-level
+tokenizer is used, which understates the gain of the Rust batch path.
+
+    python scripts/benchmarks/bench_instruction_tokenization.py --tokenizer=huggyllama/llama-7b
+"""
+import time
+
+import fire
+import numpy as np
+from tokenizers import Tokenizer
+from tokenizers.models import WordLevel
+from tokenizers.pre_tokenizers import Whitespace
+from transformers import AutoTokenizer, PreTrainedTokenizerFast
+
+from axolotl.prompt_strategies.alpaca_w_system import (
+    InstructionWSystemPromptTokenizingStrategy,
+    SystemDataPrompter,
+)
+from axolotl.prompt_tokenizers import (
+    AlpacaPromptTokenizingStrategy,
+    JeopardyPromptTokenizingStrategy,
+    OpenAssistantPromptTokenizingStrategy,
+    SummarizeTLDRPromptTokenizingStrategy,
+)
+from axolotl.prompters import (
+    AlpacaPrompter,
+    JeopardyPrompter,
+    PromptStyle,
+    SummarizeTLDRPrompter,
+)
+
+WORDS = [f"w{idx}" for idx in range(5000)]
+
+STRATEGIES = {
+    "alpaca": (
+        AlpacaPromptTokenizingStrategy,
+        lambda: AlpacaPrompter(PromptStyle.INSTRUCT.value),
+        {"instruction": 40, "input": 20, "output": 200},
+    ),
+    "jeopardy": (
+        JeopardyPromptTokenizingStrategy,
+        JeopardyPrompter,
+        {"question": 40, "category": 4, "answer": 10},
+    ),
+    "oasst": (
+        OpenAssistantPromptTokenizingStrategy,
+        lambda: AlpacaPrompter(PromptStyle.CHAT.value),
+        {"INSTRUCTION": 60, "RESPONSE": 250},
+    ),
+    "summarizetldr": (
+        SummarizeTLDRPromptTokenizingStrategy,
+        SummarizeTLDRPrompter,
+        {"article": 600, "summary": 60},
+    ),
+    "alpaca_w_system": (
+        InstructionWSystemPromptTokenizingStrategy,
+        lambda: SystemDataPrompter(PromptStyle.CHAT.value),
+        {"system": 20, "instruction": 40, "output": 200},
+    ),
+}
+
+
+def synthetic_rows(fields, num_rows: int, rng):
+    rows = []
+    for _ in range(num_rows):
+        rows.append(
+            {
+                name: " ".join(
+                    rng.choice(WORDS, size=max(1, int(rng.exponential(mean_len))))
+                )
+                for name, mean_len in fields.items()
+            }
+        )
+    return rows
+
+
+def run(
+    tokenizer: str = None,
+    num_rows: int = 2000,
+    sequence_len: int = 2048,
+    batch_size: int = 100,
+    seed: int = 42,
+):
+    if tokenizer:
+        tok = AutoTokenizer.from_pretrained(tokenizer)
+    else:
+        vocab = {"<unk>": 0, "<s>": 1, "</s>": 2}
+        vocab.update({word: idx + 3 for idx, word in enumerate(WORDS)})
+        backend = Tokenizer(WordLevel(vocab, unk_token="<unk>"))
+        backend.pre_tokenizer = Whitespace()
+        tok = PreTrainedTokenizerFast(
+            tokenizer_object=backend,
+            bos_token="<s>",
+            eos_token="</s>",
+            unk_token="<unk>",
+        )
+
+    rng = np.random.default_rng(seed)
+    for name, (strategy_cls, prompter_cls, fields) in STRATEGIES.items():
+        strat = strategy_cls(prompter_cls(), tok, False, sequence_len)
+        rows = synthetic_rows(fields, num_rows, rng)
+        batches = [
+            {key: [row[key] for row in rows[i : i + batch_size]] for key in fields}
+            for i in range(0, len(rows), batch_size)
+        ]
+
+        start = time.perf_counter()
+        num_tokens = sum(len(strat.tokenize_prompt(row)["input_ids"]) for row in rows)
+        per_row = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for batch in batches:
+            strat.tokenize_batch(batch)
+        batched = time.perf_counter() - start
+
+        print(
+            f"{name:>16}: per-row {num_tokens / per_row:>12,.0f} tokens/sec, "
+            f"batched {num_tokens / batched:>12,.0f} tokens/sec "
+            f"({per_row / batched:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    fire.Fire(run)
@@ -0,0 +1,108 @@
+"""
+Microbenchmark for assembling packed batches in the multipack dataloader.
+
+Compares rows/sec of the row-by-row reference path against the arrow-native
+PackedBatchAssembler on a synthetic dataset.
+
+    python scripts/benchmarks/bench_multipack_assembly.py --num_rows=200000
+"""
+import functools
+import time
+
+import fire
+import numpy as np
+from datasets import Dataset
+
+from axolotl.utils.dataloader import (
+    MultipackDistributedDataloader,
+    PackedBatchAssembler,
+    chunk,
+)
+
+
+def synthetic_dataset(num_rows: int, max_len: int, seed: int = 42) -> Dataset:
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(16, max_len, size=num_rows)
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    tokens = rng.integers(3, 32000, size=int(offsets[-1]))
+    input_ids = [tokens[offsets[i] : offsets[i + 1]] for i in range(num_rows)]
+    return Dataset.from_dict(
+        {
+            "input_ids": input_ids,
+            "labels": input_ids,
+            "attention_mask": [np.ones(length, dtype=np.int64) for length in lengths],
+            "position_ids": [np.arange(length) for length in lengths],
+        }
+    )
+
+
+def assemble_bins_rowwise(dataset, bins):
+    """
+    reference implementation of PackedBatchAssembler that fetches one row at a time
+    """
+    features = dataset.features.keys()
+    chunked_data = []
+    attn_mask_cum_idx = 0
+    for batch in bins:
+        concatenated = {}
+        batched_data = [dataset[int(batch_idx)] for batch_idx in batch]
+        for feature in features:
+            if feature == "length":
+                continue
+            if feature == "attention_mask":
+                arrays = [
+                    (attn_mask_cum_idx + idx + 1) * np.array(item[feature])
+                    for idx, item in enumerate(batched_data)
+                    if feature in item
+                ]
+                attn_mask_cum_idx += len(batched_data)
+                concatenated[feature] = np.concatenate(arrays)
+            else:
+                arrays = [
+                    np.array(item[feature]) for item in batched_data if feature in item
+                ]
+                concatenated[feature] = np.concatenate(arrays)
+        if "position_ids" not in features:
+            concatenated["position_ids"] = np.concatenate(
+                [np.arange(len(item["input_ids"])) for item in batched_data]
+            )
+        chunked_data.append(concatenated)
+    return chunked_data
+
+
+def run(
+    num_rows: int = 100_000,
+    max_len: int = 1024,
+    seq_max_length: int = 4096,
+    batch_size: int = 8,
+    max_batches: int = 200,
+):
+    dataset = synthetic_dataset(num_rows, max_len)
+    loader = MultipackDistributedDataloader(
+        dataset,
+        collate_fn=lambda x: x,
+        seq_max_length=seq_max_length,
+        batch_size=batch_size,
+        sample_packing_seq_len_multiplier=batch_size,
+    )
+    all_batches, _ = loader.generate_batches()
+    groups = list(chunk(all_batches, 1))[:max_batches]
+    num_packed_rows = sum(len(b) for group in groups for b in group)
+
+    assembler = PackedBatchAssembler(dataset)
+    for name, assemble in [
+        ("rowwise", functools.partial(assemble_bins_rowwise, dataset)),
+        ("arrow", assembler),
+    ]:
+        start = time.perf_counter()
+        for group in groups:
+            assemble(group)
+        elapsed = time.perf_counter() - start
+        print(
+            f"{name:>8}: {num_packed_rows / elapsed:,.0f} rows/sec "
+            f"({len(groups) / elapsed:,.1f} batches/sec)"
+        )
+
+
+if __name__ == "__main__":
+    fire.Fire(run)
@@ -0,0 +1,74 @@
+"""
+Benchmark the sample packing allocators on synthetic length distributions.
+
+Reports packing efficiency and wall time for each packer in PACKERS.
+
+    python scripts/benchmarks/bench_packers.py --sizes=1_000_000,10_000_000
+"""
+import time
+
+import fire
+import numpy as np
+
+from axolotl.utils.dataloader import PACKERS
+
+
+def synthetic_lengths(distribution: str, size: int, max_len: int, rng):
+    if distribution == "uniform":
+        lengths = rng.integers(1, max_len + 1, size=size)
+    elif distribution == "lognormal":
+        # mostly short chat turns with a long tail
+        lengths = rng.lognormal(mean=5.5, sigma=1.0, size=size)
+    elif distribution == "bimodal":
+        short = rng.normal(max_len * 0.1, max_len * 0.05, size=size)
+        long = rng.normal(max_len * 0.7, max_len * 0.15, size=size)
+        lengths = np.where(rng.random(size) < 0.7, short, long)
+    else:
+        raise ValueError(f"unknown distribution: {distribution}")
+    return np.clip(lengths, 1, max_len).astype(np.int64)
+
+
+def run(
+    sizes=(1_000_000, 10_000_000),
+    distributions=("uniform", "lognormal", "bimodal"),
+    packers=tuple(PACKERS.keys()),
+    sequence_len: int = 4096,
+    micro_batch_size: int = 8,
+    world_size: int = 1,
+    seed: int = 42,
+):
+    if isinstance(sizes, int):
+        sizes = (sizes,)
+    if isinstance(distributions, str):
+        distributions = (distributions,)
+    if isinstance(packers, str):
+        packers = (packers,)
+    capacity = sequence_len * micro_batch_size
+    rng = np.random.default_rng(seed)
+
+    # compile the numba kernels before timing
+    warmup = synthetic_lengths("uniform", 1000, sequence_len, rng)
+    for name in packers:
+        PACKERS[name](warmup, np.cumsum(warmup), 0, capacity, world_size)
+
+    print(
+        f"{'size':>12} {'distribution':>12} {'packer':>10} {'efficiency':>10} {'time':>9}"
+    )
+    for size in sizes:
+        for distribution in distributions:
+            lengths = synthetic_lengths(distribution, size, sequence_len, rng)
+            lengths_cumsum = np.cumsum(lengths)
+            for name in packers:
+                start = time.perf_counter()
+                _, _, total_used, total_slots = PACKERS[name](
+                    lengths, lengths_cumsum, 0, capacity, world_size
+                )
+                elapsed = time.perf_counter() - start
+                print(
+                    f"{size:>12,} {distribution:>12} {name:>10} "
+                    f"{total_used / total_slots:>10.4f} {elapsed:>8.2f}s"
+                )
+
+
+if __name__ == "__main__":
+    fire.Fire(run)
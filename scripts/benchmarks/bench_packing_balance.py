@@ -0,0 +1,72 @@
+"""
+Predicted per-step compute imbalance across ranks for each sample packing packer.
+
+Packs the sample lengths of a prepared dataset (or synthetic bimodal lengths) for
+every rank the way `sample_packing_exact_length` does and estimates each rank's
+compute per step with the `a*len + b*len^2` cost model. The idle fraction is the
+share of rank time spent waiting on the slowest rank at the gradient all-reduce.
+
+    python scripts/benchmarks/bench_packing_balance.py --world_size=8
+    python scripts/benchmarks/bench_packing_balance.py --dataset=last_run_prepared/<hash>
+"""
+from typing import Optional
+
+import fire
+import numpy as np
+from datasets import load_from_disk
+
+from axolotl.utils.dataloader import (
+    DEFAULT_PACKING_COST,
+    PACKERS,
+    exact_epoch_indices,
+    get_dataset_lengths,
+    simulate_packing,
+)
+
+
+def synthetic_lengths(num_rows: int, long_fraction: float, seed: int):
+    rng = np.random.default_rng(seed)
+    return np.where(
+        rng.random(num_rows) < long_fraction,
+        rng.integers(1024, 2048, size=num_rows),
+        rng.integers(16, 512, size=num_rows),
+    ).astype(np.int64)
+
+
+def run(
+    dataset: Optional[str] = None,
+    num_rows: int = 100_000,
+    long_fraction: float = 0.05,
+    sequence_len: int = 2048,
+    micro_batch_size: int = 2,
+    world_size: int = 8,
+    cost_a: float = DEFAULT_PACKING_COST[0],
+    cost_b: float = DEFAULT_PACKING_COST[1],
+    seed: int = 42,
+):
+    if dataset:
+        lengths = get_dataset_lengths(load_from_disk(dataset))
+    else:
+        lengths = synthetic_lengths(num_rows, long_fraction, seed)
+    lengths = lengths[exact_epoch_indices(len(lengths), seed, 1)]
+    cost = (cost_a, cost_b)
+    print(
+        f"{len(lengths)} samples, {world_size} ranks, "
+        f"{sequence_len * micro_batch_size} tokens per bin, cost {cost_a}*len + {cost_b:.3g}*len^2"
+    )
+    print(
+        f"{'packer':>10} {'steps':>6} {'eff':>6} {'max/mean':>9} {'p99':>6} {'idle':>6}"
+    )
+    for packer in PACKERS:
+        stats = simulate_packing(
+            lengths, sequence_len * micro_batch_size, world_size, packer, cost
+        )
+        print(
+            f"{packer:>10} {stats['steps']:>6} {stats['efficiency']:>6.3f} "
+            f"{stats['imbalance_mean']:>9.3f} {stats['imbalance_p99']:>6.3f} "
+            f"{stats['idle_fraction']:>6.1%}"
+        )
+
+
+if __name__ == "__main__":
+    fire.Fire(run)
@@ -0,0 +1,82 @@
+"""
+Read throughput of a merged dataset for each `dataset_shuffle_mode` layout.
+
+Saves synthetic tokenized rows to disk, reloads them memory-mapped and reads the
+shuffled dataset in its logical order in chunks of rows: through a global indices
+mapping (random), after rewriting the shuffled order (flatten) and through a block
+shuffle mapping (block). The page cache is dropped between layouts when possible
+(needs root), otherwise the numbers understate the gap on network filesystems.
+
+    python scripts/benchmarks/bench_shuffle_layout.py --num_rows=500000
+"""
+import os
+import subprocess
+import tempfile
+import time
+
+import fire
+import numpy as np
+import pyarrow as pa
+from datasets import Dataset, load_from_disk
+
+from axolotl.utils.data import shuffle_merged_dataset
+from axolotl.utils.dict import DictDefault
+
+
+def drop_page_cache() -> bool:
+    try:
+        subprocess.run(["sync"], check=True)
+        with open("/proc/sys/vm/drop_caches", "w", encoding="utf-8") as fout:
+            fout.write("3\n")
+        return True
+    except (OSError, subprocess.CalledProcessError):
+        return False
+
+
+def read_throughput(dataset, rows_per_read: int, max_reads: int) -> float:
+    dataset = dataset.with_format("arrow")
+    num_rows = min(len(dataset), rows_per_read * max_reads)
+    start = time.perf_counter()
+    num_tokens = 0
+    for offset in range(0, num_rows, rows_per_read):
+        batch = dataset[offset : min(offset + rows_per_read, num_rows)]
+        num_tokens += len(batch.column("input_ids").combine_chunks().flatten())
+    return num_tokens / (time.perf_counter() - start)
+
+
+def run(
+    num_rows: int = 200_000,
+    mean_len: int = 256,
+    block_size: int = 1000,
+    rows_per_read: int = 64,
+    max_reads: int = 2000,
+    seed: int = 42,
+):
+    rng = np.random.default_rng(seed)
+    lengths = np.clip(rng.exponential(mean_len, size=num_rows).astype(int), 1, 4096)
+    tokens = rng.integers(3, 32_000, size=int(lengths.sum()), dtype=np.int32)
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int32)
+    input_ids = pa.ListArray.from_arrays(pa.array(offsets), pa.array(tokens))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "merged")
+        table = pa.table({"input_ids": input_ids, "labels": input_ids})
+        Dataset(table).save_to_disk(path)
+        for mode in ("random", "flatten", "block"):
+            cfg = DictDefault(
+                {"dataset_shuffle_mode": mode, "dataset_shuffle_block_size": block_size}
+            )
+            start = time.perf_counter()
+            dataset = shuffle_merged_dataset(load_from_disk(path), cfg, seed)
+            shuffle_time = time.perf_counter() - start
+            cold = drop_page_cache()
+            throughput = read_throughput(dataset, rows_per_read, max_reads)
+            print(
+                f"{mode:>8}: shuffle {shuffle_time:6.2f}s, "
+                f"read {throughput:>14,.0f} tokens/sec"
+                f"{' (cold cache)' if cold else ''}"
+            )
+
+
+if __name__ == "__main__":
+    fire.Fire(run)
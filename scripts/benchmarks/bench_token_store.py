@@ -0,0 +1,99 @@
+"""
+Disk size and load time of a prepared dataset saved with `save_to_disk` vs as a
+TokenStore (`dataset_prepared_format: token_store`).
+
+Builds synthetic tokenized rows with a prompt/response label split, saves them
+both ways and times reloading plus reading the row lengths and packing a few
+batches, which is what the multipack dataloader does at startup.
+
+    python scripts/benchmarks/bench_token_store.py --num_rows=200000
+"""
+import tempfile
+import time
+from pathlib import Path
+
+import fire
+import numpy as np
+from datasets import Dataset, load_from_disk
+
+from axolotl.utils.dataloader import PackedBatchAssembler, get_dataset_lengths
+from axolotl.utils.token_store import TokenStore
+from axolotl.utils.trainer import get_dataset_supervised_tokens
+
+
+def synthetic_dataset(num_rows: int, mean_len: int, vocab_size: int, seed: int):
+    rng = np.random.default_rng(seed)
+    lengths = np.clip(rng.exponential(mean_len, size=num_rows).astype(int), 8, 4096)
+    rows = {"input_ids": [], "attention_mask": [], "labels": []}
+    for length in lengths:
+        input_ids = rng.integers(3, vocab_size, size=length).tolist()
+        prompt_len = int(rng.integers(1, length))
+        rows["input_ids"].append(input_ids)
+        rows["attention_mask"].append([1] * length)
+        rows["labels"].append([-100] * prompt_len + input_ids[prompt_len:])
+    return Dataset.from_dict(rows)
+
+
+def dir_size(path: Path) -> int:
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+
+def load_and_pack(load, num_batches: int, rows_per_batch: int):
+    start = time.perf_counter()
+    dataset = load()
+    get_dataset_lengths(dataset)
+    get_dataset_supervised_tokens(dataset)
+    assembler = PackedBatchAssembler(dataset)
+    rng = np.random.default_rng(0)
+    for _ in range(num_batches):
+        rows = rng.choice(len(dataset), size=rows_per_batch, replace=False)
+        assembler([rows[: rows_per_batch // 2], rows[rows_per_batch // 2 :]])
+    return time.perf_counter() - start
+
+
+def run(
+    num_rows: int = 50_000,
+    mean_len: int = 512,
+    vocab_size: int = 32_000,
+    num_batches: int = 50,
+    rows_per_batch: int = 16,
+    seed: int = 42,
+):
+    dataset = synthetic_dataset(num_rows, mean_len, vocab_size, seed)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        arrow_path = Path(tmp_dir) / "arrow"
+        store_path = Path(tmp_dir) / "store"
+
+        start = time.perf_counter()
+        dataset.save_to_disk(arrow_path)
+        arrow_save = time.perf_counter() - start
+        start = time.perf_counter()
+        TokenStore.save(dataset, store_path, vocab_size=vocab_size)
+        store_save = time.perf_counter() - start
+
+        arrow_load = load_and_pack(
+            lambda: load_from_disk(str(arrow_path)), num_batches, rows_per_batch
+        )
+        store_load = load_and_pack(
+            lambda: TokenStore(store_path), num_batches, rows_per_batch
+        )
+
+        arrow_size = dir_size(arrow_path)
+        store_size = dir_size(store_path)
+        print(f"{'':>12} {'disk':>10} {'save':>8} {'load+pack':>10}")
+        print(
+            f"{'save_to_disk':>12} {arrow_size / 2**20:>8.1f}MB "
+            f"{arrow_save:>7.2f}s {arrow_load:>9.2f}s"
+        )
+        print(
+            f"{'token_store':>12} {store_size / 2**20:>8.1f}MB "
+            f"{store_save:>7.2f}s {store_load:>9.2f}s"
+        )
+        print(
+            f"disk {arrow_size / store_size:.1f}x smaller, "
+            f"load+pack {arrow_load / store_load:.1f}x faster"
+        )
+
+
+if __name__ == "__main__":
+    fire.Fire(run)
@@ -3,7 +3,9 @@ Builder for the training args and trainer
 """
 
 import abc
+import hashlib
 import importlib
+import json
 import logging
 import math
 import os
@@ -12,7 +14,7 @@ from abc import abstractmethod
 from dataclasses import dataclass, field
 from functools import partial
 from pathlib import Path
-from typing import Optional, Union
+from typing import Any, Dict, List, Optional, Union
 
 import torch
 import transformers
@@ -20,9 +22,15 @@ from datasets import Dataset
 from torch.optim.lr_scheduler import OneCycleLR
 from torch.utils.data import DataLoader, DistributedSampler, SequentialSampler
 from transformers import EarlyStoppingCallback, Trainer, TrainingArguments
-from transformers.trainer_pt_utils import SequentialDistributedSampler
+from transformers.trainer_pt_utils import (
+    LengthGroupedSampler,
+    SequentialDistributedSampler,
+)
+from transformers.trainer_utils import PREFIX_CHECKPOINT_DIR, get_last_checkpoint
 
 from axolotl.monkeypatch.relora import ReLoRACallback, ReLoRAScheduler
+from axolotl.monkeypatch.utils import accepts_packed_seqlens
+from axolotl.utils.batch_cache import BatchCache
 from axolotl.utils.callbacks import (
     EvalFirstStepCallback,
     GPUStatsCallback,
@@ -33,7 +41,13 @@ from axolotl.utils.callbacks import (
     log_prediction_callback_factory,
 )
 from axolotl.utils.collators import DataCollatorForSeq2Seq
-from axolotl.utils.dataloader import MultipackDistributedDataloader
+from axolotl.utils.dataloader import (
+    MultipackDistributedDataloader,
+    TokenBudgetBatchSampler,
+    TokenBudgetDataLoader,
+    get_dataset_lengths,
+    packer_key,
+)
 from axolotl.utils.schedulers import get_cosine_schedule_with_quadratic_warmup
 
 try:
@@ -43,6 +57,8 @@ except ImportError:
 
 LOG = logging.getLogger("axolotl.core.trainer_builder")
 
+DATALOADER_STATE_NAME = "dataloader_state.json"
+
 
 @dataclass
 class AxolotlTrainingArguments(TrainingArguments):
@@ -74,6 +90,44 @@ class AxolotlTrainingArguments(TrainingArguments):
         default=1,
         metadata={"help": "the multiplier for the max len for packed sequences"},
     )
+    sample_packing_packer: str = field(
+        default="multifit",
+        metadata={"help": "bin packing algorithm: multifit, bfd or balanced"},
+    )
+    sample_packing_cost: Optional[List[float]] = field(
+        default=None,
+        metadata={
+            "help": "cost a*len + b*len^2 of a sequence as [a, b] for the balanced packer"
+        },
+    )
+    eval_batch_cache: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "pack and collate the eval set once and replay it, kept in memory or on disk"
+        },
+    )
+    batch_max_tokens: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "form unpacked train batches of up to this many padded tokens"
+        },
+    )
+    batch_bucket_size: int = field(
+        default=4096,
+        metadata={"help": "rows sorted by length together for batch_max_tokens"},
+    )
+    batch_loss_tokens: Optional[float] = field(
+        default=None,
+        metadata={
+            "help": "mean label tokens per batch_max_tokens batch to normalize the loss by"
+        },
+    )
+    sample_packing_exact_length: bool = field(
+        default=False,
+        metadata={
+            "help": "pack the same seeded order on every rank so the epoch length is exact"
+        },
+    )
     relora_steps: Optional[int] = field(
         default=None,
         metadata={"help": "how often to reset for ReLoRA"},
@@ -115,6 +169,9 @@ class AxolotlTrainer(Trainer):
     def __init__(self, *args, num_epochs=1, bench_data_collator=None, **kwargs):
         self.num_epochs = num_epochs
         self.bench_data_collator = bench_data_collator
+        self._eval_batches: Optional[BatchCache] = None
+        self._train_dataloader: Optional[MultipackDistributedDataloader] = None
+        self._dataloader_resume_state: Optional[Dict[str, Any]] = None
         super().__init__(*args, **kwargs)
 
     def create_scheduler(
@@ -146,13 +203,22 @@ class AxolotlTrainer(Trainer):
         return self.lr_scheduler
 
     def _get_train_sampler(self) -> Optional[torch.utils.data.Sampler]:
-        if self.args.world_size > 1 and self.args.sample_packing:
+        if self.args.sample_packing:
+            # seeded per epoch even on a single process, so a resumed run can repack
+            # the epoch it stopped in
             return DistributedSampler(
                 self.train_dataset,
                 num_replicas=self.args.world_size,
                 rank=self.args.process_index,
                 seed=self.args.seed,
             )
+        if self.args.group_by_length and isinstance(self.train_dataset, Dataset):
+            # read the lengths from the arrow offsets rather than a length column
+            return LengthGroupedSampler(
+                self.args.train_batch_size * self.args.gradient_accumulation_steps,
+                dataset=self.train_dataset,
+                lengths=get_dataset_lengths(self.train_dataset).tolist(),
+            )
         return super()._get_train_sampler()
 
     def _get_eval_sampler(
@@ -172,9 +238,23 @@ class AxolotlTrainer(Trainer):
         return super()._get_eval_sampler(eval_dataset)
 
     def get_train_dataloader(self) -> Union[DataLoader, MultipackDistributedDataloader]:
+        if self.args.sample_packing and isinstance(
+            self.train_dataset, torch.utils.data.IterableDataset
+        ):
+            # streamed pretraining datasets are already packed as they're iterated,
+            # with a whole micro batch in every row
+            return self.accelerator.prepare(
+                DataLoader(
+                    self.train_dataset,
+                    batch_size=1,
+                    collate_fn=self.data_collator,
+                    num_workers=self.args.dataloader_num_workers,
+                    pin_memory=self.args.dataloader_pin_memory,
+                )
+            )
         if self.args.sample_packing:
             train_sampler = self._get_train_sampler()
-            return self.accelerator.prepare(
+            self._train_dataloader = self.accelerator.prepare(
                 MultipackDistributedDataloader(
                     self.train_dataset,
                     batch_size=self._train_batch_size,
@@ -185,10 +265,79 @@ class AxolotlTrainer(Trainer):
                     sample_packing_seq_len_multiplier=self.args.sample_packing_seq_len_multiplier,
                     device_count=int(os.environ.get("WORLD_SIZE", 1)),
                     num_epochs=self.num_epochs,
+                    num_workers=self.args.dataloader_num_workers,
+                    packer=self.args.sample_packing_packer,
+                    exact_length=self.args.sample_packing_exact_length,
+                    seed=self.args.seed,
+                    packing_cost=self.args.sample_packing_cost,
                 )
             )
+            if self._dataloader_resume_state is not None:
+                self._train_dataloader.load_state_dict(self._dataloader_resume_state)
+                self._dataloader_resume_state = None
+            return self._train_dataloader
+        if self.args.batch_max_tokens and isinstance(self.train_dataset, Dataset):
+            return self._get_token_budget_dataloader()
         return super().get_train_dataloader()
 
+    def _get_token_budget_dataloader(self) -> TokenBudgetDataLoader:
+        batch_sampler = TokenBudgetBatchSampler(
+            get_dataset_lengths(self.train_dataset),
+            self.args.batch_max_tokens,
+            num_replicas=self.args.world_size,
+            rank=self.args.process_index,
+            seed=self.args.seed,
+            bucket_size=self.args.batch_bucket_size,
+            pad_to_multiple_of=getattr(self.data_collator, "pad_to_multiple_of", None)
+            or 1,
+            drop_last=self.args.dataloader_drop_last,
+        )
+        # not prepared by accelerate, which would shard the batches between ranks a
+        # second time
+        return TokenBudgetDataLoader(
+            self._remove_unused_columns(self.train_dataset, description="training"),
+            batch_sampler=batch_sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+        )
+
+    def train(self, resume_from_checkpoint=None, **kwargs):
+        checkpoint = resume_from_checkpoint
+        if isinstance(checkpoint, bool):
+            checkpoint = (
+                get_last_checkpoint(self.args.output_dir) if checkpoint else None
+            )
+        state_path = Path(checkpoint) / DATALOADER_STATE_NAME if checkpoint else None
+        if self.args.ignore_data_skip or not (state_path and state_path.exists()):
+            return super().train(
+                resume_from_checkpoint=resume_from_checkpoint, **kwargs
+            )
+
+        with open(state_path, encoding="utf-8") as fin:
+            self._dataloader_resume_state = json.load(fin)
+        # the packed dataloader starts at the saved batch itself, so skip the trainer's
+        # fast forward that would pack and collate every batch before it
+        self.args.ignore_data_skip = True
+        try:
+            return super().train(
+                resume_from_checkpoint=resume_from_checkpoint, **kwargs
+            )
+        finally:
+            self.args.ignore_data_skip = False
+            self._dataloader_resume_state = None
+
+    def _save_checkpoint(self, model, trial, metrics=None):
+        super()._save_checkpoint(model, trial, metrics=metrics)
+        if self._train_dataloader is None or not self.args.should_save:
+            return
+        output_dir = Path(self._get_output_dir(trial=trial)) / (
+            f"{PREFIX_CHECKPOINT_DIR}-{self.state.global_step}"
+        )
+        # the position is the same on every rank
+        with open(output_dir / DATALOADER_STATE_NAME, "w", encoding="utf-8") as fout:
+            json.dump(self._train_dataloader.state_dict(), fout)
+
     def get_eval_dataloader(
         self, eval_dataset: Optional[Dataset] = None
     ) -> Union[DataLoader, MultipackDistributedDataloader]:
@@ -197,22 +346,76 @@ class AxolotlTrainer(Trainer):
                 eval_dataset if eval_dataset is not None else self.eval_dataset
             )
 
-            eval_sampler = self._get_eval_sampler(eval_dataset)
+            if self.args.eval_batch_cache and getattr(
+                eval_dataset, "_fingerprint", None
+            ):
+                return self._get_cached_eval_batches(eval_dataset)
             return self.accelerator.prepare(
-                MultipackDistributedDataloader(
-                    eval_dataset,
-                    batch_size=self.args.eval_batch_size,
-                    seq_max_length=self.args.max_seq_length,
-                    collate_fn=self.data_collator,
-                    sampler=eval_sampler,
-                    packing_efficiency_estimate=self.args.sample_packing_efficiency,
-                    sample_packing_seq_len_multiplier=self.args.eval_batch_size,
-                    device_count=int(os.environ.get("WORLD_SIZE", 1)),
-                    num_epochs=self.num_epochs,
-                )
+                self._get_packed_eval_dataloader(eval_dataset)
             )
         return super().get_eval_dataloader(eval_dataset)
 
+    def _get_packed_eval_dataloader(
+        self, eval_dataset: Dataset, num_epochs: Optional[int] = None
+    ) -> MultipackDistributedDataloader:
+        return MultipackDistributedDataloader(
+            eval_dataset,
+            batch_size=self.args.eval_batch_size,
+            seq_max_length=self.args.max_seq_length,
+            collate_fn=self.data_collator,
+            sampler=self._get_eval_sampler(eval_dataset),
+            packing_efficiency_estimate=self.args.sample_packing_efficiency,
+            sample_packing_seq_len_multiplier=self.args.eval_batch_size,
+            device_count=int(os.environ.get("WORLD_SIZE", 1)),
+            num_epochs=num_epochs or self.num_epochs,
+            num_workers=self.args.dataloader_num_workers,
+            packer=self.args.sample_packing_packer,
+        )
+
+    def _eval_batch_cache_key(self, eval_dataset: Dataset) -> str:
+        collator = self.data_collator
+        key = [
+            eval_dataset._fingerprint,  # pylint: disable=protected-access
+            str(len(eval_dataset)),
+            str(self.args.eval_batch_size),
+            str(self.args.max_seq_length),
+            str(self.args.sample_packing_efficiency),
+            packer_key(self.args.sample_packing_packer, self.args.sample_packing_cost),
+            str(self.args.world_size),
+            str(self.args.process_index),
+            type(collator).__name__,
+            str(getattr(collator, "pad_to_multiple_of", None)),
+            str(getattr(collator, "return_cu_seqlens", None)),
+        ]
+        return hashlib.sha256("|".join(key).encode()).hexdigest()
+
+    def _get_cached_eval_batches(self, eval_dataset: Dataset) -> BatchCache:
+        # the eval set is packed in the same order for every evaluation, so pack and
+        # collate it once and replay the batches until its fingerprint changes
+        key = self._eval_batch_cache_key(eval_dataset)
+        if self._eval_batches is not None and self._eval_batches.key == key:
+            return self._eval_batches
+
+        path = None
+        cache_files = getattr(eval_dataset, "cache_files", None)
+        if self.args.eval_batch_cache == "disk" and cache_files:
+            path = Path(cache_files[0]["filename"]).parent / "eval_batches" / key
+        cache_kwargs = {
+            "key": key,
+            "dataset": eval_dataset,
+            "pin_memory": bool(getattr(self.data_collator, "pin_memory", False)),
+        }
+        if path and BatchCache.exists(path):
+            LOG.info(f"loading eval batches from {path}")
+            self._eval_batches = BatchCache.load(path, **cache_kwargs)
+        else:
+            self._eval_batches = BatchCache.build(
+                self._get_packed_eval_dataloader(eval_dataset, num_epochs=1),
+                path=path,
+                **cache_kwargs,
+            )
+        return self._eval_batches
+
     def _get_bench_sampler(
         self, bench_dataset: Dataset
     ) -> Optional[torch.utils.data.Sampler]:
@@ -239,6 +442,14 @@ class AxolotlTrainer(Trainer):
         # return self.accelerator.prepare(DataLoader(bench_dataset, **dataloader_params))
 
     def compute_loss(self, model, inputs, return_outputs=False):
+        if self.args.batch_loss_tokens and model.training:
+            # token budget batches hold different numbers of label tokens, so weigh every
+            # token the same instead of every batch. The mean over the gradient
+            # accumulation steps and ranks then stays the mean over tokens
+            num_tokens = (inputs["labels"][..., 1:] != -100).sum()
+            loss, outputs = super().compute_loss(model, inputs, return_outputs=True)
+            loss = loss * num_tokens / self.args.batch_loss_tokens
+            return (loss, outputs) if return_outputs else loss
         # use one's weighted cross entropy loss calc
         # if self.args.sample_packing:
         #     labels = inputs.pop("labels")
@@ -389,7 +600,7 @@ class HFCausalTrainerBuilder(TrainerBuilderBase):
         ):
             callbacks.append(SaveBetterTransformerModelCallback)
 
-        runpod_job_id = os.getenv('RUNPOD_JOB_ID')
+        runpod_job_id = os.getenv("RUNPOD_JOB_ID")
         if runpod_job_id:
             print("RunPodCallback enabled")
             # If the variable is set, add the RunPodCallback to the callbacks list
@@ -500,6 +711,43 @@ class HFCausalTrainerBuilder(TrainerBuilderBase):
                 "sample_packing_efficiency"
             ] = self.cfg.sample_packing_eff_est
 
+        if self.cfg.sample_packing_packer:
+            training_arguments_kwargs[
+                "sample_packing_packer"
+            ] = self.cfg.sample_packing_packer
+
+        if self.cfg.sample_packing_exact_length:
+            training_arguments_kwargs["sample_packing_exact_length"] = True
+
+        if self.cfg.eval_batch_cache:
+            training_arguments_kwargs["eval_batch_cache"] = (
+                "memory"
+                if self.cfg.eval_batch_cache is True
+                else self.cfg.eval_batch_cache
+            )
+
+        if self.cfg.batch_max_tokens:
+            training_arguments_kwargs["batch_max_tokens"] = self.cfg.batch_max_tokens
+            training_arguments_kwargs["batch_loss_tokens"] = self.cfg.batch_loss_tokens
+            if self.cfg.batch_bucket_size:
+                training_arguments_kwargs[
+                    "batch_bucket_size"
+                ] = self.cfg.batch_bucket_size
+
+        if self.cfg.sample_packing_cost:
+            training_arguments_kwargs["sample_packing_cost"] = list(
+                self.cfg.sample_packing_cost
+            )
+
+        if self.cfg.dataloader_num_workers is not None:
+            training_arguments_kwargs[
+                "dataloader_num_workers"
+            ] = self.cfg.dataloader_num_workers
+        if self.cfg.dataloader_drop_last is not None:
+            training_arguments_kwargs[
+                "dataloader_drop_last"
+            ] = self.cfg.dataloader_drop_last
+
         if self.cfg.eval_steps:
             training_arguments_kwargs["evaluation_strategy"] = "steps"
             training_arguments_kwargs["eval_steps"] = self.cfg.eval_steps
@@ -682,6 +930,19 @@ class HFCausalTrainerBuilder(TrainerBuilderBase):
             data_collator=DataCollatorForSeq2Seq(
                 self.tokenizer,
                 return_tensors="pt",
+                # let the packed flash attention forward reuse the boundaries computed
+                # on the cpu while collating instead of rebuilding them every step
+                return_cu_seqlens=bool(
+                    self.cfg.sample_packing and accepts_packed_seqlens(self.model)
+                ),
+                # the multipack loader doesn't pin batches itself, and collating in
+                # worker processes would have to ship the pinned pages back
+                pin_memory=bool(
+                    self.cfg.sample_packing
+                    and training_args.dataloader_pin_memory
+                    and not training_args.dataloader_num_workers
+                    and torch.cuda.is_available()
+                ),
                 **data_collator_kwargs,
             ),
             bench_data_collator=transformers.DataCollatorForSeq2Seq(
@@ -1,11 +1,13 @@
 """Module containing Dataset functionality"""
 
+import bisect
 import logging
 import os
-from typing import List, Optional
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
+import numpy as np
 import torch
-from datasets import Dataset, IterableDataset
+from datasets import Dataset, Features, IterableDataset, Sequence, Value
 
 from .prompt_tokenizers import PromptTokenizingStrategy
 
@@ -45,11 +47,13 @@ class TokenizedPromptDataset(Dataset):
             else min(64, os.cpu_count())
         )
         map_kwargs = {}
+        tokenize_fn = self.prompt_tokenizer.tokenize_prompt
         if self.prompt_tokenizer.supports_batched:
             map_kwargs["batched"] = True
             map_kwargs["batch_size"] = 100
+            tokenize_fn = self.prompt_tokenizer.tokenize_batch
         return dataset.map(
-            self.prompt_tokenizer.tokenize_prompt,
+            tokenize_fn,
             num_proc=num_proc,
             remove_columns=features,
             **map_kwargs,
@@ -180,3 +184,159 @@ class ConstantLengthDataset(IterableDataset):
                         buffer["labels"].append(labels_with_concat)
                         buffer["position_ids"].append(position_ids)
                         buffer_len += len(input_ids)
+
+
+class StreamingMultipackDataset(torch.utils.data.IterableDataset):
+    """
+    Iterable dataset that best-fit packs a stream of tokenized documents into sequences
+    of at most `seq_length` tokens instead of padding out the rest of a sequence when
+    the next document doesn't fit.
+        Args:
+            dataset (Iterable): Stream of examples with the `input_ids` of one document.
+            seq_length (int): Maximum number of tokens in a packed sequence.
+            buffer_size (int): Number of partially filled sequences kept open as the
+                lookahead. Once all of them are open and a document fits in none, the
+                fullest one is emitted.
+            log_every (int): Log the running packing efficiency every this many sequences.
+            micro_batch_size (int): Number of packed sequences concatenated into each
+                emitted row, like the multipack dataloader does, so the rows are loaded
+                with a batch size of 1.
+
+    Every document keeps its own `position_ids` and `attention_mask` number so the flash
+    attention varlen path doesn't attend across documents.
+    """
+
+    def __init__(
+        self,
+        dataset: Iterable[Dict[str, Any]],
+        seq_length: int = 2048,
+        buffer_size: int = 64,
+        log_every: int = 1000,
+        micro_batch_size: int = 1,
+    ):
+        self.dataset = dataset
+        self.seq_length = seq_length
+        self.buffer_size = buffer_size
+        self.log_every = log_every
+        self.micro_batch_size = micro_batch_size
+        self.num_tokens = 0
+        self.num_sequences = 0
+
+    @property
+    def packing_efficiency(self) -> float:
+        """share of the emitted token slots taken by document tokens"""
+        if not self.num_sequences:
+            return 0.0
+        return self.num_tokens / (self.num_sequences * self.seq_length)
+
+    def _emit(self, bins: List[List[Any]]) -> Dict[str, np.ndarray]:
+        documents = [document for documents in bins for document in documents]
+        lengths = np.fromiter(map(len, documents), dtype=np.int64, count=len(documents))
+        input_ids = np.concatenate(
+            [np.asarray(document, dtype=np.int64) for document in documents]
+        )
+        starts = np.cumsum(lengths) - lengths
+        self.num_tokens += len(input_ids)
+        self.num_sequences += len(bins)
+        if self.log_every and self.num_sequences % self.log_every < len(bins):
+            LOG.info(
+                f"streaming packing efficiency: {self.packing_efficiency:.4f} "
+                f"over {self.num_sequences} sequences"
+            )
+        return {
+            "input_ids": input_ids,
+            "labels": input_ids.copy(),
+            "attention_mask": np.repeat(
+                np.arange(1, len(documents) + 1, dtype=np.int64), lengths
+            ),
+            "position_ids": np.arange(len(input_ids), dtype=np.int64)
+            - np.repeat(starts, lengths),
+        }
+
+    def _pack(self) -> Iterator[List[Any]]:
+        """best-fit pack the stream, yielding the documents of each full sequence"""
+        open_bins: Dict[int, List[Any]] = {}
+        # (free tokens, bin id) of the open bins, sorted for the best-fit lookup
+        free_space: List[Tuple[int, int]] = []
+        next_bin = 0
+        for example in self.dataset:
+            input_ids = example["input_ids"]
+            length = len(input_ids)
+            if not 0 < length <= self.seq_length:
+                continue
+
+            idx = bisect.bisect_left(free_space, (length, -1))
+            if idx < len(free_space):
+                free, bin_id = free_space.pop(idx)
+            else:
+                if len(open_bins) >= self.buffer_size:
+                    # nothing fits, make room by emitting the fullest sequence
+                    _, fullest = free_space.pop(0)
+                    yield open_bins.pop(fullest)
+                free, bin_id = self.seq_length, next_bin
+                open_bins[bin_id] = []
+                next_bin += 1
+
+            open_bins[bin_id].append(input_ids)
+            free -= length
+            if free:
+                bisect.insort(free_space, (free, bin_id))
+            else:
+                yield open_bins.pop(bin_id)
+
+        for _, bin_id in free_space:
+            yield open_bins.pop(bin_id)
+
+    def __iter__(self):
+        self.num_tokens = 0
+        self.num_sequences = 0
+        bins: List[List[Any]] = []
+        for documents in self._pack():
+            bins.append(documents)
+            if len(bins) == self.micro_batch_size:
+                yield self._emit(bins)
+                bins = []
+        if bins:
+            yield self._emit(bins)
+        if self.num_sequences:
+            LOG.info(
+                f"streaming packing efficiency: {self.packing_efficiency:.4f} "
+                f"over {self.num_sequences} sequences"
+            )
+
+
+def pack_constant_length_shards(
+    shard_indices: List[int],
+    dataset: Dataset,
+    tokenizer,
+    seq_length: int,
+    num_shards: int,
+    max_length: Optional[int] = None,
+):
+    """
+    Generator that packs contiguous shards of a tokenized dataset with
+    ConstantLengthDataset, one packed example at a time. Meant to be passed to
+    `Dataset.from_generator` so packed rows are streamed into arrow record batches.
+    """
+    max_length = max_length or seq_length
+    for index in shard_indices:
+        shard = dataset.shard(num_shards=num_shards, index=index, contiguous=True)
+        for example in ConstantLengthDataset(tokenizer, [shard], seq_length=seq_length):
+            input_len = len(example["input_ids"])
+            if not 0 < input_len <= max_length:
+                continue
+            yield {key: value.numpy() for key, value in example.items()}
+
+
+def constant_length_features(tokenizer) -> Features:
+    tokens_dtype = str(
+        ConstantLengthDataset(tokenizer, []).tokens_dtype  # type: ignore
+    ).replace("torch.", "")
+    return Features(
+        {
+            "input_ids": Sequence(Value(tokens_dtype)),
+            "labels": Sequence(Value(tokens_dtype)),
+            "attention_mask": Sequence(Value("int16")),
+            "position_ids": Sequence(Value(tokens_dtype)),
+        }
+    )
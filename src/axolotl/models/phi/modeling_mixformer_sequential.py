@@ -896,11 +896,14 @@ class MixFormerSequentialForCausalLM(MixFormerSequentialPreTrainedModel):
         labels: Optional[torch.LongTensor] = None,
         past_key_values: Optional[torch.FloatTensor] = None,
         position_ids: Optional[torch.LongTensor] = None,
+        cu_seqlens: Optional[torch.LongTensor] = None,
+        max_seqlen: Optional[int] = None,
         **kwargs,
     ) -> CausalLMOutputWithPast:
-        cu_seqlens: Optional[torch.LongTensor] = None
-        max_seqlen: Optional[int] = None
-        if position_ids is not None:
+        if cu_seqlens is not None:
+            # precomputed by the collator for packed batches
+            cu_seqlens = cu_seqlens.squeeze()
+        elif position_ids is not None:
             batch_size, seq_length = input_ids.shape
             position_ids = position_ids.view(-1, seq_length).long()
             cu_seqlens, max_seqlen = get_cu_seqlens_from_pos_ids(position_ids)
@@ -24,7 +24,11 @@ from transformers.models.llama.modeling_llama import (
 )
 from xformers.ops import SwiGLU
 
-from axolotl.monkeypatch.utils import get_cu_seqlens_from_pos_ids, set_module_name
+from axolotl.monkeypatch.utils import (
+    forward_with_packed_seqlens,
+    get_packed_seqlens,
+    set_module_name,
+)
 
 try:
     from flash_attn.flash_attn_interface import (  # pylint: disable=ungrouped-imports
@@ -80,6 +84,11 @@ def replace_llama_attn_with_flash_attn(
         transformers.models.llama.modeling_llama.LlamaModel.forward = (
             llama_model_forward
         )
+        transformers.models.llama.modeling_llama.LlamaForCausalLM.forward = (
+            forward_with_packed_seqlens(
+                transformers.models.llama.modeling_llama.LlamaForCausalLM.forward
+            )
+        )
 
     # skip only if explicitly disabled
     if cross_entropy:
@@ -592,8 +601,7 @@ def llama_model_forward(
         position_ids = position_ids.unsqueeze(0).view(-1, seq_length)
     else:
         position_ids = position_ids.view(-1, seq_length).long()
-        cu_seqlens, max_seqlen = get_cu_seqlens_from_pos_ids(position_ids)
-        cu_seqlens = cu_seqlens.squeeze()
+        cu_seqlens, max_seqlen = get_packed_seqlens(self, position_ids)
 
     if inputs_embeds is None:
         inputs_embeds = self.embed_tokens(input_ids)
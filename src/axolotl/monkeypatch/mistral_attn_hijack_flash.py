@@ -22,7 +22,7 @@ from transformers.models.mistral.modeling_mistral import (
 )
 from transformers.models.mistral.modeling_mistral import apply_rotary_pos_emb, repeat_kv
 
-from axolotl.monkeypatch.utils import get_cu_seqlens_from_pos_ids
+from axolotl.monkeypatch.utils import forward_with_packed_seqlens, get_packed_seqlens
 
 LOG = logging.getLogger("axolotl.monkeypatch.mistral")
 
@@ -43,6 +43,11 @@ def replace_mistral_attn_with_flash_attn(
         transformers.models.mistral.modeling_mistral.MistralModel.forward = (
             mistral_model_forward
         )
+        transformers.models.mistral.modeling_mistral.MistralForCausalLM.forward = (
+            forward_with_packed_seqlens(
+                transformers.models.mistral.modeling_mistral.MistralForCausalLM.forward
+            )
+        )
 
 
 @torch.jit.script
@@ -470,8 +475,7 @@ def mistral_model_forward(
         position_ids = position_ids.unsqueeze(0).view(-1, seq_length)
     else:
         position_ids = position_ids.view(-1, seq_length).long()
-        cu_seqlens, max_seqlen = get_cu_seqlens_from_pos_ids(position_ids)
-        cu_seqlens = cu_seqlens.squeeze()
+        cu_seqlens, max_seqlen = get_packed_seqlens(self, position_ids)
 
     if inputs_embeds is None:
         inputs_embeds = self.embed_tokens(input_ids)
@@ -33,7 +33,7 @@ from transformers import AutoConfig, AutoModelForCausalLM
 from transformers.modeling_outputs import BaseModelOutputWithPast
 from transformers.utils import logging
 
-from axolotl.monkeypatch.utils import get_cu_seqlens_from_pos_ids
+from axolotl.monkeypatch.utils import forward_with_packed_seqlens, get_packed_seqlens
 
 logger = logging.get_logger(__name__)
 
@@ -57,6 +57,9 @@ def replace_stablelm_attn_with_flash_attn(model_name="stabilityai/stablelm-3b-4e
     modeling_stablelm.DecoderLayer.forward = (  # pylint: disable=protected-access
         decoder_layer_forward
     )
+    modeling_stablelm.StableLMEpochForCausalLM.forward = forward_with_packed_seqlens(
+        modeling_stablelm.StableLMEpochForCausalLM.forward
+    )
 
 
 def rotate_half(x: torch.Tensor):
@@ -313,8 +316,7 @@ def stablelm_model_forward(
         position_ids = position_ids.unsqueeze(0).view(-1, seq_length)
     else:
         position_ids = position_ids.view(-1, seq_length).long()
-        cu_seqlens, max_seqlen = get_cu_seqlens_from_pos_ids(position_ids)
-        cu_seqlens = cu_seqlens.squeeze()
+        cu_seqlens, max_seqlen = get_packed_seqlens(self, position_ids)
 
     if inputs_embeds is None:
         inputs_embeds = self.embed_tokens(input_ids)
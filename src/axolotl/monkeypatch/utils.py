@@ -1,58 +1,74 @@
 """
 Shared utils for the monkeypatches
 """
+import functools
+import inspect
+
 import torch
 
 
+def _cu_seqlens_from_starts(seq_starts, valid_lengths):
+    """
+    build cu_seqlens and max_seqlen for a batch from a [bsz, seq_len] mask of
+    sequence starts and the per-row count of non-padding tokens. Padding at the
+    end of a row becomes its own trailing segment. This needs a single host sync
+    to size the output.
+    """
+    bsz, seq_len = seq_starts.shape
+    device = seq_starts.device
+    positions = torch.arange(seq_len, device=device)
+
+    # count how many times each offset in [0, seq_len] appears in cu_seqlens
+    counts = torch.zeros((bsz, seq_len + 1), dtype=torch.int32, device=device)
+    counts[:, 1:seq_len] = seq_starts[:, 1:] & (positions[1:] < valid_lengths[:, None])
+    counts[:, 0] += 1
+    counts.scatter_add_(1, valid_lengths[:, None], torch.ones_like(counts[:, :1]))
+    counts[:, seq_len] += valid_lengths < seq_len
+
+    # the j-th offset is the first position whose running count exceeds j
+    running_counts = counts.cumsum(dim=1, dtype=torch.int32)
+    num_offsets = running_counts[:, -1]
+
+    # the only host sync: every row has to yield the same number of offsets
+    max_offsets, min_offsets = torch.stack(
+        [num_offsets.max(), num_offsets.min()]
+    ).tolist()
+    if max_offsets != min_offsets:
+        raise ValueError(
+            "all rows must contain the same number of sequences to stack cu_seqlens"
+        )
+
+    offset_ranks = torch.arange(max_offsets, dtype=torch.int32, device=device)
+    offset_ranks = offset_ranks.repeat(bsz, 1)
+    cu_seqlens = torch.searchsorted(running_counts, offset_ranks, right=True)
+    max_seq_lens = (cu_seqlens[:, 1:] - cu_seqlens[:, :-1]).max(dim=1).values
+
+    return cu_seqlens.to(dtype=torch.int32), max_seq_lens
+
+
 def get_cu_seqlens(attn_mask):
     """generate a cumulative sequence length mask for flash attention using attn mask"""
     if len(attn_mask.shape) == 1:
         attn_mask = attn_mask.unsqueeze(0)
 
-    device = attn_mask.device
-    results = []
-    max_seq_lens = []
-
-    for row in attn_mask:
-        # Exclude zeros to avoid adding their positions to the mask
-        t_non_zeros = row[row != 0]
-        # Find where the sequence number changes (including the first position)
-        seq_change = torch.cat(
-            [
-                torch.tensor([1], dtype=torch.int32, device=device),
-                t_non_zeros[1:] != t_non_zeros[:-1],
-            ]
-        )
-        # Get the indices where the sequence changes
-        change_indices = torch.cat(
-            [
-                (seq_change == 1).nonzero(as_tuple=True)[0],
-                torch.tensor([len(t_non_zeros)], dtype=torch.int32, device=device),
-            ]
-        )
-        # Calculate the sequence lengths
-        seq_lengths = change_indices[1:] - change_indices[:-1]
-        # Calculate the length of the final sequence or padding
-        final_seq_length = len(row) - change_indices[-1]
-        # Append the length of the final sequence or padding to seq_lengths
-        if final_seq_length.item():
-            seq_lengths = torch.cat(
-                [
-                    seq_lengths,
-                    torch.tensor(
-                        [final_seq_length.item()], dtype=torch.int32, device=device
-                    ),
-                ]
-            )
-        # Calculate the cumulative sequence lengths
-        cu_seqlens = torch.cat(
-            [torch.tensor([0], dtype=torch.int32, device=device), seq_lengths.cumsum(0)]
-        )
-        max_seq_len = (cu_seqlens[1:] - cu_seqlens[:-1]).max()
-        results.append(cu_seqlens)
-        max_seq_lens.append(max_seq_len)
+    bsz, seq_len = attn_mask.shape
+    non_zero = attn_mask != 0
+    valid_lengths = non_zero.sum(dim=1)
 
-    return torch.stack(results).to(dtype=torch.int32), torch.stack(max_seq_lens)
+    # move the non-zero entries to the front of each row, zeros are dropped into
+    # a spare trailing column
+    compact_positions = torch.where(
+        non_zero, non_zero.cumsum(dim=1, dtype=torch.int32) - 1, seq_len
+    ).long()
+    compacted = attn_mask.new_zeros((bsz, seq_len + 1))
+    compacted.scatter_(1, compact_positions, attn_mask)
+    compacted = compacted[:, :seq_len]
+
+    # a new sequence starts wherever the sequence number changes
+    seq_starts = torch.ones_like(compacted, dtype=torch.bool)
+    seq_starts[:, 1:] = compacted[:, 1:] != compacted[:, :-1]
+
+    return _cu_seqlens_from_starts(seq_starts, valid_lengths)
 
 
 def get_cu_seqlens_from_pos_ids(position_ids):
@@ -60,47 +76,73 @@ def get_cu_seqlens_from_pos_ids(position_ids):
     if len(position_ids.shape) == 1:
         position_ids = position_ids.unsqueeze(0)
 
-    device = position_ids.device
-    results = []
-    max_seq_lens = []
+    # everything after the last non-zero position id is padding
+    is_zero = position_ids == 0
+    positions = torch.arange(1, position_ids.shape[1] + 1, device=position_ids.device)
+    valid_lengths = torch.where(is_zero, 0, positions).amax(dim=1)
 
-    for row in position_ids:
-        # Count the number of consecutive zeros from the right side
-        padding_length = (row == 0).int().flip(dims=[0]).cumprod(dim=0).sum().item()
+    # a new sequence starts wherever the position resets to 0
+    return _cu_seqlens_from_starts(is_zero, valid_lengths)
 
-        # Adjust the row to exclude padding
-        adjusted_row = row[:-padding_length] if padding_length else row.clone()
 
-        # Find where the position resets to 0 (indicating a new sequence)
-        seq_starts = torch.cat(
-            [
-                torch.tensor([True], dtype=torch.bool, device=device),
-                adjusted_row[1:] == 0,
-            ]
-        )
-        # Get the indices where the sequence starts
-        start_indices = torch.cat(
-            [
-                (seq_starts).nonzero(as_tuple=True)[0],
-                torch.tensor([len(adjusted_row)], dtype=torch.int32, device=device),
-            ]
-        )
-        # Calculate the sequence lengths
-        seq_lengths = start_indices[1:] - start_indices[:-1]
-        # Calculate the cumulative sequence lengths
-        cu_seqlens = torch.cat(
-            [torch.tensor([0], dtype=torch.int32, device=device), seq_lengths.cumsum(0)]
-        )
-        # Append the padding length to the cumulative sequence lengths
-        if padding_length:
-            cu_seqlens = torch.cat(
-                [cu_seqlens, torch.tensor([len(row)], dtype=torch.int32, device=device)]
-            )
-        max_seq_len = (cu_seqlens[1:] - cu_seqlens[:-1]).max()
-        results.append(cu_seqlens)
-        max_seq_lens.append(max_seq_len)
-
-    return torch.stack(results).to(dtype=torch.int32), torch.stack(max_seq_lens)
+def get_packed_seqlens(model, position_ids):
+    """
+    cu_seqlens and max_seqlen for a packed batch, using the ones precomputed by the
+    collator when the causal lm forward handed them over, otherwise derived from the
+    position ids
+    """
+    packed_seqlens = getattr(model, "packed_seqlens", None)
+    if packed_seqlens is not None:
+        cu_seqlens, max_seqlen = packed_seqlens
+    else:
+        cu_seqlens, max_seqlen = get_cu_seqlens_from_pos_ids(position_ids)
+    return cu_seqlens.squeeze(), max_seqlen
+
+
+def forward_with_packed_seqlens(causal_lm_forward):
+    """
+    wrap a *ForCausalLM.forward so it accepts the cu_seqlens and max_seqlen emitted by
+    the collator and exposes them to the inner model for the duration of the call
+    """
+    if getattr(causal_lm_forward, "accepts_packed_seqlens", False):
+        return causal_lm_forward
+
+    @functools.wraps(causal_lm_forward)
+    def forward(self, *args, cu_seqlens=None, max_seqlen=None, **kwargs):
+        if cu_seqlens is None:
+            return causal_lm_forward(self, *args, **kwargs)
+        self.model.packed_seqlens = (cu_seqlens, max_seqlen)
+        try:
+            return causal_lm_forward(self, *args, **kwargs)
+        finally:
+            self.model.packed_seqlens = None
+
+    # keep the original signature visible so the trainer's column filtering still works
+    signature = inspect.signature(causal_lm_forward)
+    parameters = [
+        param
+        for param in signature.parameters.values()
+        if param.kind != inspect.Parameter.VAR_KEYWORD
+    ]
+    parameters += [
+        inspect.Parameter(name, inspect.Parameter.KEYWORD_ONLY, default=None)
+        for name in ("cu_seqlens", "max_seqlen")
+    ]
+    parameters += [
+        param
+        for param in signature.parameters.values()
+        if param.kind == inspect.Parameter.VAR_KEYWORD
+    ]
+    forward.__signature__ = signature.replace(parameters=parameters)
+    forward.accepts_packed_seqlens = True
+    return forward
+
+
+def accepts_packed_seqlens(model):
+    """whether the model forward takes precomputed cu_seqlens and max_seqlen"""
+    if hasattr(model, "get_base_model"):
+        model = model.get_base_model()
+    return "cu_seqlens" in inspect.signature(model.forward).parameters
 
 
 def set_module_name(model, name, value):
@@ -3,11 +3,11 @@ Prompt strategies loader for alpaca instruction datasets with system prompts
 """
 from typing import Generator, Tuple, Union
 
-from axolotl.prompt_tokenizers import PromptTokenizingStrategy
+from axolotl.prompt_tokenizers import InstructionPromptTokenizingStrategy
 from axolotl.prompters import AlpacaPrompter, PromptStyle
 
 
-class InstructionWSystemPromptTokenizingStrategy(PromptTokenizingStrategy):
+class InstructionWSystemPromptTokenizingStrategy(InstructionPromptTokenizingStrategy):
     """
     Tokenizing strategy for instruction-based prompts.
     """
@@ -20,8 +20,7 @@ class InstructionWSystemPromptTokenizingStrategy(PromptTokenizingStrategy):
             prompt["system"],
         )
 
-    def tokenize_prompt(self, prompt):
-        # pylint: disable=duplicate-code
+    def _build_user_prompt_and_response(self, prompt) -> Tuple[str, str]:
         (
             instruction,
             input,  # pylint: disable=redefined-builtin
@@ -37,19 +36,7 @@ class InstructionWSystemPromptTokenizingStrategy(PromptTokenizingStrategy):
                 )
             )
         )
-        tokenized_prompt = self._tokenize(user_prompt, add_eos_token=False)
-        if not self.train_on_inputs:
-            user_prompt_len = len(tokenized_prompt["input_ids"])
-            # TODO this could be sped up using numpy array slicing
-            tokenized_prompt["labels"] = [-100] * user_prompt_len
-        tokenized_res_prompt = self._tokenize(
-            response, strip_bos_token=True, add_eos_token=True
-        )
-        tokenized_prompt["input_ids"] += tokenized_res_prompt["input_ids"]
-        tokenized_prompt["attention_mask"] += tokenized_res_prompt["attention_mask"]
-        tokenized_prompt["labels"] += tokenized_res_prompt["input_ids"]
-
-        return tokenized_prompt
+        return user_prompt, response
 
 
 class SystemDataPrompter(AlpacaPrompter):
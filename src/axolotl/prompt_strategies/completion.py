@@ -58,6 +58,9 @@ class CompletionPromptTokenizingStrategy(InstructionPromptTokenizingStrategy):
 
         return dict(res)
 
+    def tokenize_batch(self, prompts):
+        return self.tokenize_prompt(prompts)
+
     def _build_full_prompt(
         self, instruction, input, response
     ):  # pylint: disable=redefined-builtin
@@ -37,7 +37,8 @@ class PygmalionPromptTokenizingStrategy(PromptTokenizingStrategy):
                 # this should include a bos token, no eos token, strip trailing "\n<START>"
                 if message.endswith("\n<START>"):
                     message = message[:-8]
-                res = self._tokenize(
+                # personas repeat across conversations with the same character
+                res = self._tokenize_cached(
                     prefix + "Persona: " + message.strip(),
                     add_eos_token=False,
                     strip_bos_token=False,
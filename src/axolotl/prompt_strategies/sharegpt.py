@@ -36,6 +36,8 @@ def load(tokenizer, cfg, ds_cfg: Optional[Dict[str, Any]] = None):
     )
     if ds_cfg and "strict" in ds_cfg:
         strategy.strict = ds_cfg["strict"]
+    if ds_cfg and "single_pass" in ds_cfg:
+        strategy.single_pass = ds_cfg["single_pass"]
     return strategy
 
 
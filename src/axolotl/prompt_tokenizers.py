@@ -2,9 +2,13 @@
 
 import abc
 import copy
+import itertools
 import logging
-from typing import Dict, List, Tuple, Union
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, Generator, List, Optional, Tuple, Union
 
+import numpy as np
 from fastchat.conversation import Conversation
 from transformers import BatchEncoding, PreTrainedTokenizer
 
@@ -30,6 +34,51 @@ class InvalidDataException(Exception):
     """
 
 
+def _boundary_key(text: str) -> Tuple[str, str]:
+    """
+    What the tokens across the start of `text` depend on: its leading whitespace,
+    then the next character itself, or its unicode category for letters and digits
+    """
+    rest = text.lstrip()
+    char = rest[:1]
+    return text[: len(text) - len(rest)], (
+        unicodedata.category(char) if char.isalnum() else char
+    )
+
+
+class TokenizationCache:
+    """
+    Bounded LRU of tokenized constant text (roles, system prompts, template
+    fragments and prompt prefixes). Every process fills its own copy: pickling drops the entries, so
+    `datasets.map` workers start empty and the map fingerprint stays stable.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._entries: OrderedDict = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getstate__(self):
+        return {"maxsize": self.maxsize}
+
+    def __setstate__(self, state):
+        self.__init__(state["maxsize"])  # pylint: disable=unnecessary-dunder-call
+
+    def get(self, key) -> Optional[Dict[str, Any]]:
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value: Dict[str, Any]):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+
 class PromptTokenizingStrategy(abc.ABC):
     """
     Abstract class for tokenizing strategies
@@ -49,6 +98,8 @@ class PromptTokenizingStrategy(abc.ABC):
         # TODO: Document how they are different.
         self.sequence_len = sequence_len
         self.max_length = sequence_len
+        self.token_cache = TokenizationCache()
+        self.prefix_cache = TokenizationCache()
 
     @abc.abstractmethod
     def tokenize_prompt(self, prompt):
@@ -58,6 +109,14 @@ class PromptTokenizingStrategy(abc.ABC):
     def supports_batched(self):
         return False
 
+    def tokenize_batch(self, prompts: Dict[str, List]) -> Dict[str, List]:
+        """
+        Tokenize a batch of rows given as a dict of columns, as passed by
+        `Dataset.map(batched=True)`. Strategies whose `tokenize_prompt` already
+        takes a batch don't need to override this.
+        """
+        return self.tokenize_prompt(prompts)
+
     def _tokenize(
         self, prompt: str, add_eos_token: bool = True, strip_bos_token: bool = False
     ) -> BatchEncoding:
@@ -73,9 +132,17 @@ class PromptTokenizingStrategy(abc.ABC):
             padding=False,
             return_tensors=None,
         )
+        return self._finish_tokenized(
+            result, add_eos_token=add_eos_token, strip_bos_token=strip_bos_token
+        )
+
+    def _finish_tokenized(
+        self, result: BatchEncoding, add_eos_token: bool, strip_bos_token: bool
+    ) -> BatchEncoding:
+        """eos/bos handling and labels of `_tokenize` for an already tokenized prompt"""
         if len(result["input_ids"]) == 0:
             LOG.warning("Tokenizer result is empty. You may want to audit your dataset")
-            return empty
+            return BatchEncoding(data={"input_ids": [], "attention_mask": []})
 
         if (
             result["input_ids"][-1] != self.tokenizer.eos_token_id
@@ -92,6 +159,223 @@ class PromptTokenizingStrategy(abc.ABC):
         result["labels"] = result["input_ids"].copy()
         return result
 
+    def _tokenize_cached(
+        self, prompt: str, add_eos_token: bool = True, strip_bos_token: bool = False
+    ) -> BatchEncoding:
+        """
+        `_tokenize` memoized on the exact text, for text that repeats across rows.
+        Cached ids are only ever used for the whole string, never a piece of a
+        longer one, so the result is identical to calling `_tokenize`.
+        """
+        key = (prompt, add_eos_token, strip_bos_token, self.max_length)
+        cached = self.token_cache.get(key)
+        if cached is None:
+            result = self._tokenize(
+                prompt, add_eos_token=add_eos_token, strip_bos_token=strip_bos_token
+            )
+            cached = {k: tuple(v) for k, v in result.items()}
+            self.token_cache.put(key, cached)
+        return BatchEncoding(data={k: list(v) for k, v in cached.items()})
+
+    def _tokenize_prefixed(
+        self,
+        prompt: str,
+        prefix: str,
+        add_eos_token: bool = True,
+        strip_bos_token: bool = False,
+    ) -> BatchEncoding:
+        """
+        `_tokenize` of a prompt that starts with the constant text `prefix`, see
+        `_encode` for when the cached ids of the prefix are used
+        """
+        if not prompt or type(self)._tokenize is not PromptTokenizingStrategy._tokenize:
+            return self._tokenize(
+                prompt, add_eos_token=add_eos_token, strip_bos_token=strip_bos_token
+            )
+        encoded = self._encode([prompt], [prefix])
+        return self._finish_tokenized(
+            BatchEncoding(data={key: values[0] for key, values in encoded.items()}),
+            add_eos_token=add_eos_token,
+            strip_bos_token=strip_bos_token,
+        )
+
+    def _encode(
+        self, texts: List[str], prefixes: Optional[List[str]] = None
+    ) -> Dict[str, List[List[int]]]:
+        """
+        Tokenizer output of non empty `texts`, truncated to `max_length`.
+
+        `prefixes` gives the constant text each row starts with (empty for none).
+        Once a prefix repeats, its ids are cached and spliced onto the ids of the
+        rest of the row, which is tokenized after the last character of the prefix
+        so SentencePiece doesn't add a word boundary there. Tokens can still merge
+        across the boundary, so a prefix is only spliced onto a given leading
+        whitespace and kind of first character (see `_boundary_key`) after a row
+        of that kind tokenized to exactly the same ids both ways; other rows are
+        tokenized whole.
+        """
+        kwargs = {
+            "truncation": True,
+            "max_length": self.max_length,
+            "padding": False,
+            "return_tensors": None,
+        }
+        special = self._special_tokens() if prefixes is not None else {}
+        if prefixes is None or not special:
+            return self.tokenizer(texts, **kwargs)
+        head, tail = list(special["head"]), list(special["tail"])
+        limit = self.max_length - len(head) - len(tail)
+
+        # row -> (prefix entry, boundary key, whether that kind of row was verified)
+        spliced: Dict[int, Tuple[Dict[str, Any], Tuple[str, str], Optional[bool]]] = {}
+        for idx, (text, prefix) in enumerate(zip(texts, prefixes)):
+            if limit <= 0 or len(text) <= len(prefix) or not text.startswith(prefix):
+                continue
+            entry = self._prefix_entry(prefix)
+            if entry is None:
+                continue
+            key = _boundary_key(text[len(prefix) :])
+            verified = entry["splices"].get(key)
+            if verified is not False:
+                spliced[idx] = (entry, key, verified)
+
+        input_ids: List[List[int]] = [[] for _ in texts]
+        if spliced:
+            rests = self.tokenizer(
+                [
+                    prefixes[idx][-1] + texts[idx][len(prefixes[idx]) :]
+                    for idx in spliced
+                ],
+                add_special_tokens=False,
+                **kwargs,
+            )["input_ids"]
+            for idx, ids in zip(list(spliced), rests):
+                entry = spliced[idx][0]
+                anchor = entry["anchor_ids"]
+                if ids[: len(anchor)] != anchor:
+                    # the last character of the prefix merged into the rest
+                    del spliced[idx]
+                    continue
+                input_ids[idx] = (
+                    head + (entry["input_ids"] + ids[len(anchor) :])[:limit] + tail
+                )
+
+        whole = [
+            idx
+            for idx in range(len(texts))
+            if idx not in spliced or spliced[idx][2] is None
+        ]
+        if whole:
+            encoded = self.tokenizer([texts[idx] for idx in whole], **kwargs)
+            for idx, ids in zip(whole, encoded["input_ids"]):
+                if idx in spliced:
+                    entry, key, _ = spliced[idx]
+                    entry["splices"][key] = input_ids[idx] == ids
+                input_ids[idx] = ids
+        return {
+            "input_ids": input_ids,
+            "attention_mask": [[1] * len(ids) for ids in input_ids],
+        }
+
+    def _special_tokens(self) -> Dict[str, Tuple[int, ...]]:
+        """
+        Ids the tokenizer adds before and after a text, empty when its output
+        can't be spliced together (other model inputs, or no way to tell the
+        special tokens apart from the text)
+        """
+        layout = self.prefix_cache.get("special_tokens")
+        if layout is None:
+            layout = {}
+            names = getattr(self.tokenizer, "model_input_names", None)
+            if names and set(names) <= {"input_ids", "attention_mask"}:
+                plain = self.tokenizer("a", add_special_tokens=False)["input_ids"]
+                full = self.tokenizer("a")["input_ids"]
+                for start in range(len(full) - len(plain) + 1):
+                    if plain and full[start : start + len(plain)] == plain:
+                        layout = {
+                            "head": tuple(full[:start]),
+                            "tail": tuple(full[start + len(plain) :]),
+                        }
+                        break
+            self.prefix_cache.put("special_tokens", layout)
+        return layout
+
+    def _prefix_entry(self, prefix: str) -> Optional[Dict[str, Any]]:
+        """
+        Cached ids of a prompt prefix and of its last character, None the first
+        time a prefix is seen, as only prefixes that repeat are worth caching
+        """
+        if not prefix:
+            return None
+        key = ("prefix", prefix)
+        entry = self.prefix_cache.get(key)
+        if entry is None:
+            self.prefix_cache.put(key, {"input_ids": None, "splices": {}})
+            return None
+        if entry["input_ids"] is None:
+            for name, text in (("input_ids", prefix), ("anchor_ids", prefix[-1])):
+                entry[name] = self.tokenizer(text, add_special_tokens=False)[
+                    "input_ids"
+                ]
+        return entry
+
+    def _tokenize_batch(
+        self,
+        prompts: List[str],
+        add_eos_token: bool = True,
+        strip_bos_token: bool = False,
+        prefixes: Optional[List[str]] = None,
+    ) -> Dict[str, List[List[int]]]:
+        """
+        Same rules as `_tokenize`, applied to a list of texts with a single
+        tokenizer call. Rows that `_tokenize` would return empty are left empty.
+        No labels are added, callers build those for the whole batch. `prefixes`
+        are the constant text the rows start with, as for `_tokenize_prefixed`.
+        """
+        non_empty = [idx for idx, prompt in enumerate(prompts) if prompt]
+        if len(non_empty) < len(prompts):
+            LOG.warning("Empty text requested for tokenization.")
+
+        keys = ["input_ids", "attention_mask"]
+        encoded: Dict[str, List[List[int]]] = {}
+        if non_empty:
+            encoded = self._encode(
+                [prompts[idx] for idx in non_empty],
+                [prefixes[idx] for idx in non_empty] if prefixes else None,
+            )
+            keys += [key for key in encoded.keys() if key not in keys]
+        result: Dict[str, List[List[int]]] = {
+            key: [[] for _ in prompts] for key in keys
+        }
+
+        eos_token_id = self.tokenizer.eos_token_id
+        bos_token_id = self.tokenizer.bos_token_id
+        for pos, idx in enumerate(non_empty):
+            input_ids = encoded["input_ids"][pos]
+            if not input_ids:
+                LOG.warning(
+                    "Tokenizer result is empty. You may want to audit your dataset"
+                )
+                continue
+            attention_mask = encoded["attention_mask"][pos]
+            if (
+                add_eos_token
+                and input_ids[-1] != eos_token_id
+                and len(input_ids) < self.max_length
+            ):
+                input_ids = input_ids + [eos_token_id]
+                attention_mask = attention_mask + [1]
+            if strip_bos_token and input_ids[0] == bos_token_id:
+                input_ids = input_ids[1:]
+                attention_mask = attention_mask[1:]
+
+            for key in keys[2:]:
+                result[key][idx] = encoded[key][pos]
+            result["input_ids"][idx] = input_ids
+            result["attention_mask"][idx] = attention_mask
+
+        return result
+
 
 class InstructionPromptTokenizingStrategy(PromptTokenizingStrategy):
     """
@@ -103,7 +387,16 @@ class InstructionPromptTokenizingStrategy(PromptTokenizingStrategy):
     ) -> Union[Tuple[str, str, str], Tuple[str, str, str, str]]:
         raise NotImplementedError
 
-    def tokenize_prompt(self, prompt):
+    @property
+    def supports_batched(self):
+        # strategies that customize the per-row tokenization keep the per-row path
+        return (
+            type(self).tokenize_prompt
+            is InstructionPromptTokenizingStrategy.tokenize_prompt
+            and type(self)._tokenize is PromptTokenizingStrategy._tokenize
+        )
+
+    def _build_user_prompt_and_response(self, prompt) -> Tuple[str, str]:
         (
             instruction,
             input,  # pylint: disable=redefined-builtin
@@ -117,7 +410,21 @@ class InstructionPromptTokenizingStrategy(PromptTokenizingStrategy):
                 )
             )
         )
-        tokenized_prompt = self._tokenize(user_prompt, add_eos_token=False)
+        return user_prompt, response
+
+    def _user_prompt_prefix(self, prompt, user_prompt: str) -> str:
+        """the prompt template text before the instruction, the same for most rows"""
+        instruction = self.parse_instruction_fields(prompt)[0]
+        start = user_prompt.find(instruction) if instruction else -1
+        return user_prompt[:start] if start > 0 else ""
+
+    def tokenize_prompt(self, prompt):
+        user_prompt, response = self._build_user_prompt_and_response(prompt)
+        tokenized_prompt = self._tokenize_prefixed(
+            user_prompt,
+            self._user_prompt_prefix(prompt, user_prompt),
+            add_eos_token=False,
+        )
         if not self.train_on_inputs:
             user_prompt_len = len(tokenized_prompt["input_ids"])
             # TODO this could be sped up using numpy array slicing
@@ -131,6 +438,41 @@ class InstructionPromptTokenizingStrategy(PromptTokenizingStrategy):
 
         return tokenized_prompt
 
+    def tokenize_batch(self, prompts: Dict[str, List]) -> Dict[str, List]:
+        feature_names = list(prompts.keys())
+        user_prompts, prefixes, responses = [], [], []
+        for row in zip(*prompts.values()):
+            prompt = dict(zip(feature_names, row))
+            user_prompt, response = self._build_user_prompt_and_response(prompt)
+            user_prompts.append(user_prompt)
+            prefixes.append(self._user_prompt_prefix(prompt, user_prompt))
+            responses.append(response)
+
+        tokenized_prompts = self._tokenize_batch(
+            user_prompts, add_eos_token=False, prefixes=prefixes
+        )
+        tokenized_responses = self._tokenize_batch(
+            responses, strip_bos_token=True, add_eos_token=True
+        )
+
+        prompt_ids = tokenized_prompts.pop("input_ids")
+        prompt_mask = tokenized_prompts.pop("attention_mask")
+        response_ids = tokenized_responses["input_ids"]
+        response_mask = tokenized_responses["attention_mask"]
+        if self.train_on_inputs:
+            labels = [p + r for p, r in zip(prompt_ids, response_ids)]
+        else:
+            labels = [
+                [IGNORE_INDEX] * len(p) + r for p, r in zip(prompt_ids, response_ids)
+            ]
+        return {
+            "input_ids": [p + r for p, r in zip(prompt_ids, response_ids)],
+            "attention_mask": [p + r for p, r in zip(prompt_mask, response_mask)],
+            "labels": labels,
+            # any extra tokenizer outputs only cover the prompt, as in tokenize_prompt
+            **tokenized_prompts,
+        }
+
     def _build_full_prompt(
         self, instruction, input, response  # pylint: disable=redefined-builtin
     ):
@@ -330,12 +672,18 @@ class ShareGPTPromptTokenizingStrategy(PromptTokenizingStrategy):
     Tokenizing strategy for ShareGPT prompts.
     """
 
+    # tokenize all the turns of a conversation with a single batched tokenizer call,
+    # and assemble the tokens and labels of the conversation in one go
+    single_pass: bool = False
+
     def get_conversation_thread(self, prompt):
         return prompt["conversations"]
 
-    def tokenize_prompt(self, prompt):
-        # Initial values. We will append to these as we go through the conversation.
-        result, current_len = tokenize_prompt_default()
+    def _iter_turns(self, prompt) -> Generator[Tuple[str, str, str], None, None]:
+        """
+        Yields (kind, role, content) for every turn, kind being one of
+        "system", "user" or "assistant"
+        """
         conversation: Conversation = (
             self.prompter._conversation.copy()  # pylint: disable=protected-access
         )
@@ -352,71 +700,62 @@ class ShareGPTPromptTokenizingStrategy(PromptTokenizingStrategy):
                 {"from": conversation.roles[1], "to": prompt["roles"][1]},
             ]
 
-        try:
-            for _, part in enumerate(
-                self.prompter.build_prompt(self.get_conversation_thread(prompt))
-            ):
-                if not isinstance(part, tuple):
-                    LOG.warning(f"expected tuple, got {part}")
-                    continue
-
-                user, assistant = conversation.roles
-                role, content = part
+        for _, part in enumerate(
+            self.prompter.build_prompt(self.get_conversation_thread(prompt))
+        ):
+            if not isinstance(part, tuple):
+                LOG.warning(f"expected tuple, got {part}")
+                continue
+
+            user, assistant = conversation.roles
+            role, content = part
+
+            # Uses "in" because role contains extra characters
+            if user in role:
+                role = (
+                    role.replace(role_remap[0]["from"], role_remap[0]["to"])
+                    if role_remap
+                    else role
+                )
+                # this is still the user query, we should
+                if not content.strip():
+                    LOG.warning(f"user turn has empty text: {prompt}")
+                yield "user", role, content
+            elif assistant in role:
+                role = (
+                    role.replace(role_remap[1]["from"], role_remap[1]["to"])
+                    if role_remap
+                    else role
+                )
+                # this should be the assistant response, should end with an eos token
+                if not content.strip():
+                    LOG.warning(f"assistant turn has empty text: {prompt}")
+                yield "assistant", role, content
+            elif role == "":
+                # this is only ever the first part, should include the bos token and the user query
+                yield "system", role, content
+            else:
+                LOG.warning(f"unhandled role: {role}")
 
-                # Uses "in" because role contains extra characters
-                if user in role:
-                    role = (
-                        role.replace(role_remap[0]["from"], role_remap[0]["to"])
-                        if role_remap
-                        else role
-                    )
-                    turn = role + content
-                    # this is still the user query, we should
-                    if not content.strip():
-                        LOG.warning(f"user turn has empty text: {prompt}")
-                    res = self._tokenize(
-                        turn,
-                        add_eos_token=False,
-                        strip_bos_token=True,
-                    )
-                    # everything from this is masked out from the labels
-                    labels = [IGNORE_TOKEN_ID] * len(res["input_ids"])
-                elif assistant in role:
+    def tokenize_prompt(self, prompt):
+        try:
+            turns = list(self._iter_turns(prompt))
+            if self.single_pass:
+                return self._assemble_turns(turns, self._tokenize_turns_batched(turns))
+            encoded = self._tokenize_turns(turns)
+
+            # Initial values. We will append to these as we go through the conversation.
+            result, current_len = tokenize_prompt_default()
+            for (kind, _, _), (res, role_res) in zip(turns, encoded):
+                if kind == "assistant":
                     # TODO label assistant token/tokens w/ IGNORE_TOKEN_ID
-                    role = (
-                        role.replace(role_remap[1]["from"], role_remap[1]["to"])
-                        if role_remap
-                        else role
-                    )
-                    turn = role + content
-                    # this should be the assistant response, should end with an eos token
-                    if not content.strip():
-                        LOG.warning(f"assistant turn has empty text: {prompt}")
-                    res = self._tokenize(
-                        turn,
-                        add_eos_token=True,
-                        strip_bos_token=True,
-                    )
-                    role_res = self._tokenize(
-                        role.rstrip(),
-                        add_eos_token=False,
-                        strip_bos_token=True,
-                    )
                     # not masked out from labels
                     labels = copy.deepcopy(res["input_ids"])
                     len_role = len(role_res["input_ids"])
                     labels[:len_role] = [IGNORE_TOKEN_ID] * min(len_role, len(labels))
-                elif role == "":
-                    turn = content
-                    # this is only ever the first part, should include the bos token and the user query
-                    res = self._tokenize(
-                        turn, add_eos_token=False, strip_bos_token=False
-                    )
-                    # everything from this is masked out from the labels
-                    labels = [IGNORE_TOKEN_ID] * len(res["input_ids"])
                 else:
-                    LOG.warning(f"unhandled role: {role}")
-                    continue
+                    # everything from the user turns and the system prompt is masked out
+                    labels = [IGNORE_TOKEN_ID] * len(res["input_ids"])
 
                 # pylint: disable=duplicate-code
                 result, current_len = parse_tokenized_to_result(
@@ -430,6 +769,145 @@ class ShareGPTPromptTokenizingStrategy(PromptTokenizingStrategy):
         except (KeyError, AssertionError, IndexError) as err:
             raise InvalidDataException(str(err)) from err
 
+    def _assemble_turns(
+        self,
+        turns: List[Tuple[str, str, str]],
+        encoded: List[Tuple[BatchEncoding, Optional[BatchEncoding]]],
+    ) -> Dict[str, List[int]]:
+        """
+        Concatenates the tokenized turns into flat arrays, the labels being the tokens
+        of the assistant turns after their role, found from the turn offsets
+        """
+        turn_ids = [res["input_ids"] for res, _ in encoded]
+        lengths = np.fromiter(map(len, turn_ids), dtype=np.int64, count=len(turn_ids))
+        num_tokens = int(lengths.sum())
+        input_ids = np.fromiter(
+            itertools.chain.from_iterable(turn_ids), dtype=np.int64, count=num_tokens
+        )
+        # position of the first trained on token of every turn, past its end for the
+        # turns that are masked out entirely
+        label_starts = np.array(
+            [
+                min(len(role_res["input_ids"]), length)
+                if kind == "assistant"
+                else length
+                for (kind, _, _), (_, role_res), length in zip(turns, encoded, lengths)
+            ],
+            dtype=np.int64,
+        )
+        turn_starts = np.cumsum(lengths) - lengths
+        positions = np.arange(num_tokens, dtype=np.int64) - np.repeat(
+            turn_starts, lengths
+        )
+        labels = np.where(
+            positions >= np.repeat(label_starts, lengths), input_ids, IGNORE_TOKEN_ID
+        )
+        pad_token_id = self.tokenizer.pad_token_id
+        attention_mask = (
+            input_ids != pad_token_id
+            if pad_token_id is not None
+            else np.ones_like(input_ids, dtype=np.bool_)
+        )
+        return {
+            "input_ids": input_ids.tolist(),
+            "attention_mask": attention_mask.astype(np.int64).tolist(),
+            "labels": labels.tolist(),
+        }
+
+    def _tokenize_turns(
+        self, turns: List[Tuple[str, str, str]]
+    ) -> List[Tuple[BatchEncoding, Optional[BatchEncoding]]]:
+        """
+        Tokenizes every turn on its own, along with the role of the assistant turns
+        """
+        encoded = []
+        for kind, role, content in turns:
+            turn = role + content
+            role_res = None
+            if kind == "user":
+                res = self._tokenize_prefixed(
+                    turn,
+                    role,
+                    add_eos_token=False,
+                    strip_bos_token=True,
+                )
+            elif kind == "assistant":
+                res = self._tokenize_prefixed(
+                    turn,
+                    role,
+                    add_eos_token=True,
+                    strip_bos_token=True,
+                )
+                role_res = self._tokenize_cached(
+                    role.rstrip(),
+                    add_eos_token=False,
+                    strip_bos_token=True,
+                )
+            else:
+                # it's the system prompt (or a fixed opener), the same for most rows
+                res = self._tokenize_cached(
+                    turn, add_eos_token=False, strip_bos_token=False
+                )
+            encoded.append((res, role_res))
+        return encoded
+
+    def _tokenize_turns_batched(
+        self, turns: List[Tuple[str, str, str]]
+    ) -> List[Tuple[BatchEncoding, Optional[BatchEncoding]]]:
+        """
+        Same as `_tokenize_turns`, with every turn and assistant role of the
+        conversation tokenized in a single batched tokenizer call. Turns are still
+        tokenized separately, so special tokens, word boundaries and truncation match
+        the per-turn path exactly.
+        """
+        # (text, prefix, add_eos_token, strip_bos_token) of every turn, then of
+        # every role
+        requests = [
+            (
+                role + content,
+                role if kind != "system" else "",
+                kind == "assistant",
+                kind != "system",
+            )
+            for kind, role, content in turns
+        ]
+        requests += [
+            (role.rstrip(), "", False, True)
+            for kind, role, _ in turns
+            if kind == "assistant"
+        ]
+        texts = [text for text, _, _, _ in requests if text]
+        batch = (
+            self._encode(texts, [prefix for text, prefix, _, _ in requests if text])
+            if texts
+            else {}
+        )
+
+        results = []
+        idx = 0
+        for text, _, add_eos_token, strip_bos_token in requests:
+            if not text:
+                LOG.warning("Empty text requested for tokenization.")
+                results.append(
+                    BatchEncoding(data={"input_ids": [], "attention_mask": []})
+                )
+                continue
+            res = BatchEncoding(
+                data={key: values[idx] for key, values in batch.items()}
+            )
+            results.append(
+                self._finish_tokenized(
+                    res, add_eos_token=add_eos_token, strip_bos_token=strip_bos_token
+                )
+            )
+            idx += 1
+
+        roles = iter(results[len(turns) :])
+        return [
+            (res, next(roles) if kind == "assistant" else None)
+            for (kind, _, _), res in zip(turns, results)
+        ]
+
 
 def tokenize_prompt_default() -> Tuple[Dict[str, List[int]], int]:
     """
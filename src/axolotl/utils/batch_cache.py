@@ -0,0 +1,175 @@
+"""
+Cache of collated batches that are replayed as is, for evaluation sets whose packing
+and collation don't change between evaluation rounds
+"""
+import json
+import logging
+import shutil
+import uuid
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Union
+
+import numpy as np
+import torch
+
+LOG = logging.getLogger("axolotl")
+
+NARROW_DTYPES = (np.int8, np.int16, np.int32)
+
+
+def _narrowest_dtype(min_value: int, max_value: int, dtype: np.dtype) -> np.dtype:
+    for narrow in NARROW_DTYPES:
+        info = np.iinfo(narrow)
+        if info.min <= min_value and max_value <= info.max:
+            return np.dtype(narrow) if narrow().itemsize < dtype.itemsize else dtype
+    return dtype
+
+
+class BatchCache:
+    """
+    Collated batches of tensors kept as one flat buffer per feature, stored in the
+    narrowest integer dtype that holds its values, along with the shape of every
+    batch. The buffers live in memory or are memory-mapped from `.npy` files, and
+    are cast back to the original dtypes as batches are replayed. With `pin_memory`,
+    in-memory batches are cast and pinned once up front instead.
+    """
+
+    def __init__(
+        self,
+        buffers: Dict[str, np.ndarray],
+        shapes: Dict[str, np.ndarray],
+        dtypes: Dict[str, str],
+        key: Optional[str] = None,
+        dataset: Any = None,
+        pin_memory: bool = False,
+    ):
+        self.buffers = buffers
+        self.shapes = shapes
+        self.dtypes = dtypes
+        self.offsets = {}
+        for feature, feature_shapes in shapes.items():
+            offsets = np.zeros((len(feature_shapes) + 1,), dtype=np.int64)
+            np.cumsum(np.prod(feature_shapes, axis=1), out=offsets[1:])
+            self.offsets[feature] = offsets
+        self.key = key
+        # the trainer counts evaluated samples from the loader's dataset
+        self.dataset = dataset
+        self.pin_memory = pin_memory
+        self.pinned: Optional[List[Dict[str, torch.Tensor]]] = None
+        if pin_memory and not any(
+            isinstance(buffer, np.memmap) for buffer in buffers.values()
+        ):
+            self.pinned = [
+                {
+                    feature: tensor.pin_memory()
+                    for feature, tensor in self._read(idx).items()
+                }
+                for idx in range(len(self))
+            ]
+
+    @classmethod
+    def exists(cls, path: Union[str, Path]) -> bool:
+        return (Path(path) / "meta.json").exists()
+
+    @classmethod
+    def build(
+        cls,
+        batches: Iterable[Dict[str, torch.Tensor]],
+        path: Optional[Union[str, Path]] = None,
+        **kwargs,
+    ) -> "BatchCache":
+        """
+        Collect `batches` into a cache, saved to and memory-mapped from `path` if set
+        """
+        values: Dict[str, list] = {}
+        shapes: Dict[str, list] = {}
+        num_batches = 0
+        for batch in batches:
+            if num_batches and set(batch) != set(values):
+                raise ValueError("batches with different features can't be cached")
+            for feature, tensor in batch.items():
+                array = tensor.detach().cpu().numpy()
+                values.setdefault(feature, []).append(array.reshape(-1))
+                shapes.setdefault(feature, []).append(array.shape)
+            num_batches += 1
+
+        buffers, dtypes = {}, {}
+        for feature, arrays in values.items():
+            flat = np.concatenate(arrays)
+            dtypes[feature] = flat.dtype.name
+            if np.issubdtype(flat.dtype, np.integer) and len(flat):
+                flat = flat.astype(
+                    _narrowest_dtype(int(flat.min()), int(flat.max()), flat.dtype),
+                    copy=False,
+                )
+            buffers[feature] = flat
+        batch_shapes = {
+            feature: np.asarray(feature_shapes, dtype=np.int64).reshape(
+                num_batches, len(feature_shapes[0])
+            )
+            for feature, feature_shapes in shapes.items()
+        }
+        LOG.info(
+            f"cached {num_batches} batches in "
+            f"{sum(buffer.nbytes for buffer in buffers.values()) / 2**20:.1f}MB"
+        )
+        if path is None:
+            return cls(buffers, batch_shapes, dtypes, **kwargs)
+        cls._save(Path(path), buffers, batch_shapes, dtypes)
+        return cls.load(path, **kwargs)
+
+    @staticmethod
+    def _save(path: Path, buffers, shapes, dtypes):
+        tmp_path = path.with_name(f"{path.name}.tmp-{uuid.uuid4().hex}")
+        tmp_path.mkdir(parents=True)
+        try:
+            for idx, feature in enumerate(buffers):
+                np.save(tmp_path / f"{idx}.npy", buffers[feature])
+                np.save(tmp_path / f"{idx}.shapes.npy", shapes[feature])
+            with open(tmp_path / "meta.json", "w", encoding="utf-8") as fout:
+                json.dump({"features": list(buffers), "dtypes": dtypes}, fout)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        try:
+            tmp_path.rename(path)
+        except OSError:
+            # another rank published the same cache first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path: Union[str, Path], **kwargs) -> "BatchCache":
+        path = Path(path)
+        with open(path / "meta.json", encoding="utf-8") as fin:
+            meta = json.load(fin)
+        buffers, shapes = {}, {}
+        for idx, feature in enumerate(meta["features"]):
+            buffers[feature] = np.load(path / f"{idx}.npy", mmap_mode="r")
+            shapes[feature] = np.load(path / f"{idx}.shapes.npy")
+        return cls(buffers, shapes, meta["dtypes"], **kwargs)
+
+    def __len__(self) -> int:
+        return len(next(iter(self.shapes.values()), ()))
+
+    def _read(self, idx: int) -> Dict[str, torch.Tensor]:
+        batch = {}
+        for feature, buffer in self.buffers.items():
+            offsets = self.offsets[feature]
+            values = buffer[offsets[idx] : offsets[idx + 1]]
+            batch[feature] = torch.from_numpy(
+                values.astype(self.dtypes[feature]).reshape(self.shapes[feature][idx])
+            )
+        return batch
+
+    def __getitem__(self, idx: int) -> Dict[str, torch.Tensor]:
+        if self.pinned is not None:
+            return dict(self.pinned[idx])
+        batch = self._read(idx)
+        if self.pin_memory:
+            # memory-mapped batches are read into new tensors at every replay
+            batch = {feature: tensor.pin_memory() for feature, tensor in batch.items()}
+        return batch
+
+    def __iter__(self) -> Iterator[Dict[str, torch.Tensor]]:
+        for idx in range(len(self)):
+            yield self[idx]
@@ -2,12 +2,16 @@
 DataCollator for axolotl to pad labels and position_ids for packed sequences
 """
 from dataclasses import dataclass
-from typing import Any, Optional, Union
+from typing import Any, Dict, List, Optional, Union
 
 import numpy as np
-from transformers import PreTrainedTokenizerBase
+import pyarrow as pa
+import torch
+from transformers import BatchEncoding, PreTrainedTokenizerBase
 from transformers.utils import PaddingStrategy
 
+from axolotl.monkeypatch.utils import get_cu_seqlens_from_pos_ids
+
 
 @dataclass
 class DataCollatorForSeq2Seq:
@@ -42,6 +46,12 @@ class DataCollatorForSeq2Seq:
             The id to use when padding the labels (-100 will be automatically ignored by PyTorch loss functions).
         return_tensors (`str`):
             The type of Tensor to return. Allowable values are "np", "pt" and "tf".
+        return_cu_seqlens (`bool`, *optional*, defaults to `False`):
+            Whether to add `cu_seqlens` and `max_seqlen` for packed sequences, derived from the padded
+            `position_ids`, so the flash attention forward doesn't have to rebuild them on the GPU. Only used with
+            `return_tensors="pt"`.
+        pin_memory (`bool`, *optional*, defaults to `False`):
+            Whether the tensors built by the NumPy/Arrow fast path are allocated in pinned memory.
     """
 
     tokenizer: PreTrainedTokenizerBase
@@ -52,12 +62,45 @@ class DataCollatorForSeq2Seq:
     label_pad_token_id: int = -100
     position_pad_token_id: int = 0
     return_tensors: str = "pt"
+    return_cu_seqlens: bool = False
+    pin_memory: bool = False
 
     def __call__(self, features, return_tensors=None):
-        labels = None
         if return_tensors is None:
             return_tensors = self.return_tensors
 
+        if self._use_array_fast_path(features, return_tensors):
+            features = self._pad_arrays(features)
+            labels = features.get("labels")
+        else:
+            features, labels = self._pad_features(features, return_tensors)
+
+        if (
+            self.return_cu_seqlens
+            and return_tensors == "pt"
+            and "position_ids" in features
+        ):
+            cu_seqlens, max_seqlen = get_cu_seqlens_from_pos_ids(
+                features["position_ids"]
+            )
+            features["cu_seqlens"] = cu_seqlens
+            features["max_seqlen"] = max_seqlen
+
+        # prepare decoder_input_ids
+        if (
+            labels is not None
+            and self.model is not None
+            and hasattr(self.model, "prepare_decoder_input_ids_from_labels")
+        ):
+            decoder_input_ids = self.model.prepare_decoder_input_ids_from_labels(
+                labels=features["labels"]
+            )
+            features["decoder_input_ids"] = decoder_input_ids
+
+        return features
+
+    def _pad_features(self, features, return_tensors):
+        labels = None
         for feature_name, pad_token_id in [
             ("labels", self.label_pad_token_id),
             ("position_ids", self.position_pad_token_id),
@@ -107,15 +150,95 @@ class DataCollatorForSeq2Seq:
             return_tensors=return_tensors,
         )
 
-        # prepare decoder_input_ids
+        return features, labels
+
+    def _array_pad_values(self) -> Dict[str, int]:
+        """padding value for every field the array fast path knows how to pad"""
+        return {
+            "input_ids": self.tokenizer.pad_token_id,
+            "attention_mask": 0,
+            "token_type_ids": self.tokenizer.pad_token_type_id,
+            "special_tokens_mask": 1,
+            "labels": self.label_pad_token_id,
+            "position_ids": self.position_pad_token_id,
+        }
+
+    def _use_array_fast_path(self, features, return_tensors) -> bool:
+        """
+        features made of NumPy or Arrow arrays, padded to the longest sequence, can skip
+        the per-feature python lists and `tokenizer.pad`
+        """
         if (
-            labels is not None
-            and self.model is not None
-            and hasattr(self.model, "prepare_decoder_input_ids_from_labels")
+            return_tensors != "pt"
+            or self.padding not in (True, "longest", PaddingStrategy.LONGEST)
+            or self.tokenizer.pad_token_id is None
+            or self.tokenizer.model_input_names[0] != "input_ids"
+            or "attention_mask" not in self.tokenizer.model_input_names
         ):
-            decoder_input_ids = self.model.prepare_decoder_input_ids_from_labels(
-                labels=features["labels"]
+            return False
+        pad_values = self._array_pad_values()
+        keys = features[0].keys()
+        for feature in features:
+            if "input_ids" not in feature or feature.keys() != keys:
+                return False
+            for key, value in feature.items():
+                if key not in pad_values or not isinstance(
+                    value, (np.ndarray, pa.Array, pa.ChunkedArray)
+                ):
+                    return False
+        return True
+
+    def _padded_length(self, values: List[np.ndarray]) -> int:
+        max_length = max(len(value) for value in values)
+        if self.pad_to_multiple_of is not None:
+            max_length = (
+                (max_length + self.pad_to_multiple_of - 1)
+                // self.pad_to_multiple_of
+                * self.pad_to_multiple_of
             )
-            features["decoder_input_ids"] = decoder_input_ids
+        return max_length
 
-        return features
+    def _pad_arrays(self, features) -> BatchEncoding:
+        """
+        pad every field into one preallocated int64 buffer for the whole batch, filled
+        with slice assignment instead of per-feature python lists
+        """
+        columns = {
+            key: [
+                value.to_numpy(zero_copy_only=False)
+                if isinstance(value, (pa.Array, pa.ChunkedArray))
+                else value
+                for value in (feature[key] for feature in features)
+            ]
+            for key in features[0].keys()
+        }
+        if "attention_mask" not in columns:
+            columns["attention_mask"] = [
+                np.ones(len(value), dtype=np.int64) for value in columns["input_ids"]
+            ]
+
+        # the tokenizer fields share the padded length of input_ids
+        tokenizer_length = self._padded_length(columns["input_ids"])
+        pad_values = self._array_pad_values()
+        padding_side = self.tokenizer.padding_side
+        batch = {}
+        for key, values in columns.items():
+            if key in ("labels", "position_ids"):
+                max_length = self._padded_length(values)
+            else:
+                max_length = tokenizer_length
+            buffer = torch.full(
+                (len(values), max_length),
+                pad_values[key],
+                dtype=torch.int64,
+                pin_memory=self.pin_memory,
+            )
+            rows = buffer.numpy()
+            for row, value in zip(rows, values):
+                if padding_side == "right":
+                    row[: len(value)] = value
+                else:
+                    row[max_length - len(value) :] = value
+            batch[key] = buffer
+
+        return BatchEncoding(batch)
@@ -225,6 +225,56 @@ def validate_config(cfg):
             "`trust_remote_code` is set to true. Please make sure that you reviewed the remote code/model."
         )
 
+    if cfg.distributed_dataset_preparation and not cfg.dataset_prepared_path:
+        raise ValueError(
+            "distributed_dataset_preparation requires dataset_prepared_path on a filesystem shared by all nodes"
+        )
+
+    if cfg.sample_packing_exact_length and not cfg.sample_packing:
+        raise ValueError("sample_packing_exact_length requires sample_packing")
+
+    if cfg.eval_batch_cache not in (None, False, True, "memory", "disk"):
+        raise ValueError(
+            f"unknown eval_batch_cache {cfg.eval_batch_cache}, use memory or disk"
+        )
+    if cfg.eval_batch_cache and (
+        not cfg.sample_packing or cfg.eval_sample_packing is False
+    ):
+        raise ValueError(
+            "eval_batch_cache only caches packed eval batches, it requires sample_packing and eval_sample_packing"
+        )
+
+    if cfg.batch_max_tokens:
+        if cfg.sample_packing:
+            raise ValueError("batch_max_tokens can't be used with sample_packing")
+        if cfg.sequence_len and cfg.batch_max_tokens < cfg.sequence_len:
+            raise ValueError("batch_max_tokens must be at least sequence_len")
+
+    if cfg.sample_packing_packer == "balanced" and not cfg.sample_packing_exact_length:
+        # otherwise every rank packs its own share and there's nothing to balance
+        raise ValueError(
+            "sample_packing_packer: balanced requires sample_packing_exact_length"
+        )
+
+    if cfg.sample_packing_cost is not None and len(cfg.sample_packing_cost) != 2:
+        raise ValueError("sample_packing_cost must be a list of two numbers [a, b]")
+
+    if cfg.dataset_shuffle_mode not in (None, "random", "flatten", "block"):
+        raise ValueError(
+            f"unknown dataset_shuffle_mode {cfg.dataset_shuffle_mode}, use random, flatten or block"
+        )
+
+    if cfg.dataset_prepared_format not in (None, "arrow", "token_store"):
+        raise ValueError(
+            f"unknown dataset_prepared_format {cfg.dataset_prepared_format}, use arrow or token_store"
+        )
+    if cfg.dataset_prepared_format == "token_store" and (
+        not cfg.sample_packing or cfg.max_packed_sequence_len
+    ):
+        raise ValueError(
+            "dataset_prepared_format: token_store requires sample_packing and can't be used with max_packed_sequence_len"
+        )
+
     if cfg.push_dataset_to_hub and cfg.hf_use_auth_token is not True:
         raise ValueError(
             "Require cfg.hf_use_auth_token to be True for push_dataset_to_hub"
@@ -1,11 +1,23 @@
 """Module containing data utilities"""
+import copy
 import functools
 import hashlib
+import itertools
+import json
 import logging
+import math
+import os
+import shutil
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Any, Dict, List, Tuple, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
-import torch
+import numpy as np
 from datasets import (
     Dataset,
     DatasetDict,
@@ -13,11 +25,18 @@ from datasets import (
     load_dataset,
     load_from_disk,
 )
-from huggingface_hub import hf_hub_download
+from huggingface_hub import HfApi, hf_hub_download
+from huggingface_hub import constants as hub_constants
+from huggingface_hub.file_download import repo_folder_name
 from transformers import PreTrainedTokenizerBase
 
 from axolotl.common.const import DEFAULT_DATASET_PREPARED_PATH
-from axolotl.datasets import ConstantLengthDataset, TokenizedPromptDataset
+from axolotl.datasets import (
+    StreamingMultipackDataset,
+    TokenizedPromptDataset,
+    constant_length_features,
+    pack_constant_length_shards,
+)
 from axolotl.prompt_strategies import load
 from axolotl.prompt_tokenizers import (
     AlpacaMultipleChoicePromptTokenizingStrategy,
@@ -39,7 +58,14 @@ from axolotl.prompters import (
     UnsupportedPrompter,
 )
 from axolotl.utils.dict import DictDefault
-from axolotl.utils.distributed import is_main_process, zero_first
+from axolotl.utils.distributed import (
+    broadcast_dict,
+    get_rank,
+    get_world_size,
+    is_main_process,
+    zero_first,
+)
+from axolotl.utils.token_store import TokenStore
 from axolotl.utils.trainer import (
     calculate_total_num_steps,
     process_datasets_for_packing,
@@ -47,6 +73,11 @@ from axolotl.utils.trainer import (
 
 LOG = logging.getLogger("axolotl")
 
+# rows worth handing to each extra tokenization process
+ROWS_PER_PREPROCESS_PROCESS = 5_000
+# seconds to wait on the shards of other ranks, the default process group timeout
+PREPARED_SHARD_TIMEOUT = 1800
+
 
 def md5(to_hash: str, encoding: str = "utf-8") -> str:
     try:
@@ -58,6 +89,11 @@ def md5(to_hash: str, encoding: str = "utf-8") -> str:
 def prepare_dataset(cfg, tokenizer):
     prompters = []
     if not cfg.pretraining_dataset:
+        # resolved outside zero_first, the broadcast needs every rank at once
+        cfg.dataset_source_fingerprints = resolve_dataset_sources(cfg)
+        if cfg.distributed_dataset_preparation:
+            # every rank tokenizes its share first, rank 0 then only merges
+            prepare_dataset_shards(tokenizer, cfg, DEFAULT_DATASET_PREPARED_PATH)
         with zero_first(is_main_process()):
             train_dataset, eval_dataset, prompters = load_prepare_datasets(
                 tokenizer, cfg, DEFAULT_DATASET_PREPARED_PATH
@@ -68,9 +104,13 @@ def prepare_dataset(cfg, tokenizer):
             tokenizer,
             max_tokens=cfg.sequence_len,
             seed=cfg.seed or 42,
+            sample_packing=cfg.sample_packing,
+            packing_buffer_size=cfg.pretraining_packing_buffer_size or 64,
+            micro_batch_size=cfg.micro_batch_size or 1,
         )
-        # https://discuss.huggingface.co/t/how-to-use-huggingface-trainer-streaming-datasets-without-wrapping-it-with-torchdatas-iterablewrapper/25230
-        train_dataset = train_dataset.with_format("torch")
+        if not cfg.sample_packing:
+            # https://discuss.huggingface.co/t/how-to-use-huggingface-trainer-streaming-datasets-without-wrapping-it-with-torchdatas-iterablewrapper/25230
+            train_dataset = train_dataset.with_format("torch")
         eval_dataset = None
         return train_dataset, eval_dataset, cfg.max_steps, prompters
 
@@ -88,28 +128,230 @@ def prepare_dataset(cfg, tokenizer):
     return train_dataset, eval_dataset, total_num_steps, prompters
 
 
-def load_tokenized_prepared_datasets(
-    tokenizer, cfg, default_dataset_prepared_path
-) -> DatasetDict:
-    tokenizer_name = tokenizer.__class__.__name__
-    ds_hash = str(
-        md5(
-            (
-                str(cfg.sequence_len)
-                + "@"
-                + "|".join(
-                    sorted([f"{d.path}:{d.type}:{d.shards}" for d in cfg.datasets])
-                )
-                + "|"
-                + tokenizer_name
+def get_tokenizer_fingerprint(tokenizer: PreTrainedTokenizerBase) -> str:
+    """hash of everything about the tokenizer that changes the tokenized output"""
+    state = {
+        "class": tokenizer.__class__.__name__,
+        "vocab": sorted(tokenizer.get_vocab().items()),
+        "special_tokens": tokenizer.special_tokens_map_extended,
+        "add_bos_token": getattr(tokenizer, "add_bos_token", None),
+        "add_eos_token": getattr(tokenizer, "add_eos_token", None),
+        "legacy": getattr(tokenizer, "legacy", None),
+    }
+    if tokenizer.is_fast:
+        # merges, normalizers and post processors of the rust tokenizer
+        state["backend"] = tokenizer.backend_tokenizer.to_str()
+    serialized = json.dumps(state, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+def get_hub_dataset_revision(path: str, use_auth_token=None) -> Optional[str]:
+    """
+    commit a hub dataset resolves to, falling back to the revision in the local hub
+    cache when offline or when the hub can't be reached
+    """
+    if not hub_constants.HF_HUB_OFFLINE:
+        try:
+            return HfApi().dataset_info(path, token=use_auth_token).sha
+        except Exception as err:  # pylint: disable=broad-except
+            LOG.warning(f"Unable to resolve the revision of {path} on the hub: {err}")
+    ref_path = (
+        Path(hub_constants.HUGGINGFACE_HUB_CACHE)
+        / repo_folder_name(repo_id=path, repo_type="dataset")
+        / "refs"
+        / "main"
+    )
+    if ref_path.is_file():
+        return ref_path.read_text(encoding="utf-8").strip()
+    return None
+
+
+def get_dataset_source_fingerprint(
+    config_dataset: DictDefault, use_auth_token=None
+) -> str:
+    """
+    size and mtime of the local files backing a dataset entry, or the commit of a
+    hub dataset
+    """
+    local_path = Path(config_dataset.path)
+    if local_path.is_file():
+        files = [local_path]
+    elif local_path.is_dir():
+        files = sorted(path for path in local_path.rglob("*") if path.is_file())
+    else:
+        # hub datasets are identified by the path, name and data_files of the entry
+        # along with the commit the hub resolves them to
+        sha = get_hub_dataset_revision(config_dataset.path, use_auth_token)
+        if sha is None:
+            LOG.warning(
+                f"No revision of {config_dataset.path} found, "
+                "its prepared dataset is matched by path only"
             )
+            return f"hub:{config_dataset.path}"
+        return f"hub:{config_dataset.path}@{sha}"
+    stats = []
+    for path in files:
+        stat = path.stat()
+        stats.append(
+            f"{path.relative_to(local_path)}:{stat.st_size}:{stat.st_mtime_ns}"
         )
+    return md5("|".join(stats))
+
+
+def get_dataset_source_key(config_dataset: DictDefault) -> str:
+    return md5(json.dumps(config_dataset, sort_keys=True, default=str))
+
+
+def resolve_dataset_sources(cfg) -> Dict[str, str]:
+    """
+    source fingerprints of every dataset entry, resolved once on rank 0 and
+    broadcast so all ranks build the same cache keys
+    """
+    sources = {}
+    if is_main_process():
+        for config_dataset in for_d_in_datasets(cfg.datasets):
+            sources[
+                get_dataset_source_key(config_dataset)
+            ] = get_dataset_source_fingerprint(config_dataset, cfg.hf_use_auth_token)
+    return broadcast_dict(sources)
+
+
+def get_dataset_entry_hash(
+    config_dataset: DictDefault, cfg, tokenizer_fingerprint: str, seed: int
+) -> str:
+    """cache key for the tokenized output of a single dataset entry"""
+    source = (cfg.dataset_source_fingerprints or {}).get(
+        get_dataset_source_key(config_dataset)
     )
-    prepared_ds_path = (
-        Path(cfg.dataset_prepared_path) / ds_hash
-        if cfg.dataset_prepared_path
-        else Path(default_dataset_prepared_path) / ds_hash
+    if source is None:
+        source = get_dataset_source_fingerprint(config_dataset, cfg.hf_use_auth_token)
+    entry = {
+        "dataset": config_dataset,
+        "source": source,
+        "sequence_len": cfg.sequence_len,
+        "train_on_inputs": cfg.train_on_inputs,
+        # the seed only matters when sharding shuffles the raw dataset
+        "seed": seed if config_dataset.shards else None,
+        "tokenizer": tokenizer_fingerprint,
+    }
+    return md5(json.dumps(entry, sort_keys=True, default=str))
+
+
+def for_d_in_datasets(dataset_configs):
+    for dataset in dataset_configs:
+        if dataset.name and isinstance(dataset.name, list):
+            for name in dataset.name:
+                yield DictDefault({**dataset, "name": name})
+        else:
+            yield dataset
+
+
+def get_prepared_dataset_hashes(
+    cfg, tokenizer: PreTrainedTokenizerBase, seed: int
+) -> Tuple[List[DictDefault], List[str], str]:
+    """dataset entries with their cache keys, and the key of the merged dataset"""
+    tokenizer_fingerprint = get_tokenizer_fingerprint(tokenizer)
+    dataset_configs = list(for_d_in_datasets(cfg.datasets))
+    entry_hashes = [
+        get_dataset_entry_hash(config_dataset, cfg, tokenizer_fingerprint, seed)
+        for config_dataset in dataset_configs
+    ]
+    to_hash = str(cfg.sequence_len) + "@" + "|".join(entry_hashes)
+    if cfg.dataset_shuffle_mode == "block":
+        # the block shuffle merges the entries in a different order
+        to_hash += f"|block:{cfg.dataset_shuffle_block_size or 1000}"
+    ds_hash = str(md5(to_hash))
+    return dataset_configs, entry_hashes, ds_hash
+
+
+def block_shuffle_indices(num_rows: int, block_size: int, seed: int) -> np.ndarray:
+    """
+    Permutation of `num_rows` rows that shuffles the order of contiguous blocks of
+    `block_size` rows and the order of the rows within each block, so consecutive
+    reads stay within one block of the underlying arrow table
+    """
+    rng = np.random.default_rng(seed)
+    block_starts = np.arange(0, num_rows, block_size, dtype=np.int64)
+    rng.shuffle(block_starts)
+    blocks = [
+        start + rng.permutation(min(block_size, num_rows - start))
+        for start in block_starts
+    ]
+    return np.concatenate(blocks) if blocks else np.zeros((0,), dtype=np.int64)
+
+
+def shuffle_merged_dataset(dataset: Dataset, cfg, seed: int) -> Dataset:
+    """
+    Shuffle the merged dataset according to `dataset_shuffle_mode`:
+    - random: a global shuffle, kept as an indices mapping until saved
+    - flatten: a global shuffle, rewritten in the shuffled order right away
+    - block: a two-level block shuffle that keeps reads local
+    """
+    mode = cfg.dataset_shuffle_mode or "random"
+    if mode == "block":
+        return dataset.select(
+            block_shuffle_indices(
+                len(dataset), cfg.dataset_shuffle_block_size or 1000, seed
+            )
+        )
+    dataset = dataset.shuffle(seed=seed)
+    if mode == "flatten":
+        dataset = dataset.flatten_indices(num_proc=cfg.dataset_processes)
+    return dataset
+
+
+def save_prepared_dataset_entry(dataset: Dataset, path: Path):
+    """save a tokenized dataset entry, only publishing it once fully written"""
+    tmp_path = path.with_name(f"{path.name}.tmp-{uuid.uuid4().hex}")
+    dataset.save_to_disk(str(tmp_path))
+    try:
+        tmp_path.rename(path)
+    except OSError:
+        # another process published the same entry first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def load_prepared_dataset_entry(entry_path: Path) -> Dataset:
+    """
+    load a cached dataset entry, saved either as a whole or as the shards listed
+    in its manifest by distributed preparation
+    """
+    manifest_path = entry_path / "manifest.json"
+    if not manifest_path.exists():
+        return load_from_disk(str(entry_path))
+
+    manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+    shards = []
+    for shard_info in manifest["shards"]:
+        shard = load_from_disk(str(entry_path.parent / shard_info["path"]))
+        if (
+            len(shard) != shard_info["num_rows"]
+            or shard._fingerprint  # pylint: disable=protected-access
+            != shard_info["fingerprint"]
+        ):
+            raise ValueError(
+                f"prepared dataset shard {shard_info['path']} doesn't match {manifest_path}"
+            )
+        shards.append(shard)
+    return concatenate_datasets(shards)
+
+
+def load_tokenized_prepared_datasets(
+    tokenizer, cfg, default_dataset_prepared_path
+) -> DatasetDict:
+    if cfg.seed:
+        seed = cfg.seed
+    else:
+        LOG.info("No seed provided, using default seed of 42")
+        seed = 42
+
+    dataset_configs, entry_hashes, ds_hash = get_prepared_dataset_hashes(
+        cfg, tokenizer, seed
     )
+    prepared_root = Path(cfg.dataset_prepared_path or default_dataset_prepared_path)
+    prepared_ds_path = prepared_root / ds_hash
+    use_token_store = cfg.dataset_prepared_format == "token_store"
+    token_store_path = prepared_root / f"{ds_hash}-tokens"
     dataset = None
     prompters = []
     use_auth_token = cfg.hf_use_auth_token
@@ -125,6 +367,13 @@ def load_tokenized_prepared_datasets(
 
     if dataset:
         ...
+    elif (
+        cfg.dataset_prepared_path
+        and use_token_store
+        and TokenStore.exists(token_store_path)
+    ):
+        LOG.info(f"Loading prepared token store from disk at {token_store_path}...")
+        dataset = TokenStore(token_store_path)
     elif cfg.dataset_prepared_path and any(prepared_ds_path.glob("*")):
         LOG.info(f"Loading prepared dataset from disk at {prepared_ds_path}...")
         dataset = load_from_disk(str(prepared_ds_path))
@@ -133,160 +382,68 @@ def load_tokenized_prepared_datasets(
         LOG.info(f"Unable to find prepared dataset in {prepared_ds_path}")
         LOG.info("Loading raw datasets...")
 
-        if cfg.seed:
-            seed = cfg.seed
-        else:
-            LOG.info("No seed provided, using default seed of 42")
-            seed = 42
-
-        datasets = []
-
-        def for_d_in_datasets(dataset_configs):
-            for dataset in dataset_configs:
-                if dataset.name and isinstance(dataset.name, list):
-                    for name in dataset.name:
-                        yield DictDefault({**dataset, "name": name})
-                else:
-                    yield dataset
-
-        # pylint: disable=invalid-name
-        for config_dataset in for_d_in_datasets(cfg.datasets):
-            ds: Union[Dataset, DatasetDict] = None
-            ds_from_hub = False
-            try:
-                load_dataset(
-                    config_dataset.path,
-                    name=config_dataset.name,
-                    streaming=True,
-                    token=use_auth_token,
+        datasets: List[Optional[Dataset]] = [None] * len(dataset_configs)
+        dataset_prompters: List[Any] = [None] * len(dataset_configs)
+        pending = []
+        for idx, (config_dataset, entry_hash) in enumerate(
+            zip(dataset_configs, entry_hashes)
+        ):
+            # each entry is cached on its own so only changed entries get re-tokenized
+            entry_path = prepared_root / "datasets" / entry_hash
+            if cfg.dataset_prepared_path and any(entry_path.glob("*")):
+                LOG.info(
+                    f"Loading prepared dataset {config_dataset.path} from disk at {entry_path}..."
                 )
-                ds_from_hub = True
-            except (FileNotFoundError, ConnectionError):
-                pass
-
-            # prefer local dataset, even if hub exists
-            local_path = Path(config_dataset.path)
-            if local_path.exists():
-                if local_path.is_dir():
-                    # TODO dirs with arrow or parquet files could be loaded with `load_from_disk`
-                    ds = load_dataset(
-                        config_dataset.path,
-                        name=config_dataset.name,
-                        data_files=config_dataset.data_files,
-                        streaming=False,
-                        split=None,
-                    )
-                elif local_path.is_file():
-                    ds_type = "json"
-                    if config_dataset.ds_type:
-                        ds_type = config_dataset.ds_type
-                    elif ".parquet" in config_dataset.path:
-                        ds_type = "parquet"
-                    elif ".arrow" in config_dataset.path:
-                        ds_type = "arrow"
-                    elif ".csv" in config_dataset.path:
-                        ds_type = "csv"
-                    elif ".txt" in config_dataset.path:
-                        ds_type = "text"
-                    ds = load_dataset(
-                        ds_type,
-                        name=config_dataset.name,
-                        data_files=config_dataset.path,
-                        streaming=False,
-                        split=None,
-                    )
-                else:
-                    raise ValueError(
-                        "unhandled dataset load: local path exists, but is neither a directory or a file"
-                    )
-            elif ds_from_hub:
-                ds = load_dataset(
-                    config_dataset.path,
-                    name=config_dataset.name,
-                    streaming=False,
-                    data_files=config_dataset.data_files,
-                    token=use_auth_token,
+                datasets[idx] = load_prepared_dataset_entry(entry_path)
+                dataset_prompters[idx] = get_dataset_prompter(
+                    config_dataset, tokenizer, cfg
                 )
             else:
-                if isinstance(config_dataset.data_files, str):
-                    fp = hf_hub_download(
-                        repo_id=config_dataset.path,
-                        repo_type="dataset",
-                        filename=config_dataset.data_files,
-                    )
-                elif isinstance(config_dataset.data_files, list):
-                    fp = []
-                    for file in config_dataset.data_files:
-                        fp.append(
-                            hf_hub_download(
-                                repo_id=config_dataset.path,
-                                repo_type="dataset",
-                                filename=file,
-                            )
-                        )
-                else:
-                    raise ValueError(
-                        "data_files must be either a string or list of strings"
-                    )
-                ds = load_dataset(
-                    "json",
-                    name=config_dataset.name,
-                    data_files=fp,
-                    streaming=False,
-                    split=None,
-                )
-            if not ds:
-                raise ValueError("unhandled dataset load")
-            # support for using a subset of the data
-            if config_dataset.shards:
-                if "train" in ds:
-                    ds = ds.shuffle(seed=seed)["train"].shard(
-                        num_shards=config_dataset.shards, index=0
-                    )
-                else:
-                    ds = ds.shuffle(seed=seed).shard(
-                        num_shards=config_dataset.shards, index=0
-                    )
+                pending.append((idx, config_dataset, entry_path))
 
-            d_base_type = d_prompt_style = None
-            d_type = config_dataset.type
-            if isinstance(d_type, str):
-                d_type_split = d_type.split(":")
-                d_base_type = d_type_split[0]
-                d_prompt_style = d_type_split[1] if len(d_type_split) > 1 else None
-            if "train" in ds:
-                ds = ds["train"]
-            elif (
-                isinstance(ds, DatasetDict)
-                and config_dataset.train_on_split
-                and config_dataset.train_on_split in ds
-            ):
-                ds = ds[config_dataset.train_on_split]
-            elif isinstance(ds, DatasetDict):
-                raise ValueError(
-                    f"no train split found for dataset {config_dataset.path}, you may specify a split with 'train_on_split: `"
-                )
-
-            dataset_wrapper, dataset_prompter = get_dataset_wrapper(
-                config_dataset=config_dataset,
-                dataset=ds,
-                tokenizer=tokenizer,
-                cfg=cfg,
-                d_base_type=d_base_type,
-                d_prompt_style=d_prompt_style,
-            )
-            datasets.append(dataset_wrapper)
-            prompters.append(dataset_prompter)
+        if pending:
+            # load and tokenize the remaining entries concurrently, sharing one
+            # process budget so small entries don't leave the cores idle
+            budget = ProcessBudget(cfg.dataset_processes or os.cpu_count())
+            max_workers = min(len(pending), budget.total)
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [
+                    (
+                        idx,
+                        executor.submit(
+                            prepare_dataset_entry,
+                            config_dataset,
+                            entry_path,
+                            # fast tokenizers can't be shared between threads
+                            copy.deepcopy(tokenizer) if max_workers > 1 else tokenizer,
+                            cfg,
+                            use_auth_token,
+                            seed,
+                            budget,
+                        ),
+                    )
+                    for idx, config_dataset, entry_path in pending
+                ]
+                try:
+                    for idx, future in futures:
+                        datasets[idx], dataset_prompters[idx] = future.result()
+                except BaseException:
+                    executor.shutdown(wait=True, cancel_futures=True)
+                    raise
+        prompters = dataset_prompters
 
         LOG.info("merging datasets")
         dataset = concatenate_datasets(datasets)
 
         if len(datasets) > 1:
             LOG.info("shuffle merged datasets")
-            dataset = dataset.shuffle(seed=seed)
+            dataset = shuffle_merged_dataset(dataset, cfg, seed)
         if cfg.local_rank == 0:
-            LOG.info(f"Saving merged prepared dataset to disk... {prepared_ds_path}")
-            dataset.save_to_disk(prepared_ds_path)
+            if not use_token_store:
+                LOG.info(
+                    f"Saving merged prepared dataset to disk... {prepared_ds_path}"
+                )
+                dataset.save_to_disk(prepared_ds_path)
             if cfg.push_dataset_to_hub:
                 LOG.info(
                     f"Saving merged prepared dataset with push_to_hub... {cfg.push_dataset_to_hub}/{ds_hash}"
@@ -295,9 +452,390 @@ def load_tokenized_prepared_datasets(
                     f"{cfg.push_dataset_to_hub}/{ds_hash}", private=True
                 )
 
+    if use_token_store and not isinstance(dataset, TokenStore):
+        if not TokenStore.exists(token_store_path):
+            LOG.info(f"Saving merged prepared token store... {token_store_path}")
+            TokenStore.save(dataset, token_store_path, vocab_size=len(tokenizer))
+        dataset = TokenStore(token_store_path)
+
     return dataset, prompters
 
 
+class ProcessBudget:
+    """
+    Fixed number of preprocessing processes shared by the dataset entries that are
+    loaded and tokenized concurrently
+    """
+
+    def __init__(self, total: int):
+        self.total = max(1, total)
+        self.available = self.total
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def reserve(self, count: int):
+        """block until `count` processes are free, capped at the whole budget"""
+        count = max(1, min(count, self.total))
+        with self._condition:
+            self._condition.wait_for(lambda: self.available >= count)
+            self.available -= count
+        try:
+            yield count
+        finally:
+            with self._condition:
+                self.available += count
+                self._condition.notify_all()
+
+
+def prepare_dataset_entry(
+    config_dataset: DictDefault,
+    entry_path: Path,
+    tokenizer: PreTrainedTokenizerBase,
+    cfg,
+    use_auth_token,
+    seed: int,
+    budget: ProcessBudget,
+):
+    """load, tokenize and cache a single dataset entry"""
+    with budget.reserve(1):
+        ds = load_raw_dataset(config_dataset, use_auth_token, seed)
+
+    wanted_processes = math.ceil(len(ds) / ROWS_PER_PREPROCESS_PROCESS)
+    with budget.reserve(wanted_processes) as process_count:
+        dataset_wrapper, dataset_prompter = tokenize_dataset_entry(
+            config_dataset, ds, tokenizer, cfg, process_count
+        )
+    # entries are only read back from an explicit dataset_prepared_path
+    if cfg.dataset_prepared_path and cfg.local_rank == 0:
+        LOG.info(f"Saving prepared dataset entry to disk... {entry_path}")
+        entry_path.parent.mkdir(parents=True, exist_ok=True)
+        with budget.reserve(1):
+            save_prepared_dataset_entry(dataset_wrapper, entry_path)
+    return dataset_wrapper, dataset_prompter
+
+
+# prompters of the base dataset types handled by `get_dataset_wrapper`
+BASE_TYPE_PROMPTERS = {
+    "alpaca": AlpacaPrompter,
+    "explainchoice": MultipleChoiceExplainPrompter,
+    "concisechoice": MultipleChoiceConcisePrompter,
+    "summarizetldr": SummarizeTLDRPrompter,
+    "jeopardy": JeopardyPrompter,
+    "oasst": AlpacaPrompter,
+    "gpteacher": GPTeacherPrompter,
+    "reflection": ReflectAlpacaPrompter,
+}
+
+
+def get_dataset_prompter(
+    config_dataset: DictDefault, tokenizer: PreTrainedTokenizerBase, cfg
+):
+    """
+    the prompter `get_dataset_wrapper` picks for a dataset entry, for entries loaded
+    from the prepared dataset cache without being tokenized again
+    """
+    d_type = config_dataset.type
+    if not isinstance(d_type, str) or load(d_type, tokenizer, cfg, config_dataset):
+        return UnsupportedPrompter()
+    d_base_type, _, d_prompt_style = d_type.partition(":")
+    prompter_cls = BASE_TYPE_PROMPTERS.get(d_base_type)
+    if prompter_cls is None:
+        return UnsupportedPrompter()
+    return prompter_cls(d_prompt_style or None)
+
+
+def tokenize_dataset_entry(
+    config_dataset: DictDefault,
+    ds: Dataset,
+    tokenizer: PreTrainedTokenizerBase,
+    cfg,
+    process_count: Optional[int] = None,
+):
+    d_base_type = d_prompt_style = None
+    d_type = config_dataset.type
+    if isinstance(d_type, str):
+        d_type_split = d_type.split(":")
+        d_base_type = d_type_split[0]
+        d_prompt_style = d_type_split[1] if len(d_type_split) > 1 else None
+
+    return get_dataset_wrapper(
+        config_dataset=config_dataset,
+        dataset=ds,
+        tokenizer=tokenizer,
+        cfg=cfg,
+        d_base_type=d_base_type,
+        d_prompt_style=d_prompt_style,
+        process_count=process_count,
+    )
+
+
+def prepare_dataset_shards(
+    tokenizer: PreTrainedTokenizerBase,
+    cfg,
+    default_dataset_prepared_path,
+    rank: Optional[int] = None,
+    world_size: Optional[int] = None,
+    run_id: Optional[str] = None,
+):
+    """
+    Tokenize disjoint shards of every uncached dataset entry on all ranks, and
+    publish a manifest per entry so that loading it only has to merge the shards.
+
+    Shards are claimed through lock files under `dataset_prepared_path`, which has
+    to be on a filesystem shared by all nodes. Locks are tagged with an id shared
+    by the ranks of this run, so locks left behind by a crashed run are ignored.
+    """
+    if rank is None:
+        rank = get_rank()
+    if world_size is None:
+        world_size = get_world_size()
+    if run_id is None:
+        run_id = broadcast_dict({"run_id": uuid.uuid4().hex})["run_id"]
+    seed = cfg.seed or 42
+
+    dataset_configs, entry_hashes, ds_hash = get_prepared_dataset_hashes(
+        cfg, tokenizer, seed
+    )
+    prepared_root = Path(cfg.dataset_prepared_path or default_dataset_prepared_path)
+    if any((prepared_root / ds_hash).glob("*")):
+        return
+
+    # the ranks of a node share its cores
+    max_processes = max(
+        1,
+        (cfg.dataset_processes or os.cpu_count())
+        // int(os.getenv("LOCAL_WORLD_SIZE", "1")),
+    )
+    published = []
+    for config_dataset, entry_hash in zip(dataset_configs, entry_hashes):
+        entry_path = prepared_root / "datasets" / entry_hash
+        if any(entry_path.glob("*")):
+            continue
+        ds = load_raw_dataset(config_dataset, cfg.hf_use_auth_token, seed)
+        num_shards = max(
+            1, min(world_size, math.ceil(len(ds) / ROWS_PER_PREPROCESS_PROCESS))
+        )
+        shards_dir = prepared_root / "datasets" / f"{entry_hash}-shards"
+        shards_dir.mkdir(parents=True, exist_ok=True)
+        shard_paths = [
+            shards_dir / f"{index:05d}-of-{num_shards:05d}"
+            for index in range(num_shards)
+        ]
+        # start at our own shard, then help with whatever nobody has claimed yet
+        for offset in range(num_shards):
+            index = (rank + offset) % num_shards
+            shard_path = shard_paths[index]
+            if shard_path.exists() or not claim_prepared_shard(shard_path, run_id):
+                continue
+            LOG.info(
+                f"Tokenizing shard {index + 1}/{num_shards} of {config_dataset.path}..."
+            )
+            shard = ds.shard(num_shards=num_shards, index=index, contiguous=True)
+            process_count = min(
+                max_processes, math.ceil(len(shard) / ROWS_PER_PREPROCESS_PROCESS)
+            )
+            dataset_wrapper, _ = tokenize_dataset_entry(
+                config_dataset, shard, tokenizer, cfg, max(1, process_count)
+            )
+            save_prepared_dataset_entry(dataset_wrapper, shard_path)
+        published.append((entry_path, shard_paths))
+
+    for entry_path, shard_paths in published:
+        wait_for_prepared_shards(
+            shard_paths, run_id, timeout=cfg.ddp_timeout or PREPARED_SHARD_TIMEOUT
+        )
+        write_prepared_shard_manifest(entry_path, shard_paths)
+
+
+def claim_prepared_shard(shard_path: Path, run_id: str) -> bool:
+    """atomically create the lock file of a shard, False if it is already taken"""
+    lock_path = shard_path.with_name(f"{shard_path.name}.{run_id}.lock")
+    try:
+        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, "w", encoding="utf-8") as fout:
+        fout.write(f"{socket.gethostname()}:{os.getpid()}\n")
+    return True
+
+
+def wait_for_prepared_shards(
+    shard_paths: List[Path],
+    run_id: str,
+    timeout: float = PREPARED_SHARD_TIMEOUT,
+    poll_interval: float = 5.0,
+):
+    """
+    wait for the other ranks to publish their shards, failing once `timeout` seconds
+    pass without all of them, e.g. because the rank that claimed one crashed
+    """
+    start = last_log = time.monotonic()
+    while True:
+        missing = [path for path in shard_paths if not path.exists()]
+        if not missing:
+            return
+        if time.monotonic() - start > timeout:
+            owners = []
+            for path in missing:
+                lock_path = path.with_name(f"{path.name}.{run_id}.lock")
+                owner = (
+                    lock_path.read_text(encoding="utf-8").strip()
+                    if lock_path.exists()
+                    else "unclaimed"
+                )
+                owners.append(f"{path} ({owner})")
+            raise TimeoutError(
+                f"prepared dataset shards still missing after {timeout}s: "
+                + ", ".join(owners)
+            )
+        if time.monotonic() - last_log > 60:
+            LOG.info(
+                f"Waiting for {len(missing)} prepared dataset shards from other ranks..."
+            )
+            last_log = time.monotonic()
+        time.sleep(poll_interval)
+
+
+def write_prepared_shard_manifest(entry_path: Path, shard_paths: List[Path]):
+    """publish a dataset entry as the ordered list of its shards"""
+    if (entry_path / "manifest.json").exists():
+        return
+    shards = []
+    for shard_path in shard_paths:
+        shard = load_from_disk(str(shard_path))
+        shards.append(
+            {
+                "path": str(shard_path.relative_to(entry_path.parent)),
+                "num_rows": len(shard),
+                "fingerprint": shard._fingerprint,  # pylint: disable=protected-access
+            }
+        )
+    manifest = {
+        "shards": shards,
+        "fingerprint": md5("|".join(shard["fingerprint"] for shard in shards)),
+    }
+    tmp_path = entry_path.with_name(f"{entry_path.name}.tmp-{uuid.uuid4().hex}")
+    tmp_path.mkdir(parents=True)
+    (tmp_path / "manifest.json").write_text(json.dumps(manifest), encoding="utf-8")
+    try:
+        tmp_path.rename(entry_path)
+    except OSError:
+        # another rank published the same manifest first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def dataset_exists_on_hub(config_dataset: DictDefault, use_auth_token) -> bool:
+    try:
+        load_dataset(
+            config_dataset.path,
+            name=config_dataset.name,
+            streaming=True,
+            token=use_auth_token,
+        )
+        return True
+    except (FileNotFoundError, ConnectionError):
+        return False
+
+
+def load_raw_dataset(config_dataset: DictDefault, use_auth_token, seed: int) -> Dataset:
+    """load the train split of a single dataset entry, before tokenization"""
+    ds: Union[Dataset, DatasetDict] = None
+
+    # prefer local dataset, even if hub exists, and don't probe the hub for it
+    local_path = Path(config_dataset.path)
+    if local_path.exists():
+        if local_path.is_dir():
+            # TODO dirs with arrow or parquet files could be loaded with `load_from_disk`
+            ds = load_dataset(
+                config_dataset.path,
+                name=config_dataset.name,
+                data_files=config_dataset.data_files,
+                streaming=False,
+                split=None,
+            )
+        elif local_path.is_file():
+            ds_type = "json"
+            if config_dataset.ds_type:
+                ds_type = config_dataset.ds_type
+            elif ".parquet" in config_dataset.path:
+                ds_type = "parquet"
+            elif ".arrow" in config_dataset.path:
+                ds_type = "arrow"
+            elif ".csv" in config_dataset.path:
+                ds_type = "csv"
+            elif ".txt" in config_dataset.path:
+                ds_type = "text"
+            ds = load_dataset(
+                ds_type,
+                name=config_dataset.name,
+                data_files=config_dataset.path,
+                streaming=False,
+                split=None,
+            )
+        else:
+            raise ValueError(
+                "unhandled dataset load: local path exists, but is neither a directory or a file"
+            )
+    elif dataset_exists_on_hub(config_dataset, use_auth_token):
+        ds = load_dataset(
+            config_dataset.path,
+            name=config_dataset.name,
+            streaming=False,
+            data_files=config_dataset.data_files,
+            token=use_auth_token,
+        )
+    else:
+        if isinstance(config_dataset.data_files, str):
+            fp = hf_hub_download(
+                repo_id=config_dataset.path,
+                repo_type="dataset",
+                filename=config_dataset.data_files,
+            )
+        elif isinstance(config_dataset.data_files, list):
+            fp = []
+            for file in config_dataset.data_files:
+                fp.append(
+                    hf_hub_download(
+                        repo_id=config_dataset.path,
+                        repo_type="dataset",
+                        filename=file,
+                    )
+                )
+        else:
+            raise ValueError("data_files must be either a string or list of strings")
+        ds = load_dataset(
+            "json",
+            name=config_dataset.name,
+            data_files=fp,
+            streaming=False,
+            split=None,
+        )
+    if not ds:
+        raise ValueError("unhandled dataset load")
+    # support for using a subset of the data
+    if config_dataset.shards:
+        if "train" in ds:
+            ds = ds.shuffle(seed=seed)["train"].shard(
+                num_shards=config_dataset.shards, index=0
+            )
+        else:
+            ds = ds.shuffle(seed=seed).shard(num_shards=config_dataset.shards, index=0)
+
+    if "train" in ds:
+        ds = ds["train"]
+    elif (
+        isinstance(ds, DatasetDict)
+        and config_dataset.train_on_split
+        and config_dataset.train_on_split in ds
+    ):
+        ds = ds[config_dataset.train_on_split]
+    elif isinstance(ds, DatasetDict):
+        raise ValueError(
+            f"no train split found for dataset {config_dataset.path}, you may specify a split with 'train_on_split: `"
+        )
+    return ds
+
+
 def load_prepare_datasets(
     tokenizer: PreTrainedTokenizerBase,
     cfg,
@@ -374,25 +912,23 @@ def load_prepare_datasets(
             if cfg.seed:
                 dataset = dataset.shuffle(seed=cfg.seed)
 
-            constant_len_dataset = ConstantLengthDataset(
-                tokenizer,
-                [dataset],
-                seq_length=max_packed_sequence_len,
-            )
+            # pack contiguous shards in parallel, streaming the packed rows into
+            # arrow files rather than materializing them in memory
+            num_shards = min(cfg.dataset_processes or 1, len(dataset)) or 1
             LOG.info(f"packing master dataset to len: {cfg.max_packed_sequence_len}")
-            dataset = Dataset.from_list(list(constant_len_dataset))
-
-            # filter out bad data
-            # TODO convert to dataset.filter(...)
-            dataset = Dataset.from_list(
-                [
-                    d
-                    for d in dataset
-                    if len(d["input_ids"]) <= cfg.sequence_len
-                    and len(d["input_ids"]) > 0
-                    and len(d["input_ids"]) == len(d["attention_mask"])
-                    and len(d["input_ids"]) == len(d["labels"])
-                ]
+            dataset = Dataset.from_generator(
+                pack_constant_length_shards,
+                features=constant_length_features(tokenizer),
+                cache_dir=str(prepared_ds_path.parent / "packing_cache"),
+                gen_kwargs={
+                    "shard_indices": list(range(num_shards)),
+                    "dataset": dataset,
+                    "tokenizer": tokenizer,
+                    "seq_length": max_packed_sequence_len,
+                    "num_shards": num_shards,
+                    "max_length": cfg.sequence_len,
+                },
+                num_proc=num_shards if num_shards > 1 else None,
             )
 
             if cfg.local_rank == 0:
@@ -464,10 +1000,17 @@ def load_prepare_datasets(
 
 
 def get_dataset_wrapper(
-    config_dataset, dataset, tokenizer, cfg, d_base_type, d_prompt_style
+    config_dataset,
+    dataset,
+    tokenizer,
+    cfg,
+    d_base_type,
+    d_prompt_style,
+    process_count=None,
 ):
     dataset_wrapper = None
     dataset_prompter = None
+    process_count = process_count or cfg.dataset_processes
 
     if (
         "input_ids" in dataset.features
@@ -483,12 +1026,12 @@ def get_dataset_wrapper(
         )
         dataset_prompter = UnsupportedPrompter()
         dataset_wrapper = TokenizedPromptDataset(
-            ds_strategy, dataset, process_count=cfg.dataset_processes
+            ds_strategy, dataset, process_count=process_count
         )
     elif ds_strategy := load(config_dataset.type, tokenizer, cfg, config_dataset):
         dataset_prompter = UnsupportedPrompter()
         dataset_wrapper = TokenizedPromptDataset(
-            ds_strategy, dataset, process_count=cfg.dataset_processes
+            ds_strategy, dataset, process_count=process_count
         )
     elif d_base_type == "alpaca":
         dataset_prompter = AlpacaPrompter(d_prompt_style)
@@ -499,7 +1042,7 @@ def get_dataset_wrapper(
             cfg.sequence_len,
         )
         ds_wrapper = TokenizedPromptDataset(
-            ds_strategy, dataset, process_count=cfg.dataset_processes
+            ds_strategy, dataset, process_count=process_count
         )
         dataset_wrapper = ds_wrapper
     elif d_base_type == "explainchoice":
@@ -511,7 +1054,7 @@ def get_dataset_wrapper(
             cfg.sequence_len,
         )
         ds_wrapper = TokenizedPromptDataset(
-            ds_strategy, dataset, process_count=cfg.dataset_processes
+            ds_strategy, dataset, process_count=process_count
         )
         dataset_wrapper = ds_wrapper
     elif d_base_type == "concisechoice":
@@ -523,7 +1066,7 @@ def get_dataset_wrapper(
             cfg.sequence_len,
         )
         ds_wrapper = TokenizedPromptDataset(
-            ds_strategy, dataset, process_count=cfg.dataset_processes
+            ds_strategy, dataset, process_count=process_count
         )
         dataset_wrapper = ds_wrapper
     elif d_base_type == "summarizetldr":
@@ -535,7 +1078,7 @@ def get_dataset_wrapper(
             cfg.sequence_len,
         )
         ds_wrapper = TokenizedPromptDataset(
-            ds_strategy, dataset, process_count=cfg.dataset_processes
+            ds_strategy, dataset, process_count=process_count
         )
         dataset_wrapper = ds_wrapper
     elif d_base_type == "jeopardy":
@@ -547,7 +1090,7 @@ def get_dataset_wrapper(
             cfg.sequence_len,
         )
         ds_wrapper = TokenizedPromptDataset(
-            ds_strategy, dataset, process_count=cfg.dataset_processes
+            ds_strategy, dataset, process_count=process_count
         )
         dataset_wrapper = ds_wrapper
     elif d_base_type == "oasst":
@@ -559,7 +1102,7 @@ def get_dataset_wrapper(
             cfg.sequence_len,
         )
         ds_wrapper = TokenizedPromptDataset(
-            ds_strategy, dataset, process_count=cfg.dataset_processes
+            ds_strategy, dataset, process_count=process_count
         )
         dataset_wrapper = ds_wrapper
     elif d_base_type == "gpteacher":
@@ -571,7 +1114,7 @@ def get_dataset_wrapper(
             cfg.sequence_len,
         )
         ds_wrapper = TokenizedPromptDataset(
-            ds_strategy, dataset, process_count=cfg.dataset_processes
+            ds_strategy, dataset, process_count=process_count
         )
         dataset_wrapper = ds_wrapper
     elif d_base_type == "reflection":
@@ -583,7 +1126,7 @@ def get_dataset_wrapper(
             cfg.sequence_len,
         )
         ds_wrapper = TokenizedPromptDataset(
-            ds_strategy, dataset, process_count=cfg.dataset_processes
+            ds_strategy, dataset, process_count=process_count
         )
         dataset_wrapper = ds_wrapper
     else:
@@ -600,118 +1143,141 @@ def get_dataset_wrapper(
     return dataset_wrapper, dataset_prompter
 
 
+def pack_pretraining_sequences(
+    input_ids: List[List[int]],
+    attention_mask: List[List[int]],
+    max_tokens: int,
+    eos_token_id: int,
+    pad_token_id: int,
+) -> Dict[str, np.ndarray]:
+    """
+    Greedily concatenate tokenized samples, each followed by EOS and PAD, into rows of
+    `max_tokens`, padding a row whenever the next sample doesn't fit. The row layout is
+    computed from the cumulative sample lengths and every token is scattered into
+    preallocated arrays in one shot.
+    """
+    num_samples = len(input_ids)
+    token_lens = np.fromiter(map(len, input_ids), dtype=np.int64, count=num_samples)
+    # each sample is followed by an EOS and a PAD token
+    sample_lens = token_lens + 2
+    sample_starts = np.zeros((num_samples + 1,), dtype=np.int64)
+    np.cumsum(sample_lens, out=sample_starts[1:])
+
+    # first sample of each row: everything up to the next sample that overflows
+    row_starts = []
+    idx = 0
+    while idx < num_samples:
+        row_starts.append(idx)
+        idx = int(
+            np.searchsorted(sample_starts, sample_starts[idx] + max_tokens, "right") - 1
+        )
+    row_starts_arr = np.asarray(row_starts, dtype=np.int64)
+    num_rows = len(row_starts_arr)
+
+    sample_row = np.repeat(
+        np.arange(num_rows), np.diff(np.append(row_starts_arr, num_samples))
+    )
+    sample_dest = (
+        sample_row * max_tokens
+        + sample_starts[:-1]
+        - sample_starts[row_starts_arr][sample_row]
+    )
+    total_tokens = int(token_lens.sum())
+    token_starts = np.cumsum(token_lens) - token_lens
+    token_dest = np.repeat(sample_dest - token_starts, token_lens) + np.arange(
+        total_tokens
+    )
+
+    packed_input_ids = np.full((num_rows, max_tokens), pad_token_id, dtype=np.int32)
+    packed_attention_mask = np.zeros((num_rows, max_tokens), dtype=np.int32)
+    flat_input_ids = packed_input_ids.reshape(-1)
+    flat_attention_mask = packed_attention_mask.reshape(-1)
+    flat_input_ids[token_dest] = np.fromiter(
+        itertools.chain.from_iterable(input_ids), dtype=np.int32, count=total_tokens
+    )
+    flat_attention_mask[token_dest] = np.fromiter(
+        itertools.chain.from_iterable(attention_mask),
+        dtype=np.int32,
+        count=total_tokens,
+    )
+    eos_dest = sample_dest + token_lens
+    flat_input_ids[eos_dest] = eos_token_id
+    flat_attention_mask[eos_dest] = 1
+
+    return {
+        "input_ids": packed_input_ids,
+        # the loss needs int64 targets
+        "labels": packed_input_ids.astype(np.int64),
+        "attention_mask": packed_attention_mask,
+    }
+
+
 def encode_pretraining(
     tokenizer: PreTrainedTokenizerBase, max_tokens: int, examples: List[str]
-) -> Dict[str, List]:
+) -> Dict[str, np.ndarray]:
     res = tokenizer(
         examples,
         truncation=True,
         max_length=max_tokens - 2,
         add_special_tokens=True,
     )
-    # Convert to PyTorch tensors
-    input_ids = [torch.tensor(seq) for seq in res["input_ids"]]
-    attention_mask = [torch.tensor(seq) for seq in res["attention_mask"]]
-    new_input_ids = []
-    new_attention_mask = []
-    # Append EOS and PAD tokens to input_ids, and correct attention_mask
-    for i, _ in enumerate(input_ids):
-        input_ids[i] = torch.cat(
-            (
-                input_ids[i],
-                torch.tensor([tokenizer.eos_token_id, tokenizer.pad_token_id]),
-            ),
-            dim=0,
-        )
-        attention_mask[i] = torch.cat((attention_mask[i], torch.tensor([1, 0])), dim=0)
-
-    # Concatenate tokens so that their lengths are less than max_tokens
-    buffer_input_ids = torch.tensor([], dtype=torch.long)
-    buffer_attention_mask = torch.tensor([], dtype=torch.long)
-
-    for ids, mask in zip(input_ids, attention_mask):
-        if buffer_input_ids.numel() == max_tokens:
-            new_input_ids.append(buffer_input_ids)
-            new_attention_mask.append(buffer_attention_mask)
-            buffer_input_ids = torch.tensor([], dtype=torch.long)
-            buffer_attention_mask = torch.tensor([], dtype=torch.long)
-            buffer_input_ids = torch.cat((buffer_input_ids, ids), dim=0)
-            buffer_attention_mask = torch.cat((buffer_attention_mask, mask), dim=0)
-        elif buffer_input_ids.numel() + ids.numel() <= max_tokens:
-            buffer_input_ids = torch.cat((buffer_input_ids, ids), dim=0)
-            buffer_attention_mask = torch.cat((buffer_attention_mask, mask), dim=0)
-        else:
-            buffer_input_ids = torch.cat(
-                (
-                    buffer_input_ids,
-                    torch.full(
-                        (max_tokens - buffer_input_ids.numel(),),
-                        tokenizer.pad_token_id,
-                        dtype=torch.long,
-                    ),
-                ),
-                dim=0,
-            )
-            buffer_attention_mask = torch.cat(
-                (
-                    buffer_attention_mask,
-                    torch.full(
-                        (max_tokens - buffer_attention_mask.numel(),),
-                        0,
-                        dtype=torch.long,
-                    ),
-                ),
-                dim=0,
-            )
-            new_input_ids.append(buffer_input_ids)
-            new_attention_mask.append(buffer_attention_mask)
-            buffer_input_ids = torch.tensor([], dtype=torch.long)
-            buffer_attention_mask = torch.tensor([], dtype=torch.long)
+    ret = pack_pretraining_sequences(
+        res["input_ids"],
+        res["attention_mask"],
+        max_tokens,
+        tokenizer.eos_token_id,
+        tokenizer.pad_token_id,
+    )
 
-            buffer_input_ids = torch.cat((buffer_input_ids, ids), dim=0)
-            buffer_attention_mask = torch.cat((buffer_attention_mask, mask), dim=0)
+    LOG.debug(len(ret["input_ids"]))
+    return ret
 
-    if buffer_input_ids.numel() > 0:  # for any leftover tokens
-        while buffer_input_ids.numel() < max_tokens:  # make all sequences equal in size
-            buffer_input_ids = torch.cat(
-                (
-                    buffer_input_ids,
-                    torch.full(
-                        (max_tokens - buffer_input_ids.numel(),),
-                        tokenizer.pad_token_id,
-                        dtype=torch.long,
-                    ),
-                ),
-                dim=0,
-            )
-            buffer_attention_mask = torch.cat(
-                (
-                    buffer_attention_mask,
-                    torch.full(
-                        (max_tokens - buffer_attention_mask.numel(),),
-                        0,
-                        dtype=torch.long,
-                    ),
-                ),
-                dim=0,
-            )
-        new_input_ids.append(buffer_input_ids)
-        new_attention_mask.append(buffer_attention_mask)
 
-    ret = {
-        "input_ids": [seq.tolist() for seq in new_input_ids],
-        "labels": [seq.tolist() for seq in new_input_ids],
-        "attention_mask": [seq.tolist() for seq in new_attention_mask],
+def encode_pretraining_documents(
+    tokenizer: PreTrainedTokenizerBase, max_tokens: int, examples: List[str]
+) -> Dict[str, List[List[int]]]:
+    """
+    Tokenize each document on its own, ending with EOS, for StreamingMultipackDataset
+    """
+    res = tokenizer(
+        examples,
+        truncation=True,
+        max_length=max_tokens - 1,
+        add_special_tokens=True,
+    )
+    return {
+        "input_ids": [
+            input_ids + [tokenizer.eos_token_id] for input_ids in res["input_ids"]
+        ]
     }
 
-    LOG.debug(len(ret["input_ids"]))
-    return ret
-
 
-def load_pretraining_dataset(path, tokenizer, max_tokens=2048, seed=42):
-    encode = functools.partial(encode_pretraining, tokenizer, max_tokens)
+def load_pretraining_dataset(
+    path,
+    tokenizer,
+    max_tokens=2048,
+    seed=42,
+    sample_packing=False,
+    packing_buffer_size=64,
+    micro_batch_size=1,
+):
     dataset = load_dataset(path, streaming=True, split="train")
     dataset = dataset.shuffle(seed=seed, buffer_size=10_000)
+    if sample_packing:
+        dataset = dataset.map(
+            functools.partial(encode_pretraining_documents, tokenizer, max_tokens),
+            batched=True,
+            input_columns="text",
+            remove_columns=dataset.features.keys(),
+        )
+        return StreamingMultipackDataset(
+            dataset,
+            seq_length=max_tokens,
+            buffer_size=packing_buffer_size,
+            micro_batch_size=micro_batch_size,
+        )
+
+    encode = functools.partial(encode_pretraining, tokenizer, max_tokens)
     dataset = dataset.map(
         encode,
         batched=True,
@@ -1,19 +1,41 @@
 # pylint: skip-file
+import functools
 import hashlib
 import itertools
+import json
 import logging
 import math
-import time
-from queue import Queue
+import os
+import shutil
+import traceback
+import uuid
+from pathlib import Path
+from queue import Empty, Queue
 from threading import Thread
-from typing import Any, Callable, List, Union
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
 
 import numba
 import numpy as np
-from torch.utils.data import DistributedSampler, Sampler
+import pyarrow as pa
+import pyarrow.compute as pc
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, DistributedSampler, Sampler
+
+from axolotl.utils.token_store import TokenStore
 
 LOG = logging.getLogger("axolotl.utils.dataloader")
 
+# default `a*len + b*len^2` cost of a sequence for the balanced packer, dense matmuls
+# against attention for a hidden size of 4096 (24*h^2 vs 4*h*len FLOPs per token)
+DEFAULT_PACKING_COST = (1.0, 1.0 / 24576)
+
+# seconds to wait on a collate worker before checking it's still alive
+COLLATE_WORKER_POLL_INTERVAL = 5.0
+
+# packing plans kept in a plan directory, every (epoch, rank, seed, packer, cost)
+# gets its own, the least recently used are removed when a new one is saved
+MAX_PACKING_PLANS = 64
+
 
 @numba.njit
 def ffd_check(a: np.ndarray, c: int, n: int):
@@ -113,6 +135,307 @@ def allocate(
     return result, result_totseqs, s, len(result) * c * n
 
 
+@numba.njit
+def _next_pool(lengths, pending, pos, capacity):
+    """
+    Candidate pool for the next group of bins: the deferred items followed by fresh
+    items in sampler order, until the pool holds at least `capacity` tokens
+    """
+    pool_len = 0
+    for idx in pending:
+        pool_len += lengths[idx]
+    end = pos
+    while end < len(lengths) and pool_len < capacity:
+        pool_len += lengths[end]
+        end += 1
+    pool = np.empty((len(pending) + end - pos,), dtype=np.int64)
+    pool[: len(pending)] = pending
+    pool[len(pending) :] = np.arange(pos, end)
+    return pool, end
+
+
+@numba.njit
+def _collect_rank(pool, assignment, rank, n):
+    """
+    Split one group of packed items into the bin for `rank` and the deferred items.
+    Items assigned -1 are deferred, items assigned -2 are dropped.
+    """
+    in_rank = 0
+    deferred = 0
+    used_bins = np.zeros((n,), dtype=np.bool_)
+    for k in range(len(pool)):
+        if assignment[k] >= 0:
+            used_bins[assignment[k]] = True
+            if assignment[k] == rank:
+                in_rank += 1
+        elif assignment[k] == -1:
+            deferred += 1
+    rank_bin = np.empty((in_rank,), dtype=np.int64)
+    pending = np.empty((deferred,), dtype=np.int64)
+    i = 0
+    j = 0
+    tot_seqs = 0
+    for k in range(len(pool)):
+        if assignment[k] >= 0:
+            tot_seqs += 1
+            if assignment[k] == rank:
+                rank_bin[i] = pool[k]
+                i += 1
+        elif assignment[k] == -1:
+            pending[j] = pool[k]
+            j += 1
+    return rank_bin, pending, used_bins.all(), tot_seqs
+
+
+@numba.njit
+def _merge_longest_first(lengths: np.ndarray, pending: np.ndarray, fresh: np.ndarray):
+    # merge two pools that are ordered longest first, pending items go first among
+    # items of the same length
+    merged = np.empty((len(pending) + len(fresh),), dtype=np.int64)
+    i = 0
+    j = 0
+    for k in range(len(merged)):
+        if j == len(fresh) or (
+            i < len(pending) and lengths[pending[i]] >= lengths[fresh[j]]
+        ):
+            merged[k] = pending[i]
+            i += 1
+        else:
+            merged[k] = fresh[j]
+            j += 1
+    return merged
+
+
+@numba.njit
+def bfd_pack(lengths: np.ndarray, pool: np.ndarray, c: int, n: int, presorted=False):
+    # Best-fit-decreasing into n bins of capacity c, keeping the remaining bin
+    # capacities sorted so each placement is a binary search
+    # `presorted` pools are already ordered longest first
+    # returns the bin of each pool item, -1 for items deferred to the next group
+    if presorted:
+        order = np.arange(len(pool))
+    else:
+        order = np.argsort(-lengths[pool], kind="mergesort")
+    remaining = np.full((n,), c, dtype=np.int64)
+    bin_ids = np.arange(n)
+    assignment = np.full((len(pool),), -1, dtype=np.int64)
+    smallest = lengths[pool[order[-1]]] if len(pool) else 0
+    for k in order:
+        if remaining[n - 1] < smallest:
+            # no bin has room for any remaining item
+            break
+        size = lengths[pool[k]]
+        slot = np.searchsorted(remaining, size)
+        if slot == n:
+            continue
+        assignment[k] = bin_ids[slot]
+        remaining[slot] -= size
+        # restore ascending order of remaining capacities
+        while slot > 0 and remaining[slot - 1] > remaining[slot]:
+            remaining[slot - 1], remaining[slot] = remaining[slot], remaining[slot - 1]
+            bin_ids[slot - 1], bin_ids[slot] = bin_ids[slot], bin_ids[slot - 1]
+            slot -= 1
+    return assignment
+
+
+@numba.njit
+def balanced_pack(
+    lengths: np.ndarray, pool: np.ndarray, c: int, n: int, cost_a: float, cost_b: float
+):
+    # Longest-processing-time-first over the estimated compute of each item: the most
+    # expensive remaining item goes to the cheapest bin that still has room for it, so
+    # the long sequences are spread over the ranks instead of the tokens alone
+    # returns the bin of each pool item, -1 for items deferred to the next group
+    pool_lengths = lengths[pool].astype(np.float64)
+    costs = cost_a * pool_lengths + cost_b * pool_lengths * pool_lengths
+    order = np.argsort(-costs, kind="mergesort")
+    remaining = np.full((n,), c, dtype=np.int64)
+    bin_costs = np.zeros((n,), dtype=np.float64)
+    assignment = np.full((len(pool),), -1, dtype=np.int64)
+    for k in order:
+        size = lengths[pool[k]]
+        best = -1
+        for bin_id in range(n):
+            if remaining[bin_id] >= size and (
+                best < 0 or bin_costs[bin_id] < bin_costs[best]
+            ):
+                best = bin_id
+        if best < 0:
+            continue
+        assignment[k] = best
+        remaining[best] -= size
+        bin_costs[best] += costs[k]
+    return assignment
+
+
+@numba.njit
+def allocate_bfd(
+    lengths: np.ndarray, lengths_cumsum: np.ndarray, rank: int, c: int, n: int
+):
+    """
+    Group-at-a-time best-fit-decreasing allocator. Items that don't fit into the
+    current group of n bins are carried over to the next one instead of re-running
+    the packing for every probe of a binary search.
+    Packs tighter than `allocate`, at least as fast on a single rank and several times
+    faster across ranks (1M samples, 4096 x 8 tokens per bin).
+    Same signature and return values as `allocate`.
+    """
+    return _allocate_pooled(lengths, rank, c, n, 0)
+
+
+@numba.njit
+def allocate_balanced(
+    lengths: np.ndarray,
+    lengths_cumsum: np.ndarray,
+    rank: int,
+    c: int,
+    n: int,
+    cost_a: float = DEFAULT_PACKING_COST[0],
+    cost_b: float = DEFAULT_PACKING_COST[1],
+):
+    """
+    Group-at-a-time allocator balancing the estimated compute `a*len + b*len^2` of
+    the bins of each step across ranks rather than only their tokens.
+    Same signature and return values as `allocate`.
+    """
+    return _allocate_pooled(lengths, rank, c, n, 1, cost_a, cost_b)
+
+
+@numba.njit
+def _allocate_pooled(
+    lengths: np.ndarray,
+    rank: int,
+    c: int,
+    n: int,
+    method: int,
+    cost_a: float = 1.0,
+    cost_b: float = 0.0,
+):
+    # one extra bin worth of lookahead so the packer can pick better fits
+    capacity = c * n + c
+    pending = np.empty((0,), dtype=np.int64)
+    pos = 0
+    total_used = 0
+    result = []
+    result_totseqs = []
+    while True:
+        if method == 0:
+            # best-fit-decreasing defers the shortest items, so the pending items
+            # pile up. They are kept longest first, and only the fresh items of the
+            # group get sorted before both are merged.
+            pool, pos = _next_pool(lengths, pending, pos, capacity)
+            fresh = pool[len(pending) :]
+            fresh = fresh[np.argsort(-lengths[fresh], kind="mergesort")]
+            pool = _merge_longest_first(lengths, pending, fresh)
+            if len(pool) == 0:
+                break
+            assignment = bfd_pack(lengths, pool, c, n, True)
+        else:
+            pool, pos = _next_pool(lengths, pending, pos, capacity)
+            if len(pool) == 0:
+                break
+            assignment = balanced_pack(lengths, pool, c, n, cost_a, cost_b)
+        group_used = 0
+        for k in range(len(pool)):
+            if assignment[k] >= 0:
+                group_used += lengths[pool[k]]
+            elif not 0 < lengths[pool[k]] <= c:
+                # samples that can't fit in any bin would be deferred forever
+                assignment[k] = -2
+        rank_bin, pending, all_bins_used, tot_seqs = _collect_rank(
+            pool, assignment, rank, n
+        )
+        if not all_bins_used:
+            # mirror `allocate`, which stops once the tail can't fill every rank
+            break
+        total_used += group_used
+        if method == 0:
+            # back to sampler order
+            rank_bin = np.sort(rank_bin)
+        result.append(rank_bin)
+        result_totseqs.append(tot_seqs)
+    return result, result_totseqs, total_used, len(result) * c * n
+
+
+PACKERS = {
+    "multifit": allocate,
+    "bfd": allocate_bfd,
+    "balanced": allocate_balanced,
+}
+
+
+def get_packer(name: Optional[str], cost: Optional[Sequence[float]] = None) -> Callable:
+    name = name or "multifit"
+    if name not in PACKERS:
+        raise ValueError(
+            f"unknown sample packing packer: {name}, choose one of {list(PACKERS)}"
+        )
+    if name == "balanced":
+        cost_a, cost_b = cost or DEFAULT_PACKING_COST
+        return functools.partial(
+            allocate_balanced, cost_a=float(cost_a), cost_b=float(cost_b)
+        )
+    return PACKERS[name]
+
+
+def packer_key(name: Optional[str], cost: Optional[Sequence[float]] = None) -> str:
+    """identifies the packer and its cost model in packing plan and stats keys"""
+    name = name or "multifit"
+    if name == "balanced":
+        cost_a, cost_b = cost or DEFAULT_PACKING_COST
+        return f"{name}:{float(cost_a)!r}:{float(cost_b)!r}"
+    return name
+
+
+def packing_cost(lengths: np.ndarray, cost: Optional[Sequence[float]] = None):
+    """estimated compute `a*len + b*len^2` of sequences of `lengths`"""
+    cost_a, cost_b = cost or DEFAULT_PACKING_COST
+    lengths = np.asarray(lengths, dtype=np.float64)
+    return cost_a * lengths + cost_b * lengths * lengths
+
+
+def simulate_packing(
+    lengths: np.ndarray,
+    c: int,
+    n: int,
+    packer: Optional[str] = None,
+    cost: Optional[Sequence[float]] = None,
+) -> Dict[str, Any]:
+    """
+    Pack `lengths` (in sampler order) for all `n` ranks and estimate the compute of
+    every rank at every step with the cost model. Reports how much longer the slowest
+    rank of each step takes than the average rank, which the others spend waiting at
+    the gradient all-reduce.
+    """
+    allocator = get_packer(packer, cost)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    per_rank = [
+        allocator(
+            lengths=lengths, lengths_cumsum=np.cumsum(lengths), rank=rank, c=c, n=n
+        )
+        for rank in range(n)
+    ]
+    num_steps = len(per_rank[0][0])
+    step_costs = np.zeros((num_steps, n), dtype=np.float64)
+    for rank, (bins, _, _, _) in enumerate(per_rank):
+        for step, rank_bin in enumerate(bins):
+            step_costs[step, rank] = packing_cost(lengths[rank_bin], cost).sum()
+    _, _, total_used, total_slots = per_rank[0]
+    slowest = step_costs.max(axis=1) if num_steps else np.zeros((0,))
+    mean = step_costs.mean(axis=1) if num_steps else np.zeros((0,))
+    imbalance = slowest / np.maximum(mean, 1e-12)
+    return {
+        "steps": num_steps,
+        "efficiency": total_used / total_slots if total_slots else 0.0,
+        "step_costs": step_costs,
+        # max / mean rank cost of each step
+        "imbalance_mean": float(imbalance.mean()) if num_steps else 1.0,
+        "imbalance_p99": float(np.percentile(imbalance, 99)) if num_steps else 1.0,
+        # share of the ranks' step time spent waiting for the slowest rank
+        "idle_fraction": float(1 - mean.sum() / slowest.sum()) if num_steps else 0.0,
+    }
+
+
 def chunk(iterable, n):
     """
     Chunk data into tuples of length n
@@ -125,17 +448,354 @@ def chunk(iterable, n):
         yield batch
 
 
-def hash_indices(lst: List[int]) -> str:
-    # Convert the list of integers to a string representation
-    concatenated = ",".join(map(str, lst))
-
-    # Generate the hash
+def hash_indices(lst: Union[List[int], np.ndarray]) -> str:
+    # Generate the hash over the raw int64 buffer of the indices
     sha256 = hashlib.sha256()
-    sha256.update(concatenated.encode())
+    sha256.update(np.ascontiguousarray(lst, dtype=np.int64).tobytes())
 
     return sha256.hexdigest()
 
 
+def save_packing_plan(
+    path: Path,
+    batches: List[np.ndarray],
+    totseqs: List[int],
+    total_used: int,
+    total_slots: int,
+    meta: Optional[Dict[str, Any]] = None,
+):
+    """
+    Persist a packing plan as flat .npy arrays so it can be memory-mapped on reload
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f"{path.name}.tmp-{uuid.uuid4().hex}")
+    tmp_path.mkdir(parents=True)
+    bin_offsets = np.zeros((len(batches) + 1,), dtype=np.int64)
+    np.cumsum([len(b) for b in batches], out=bin_offsets[1:])
+    flat = np.concatenate(batches) if batches else np.empty((0,), dtype=np.int64)
+    np.save(tmp_path / "bins.npy", flat.astype(np.int64, copy=False))
+    np.save(tmp_path / "bin_offsets.npy", bin_offsets)
+    np.save(tmp_path / "totseqs.npy", np.asarray(totseqs, dtype=np.int64))
+    with open(tmp_path / "stats.json", "w", encoding="utf-8") as fout:
+        json.dump(
+            {
+                "total_used": int(total_used),
+                "total_slots": int(total_slots),
+                **(meta or {}),
+            },
+            fout,
+        )
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another process already wrote the same plan
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    prune_packing_plans(path.parent, MAX_PACKING_PLANS)
+
+
+def prune_packing_plans(plan_dir: Path, keep: int = MAX_PACKING_PLANS):
+    """
+    Remove all but the `keep` most recently used plans in `plan_dir`. Loading a plan
+    touches it, so the plans of the current run are the last to go.
+    """
+    plans = []
+    for path in Path(plan_dir).iterdir():
+        if ".tmp-" in path.name:
+            # still being written
+            continue
+        try:
+            plans.append((path.stat().st_mtime, path))
+        except FileNotFoundError:
+            # removed by another process in the meantime
+            continue
+    plans.sort(reverse=True)
+    for _, path in plans[keep:]:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def load_packing_plan(path: Path) -> Tuple[List[np.ndarray], np.ndarray, int, int]:
+    """
+    Load a packing plan written by `save_packing_plan`, bins are views into the mmap
+    """
+    path = Path(path)
+    flat = np.load(path / "bins.npy", mmap_mode="r")
+    try:
+        os.utime(path)
+    except OSError:
+        # read only plan directory, the plan just isn't marked as used
+        pass
+    bin_offsets = np.load(path / "bin_offsets.npy")
+    totseqs = np.load(path / "totseqs.npy")
+    with open(path / "stats.json", encoding="utf-8") as fin:
+        stats = json.load(fin)
+    batches = np.split(flat, bin_offsets[1:-1]) if len(bin_offsets) > 1 else []
+    return batches, totseqs, stats["total_used"], stats["total_slots"]
+
+
+def default_packing_plan_dir(dataset: Any) -> Optional[Path]:
+    """
+    Store packing plans alongside the arrow files backing the dataset, if any
+    """
+    cache_files = getattr(dataset, "cache_files", None)
+    if not cache_files:
+        return None
+    return Path(cache_files[0]["filename"]).parent / "packing_plans"
+
+
+def get_dataset_lengths(dataset: Any, column: str = "input_ids") -> np.ndarray:
+    """
+    Per-row lengths of a list column, read from the arrow offsets
+    """
+    if isinstance(dataset, TokenStore):
+        return dataset.lengths.astype(np.int64, copy=False)
+    lengths = pc.list_value_length(dataset.data.column(column)).to_numpy(
+        zero_copy_only=False
+    )
+    indices = getattr(dataset, "_indices", None)
+    if indices is not None:
+        lengths = lengths[indices.column(0).to_numpy()]
+    return lengths.astype(np.int64, copy=False)
+
+
+def packing_plan_path(
+    plan_dir: Optional[Path],
+    dataset: Any,
+    indices_hash: str,
+    packer: str,
+    c: int,
+    n: int,
+    rank: int = 0,
+) -> Optional[Path]:
+    fingerprint = getattr(dataset, "_fingerprint", None)
+    if not plan_dir or not fingerprint:
+        return None
+    # the sampled indices already capture the sampler seed, epoch and rank, unless
+    # the packer splits the bins of all ranks itself
+    key = [fingerprint, indices_hash, packer, str(c), str(n)]
+    if n > 1:
+        key.append(str(rank))
+    plan_hash = hashlib.sha256("|".join(key).encode()).hexdigest()
+    return Path(plan_dir) / plan_hash
+
+
+def generate_packing_plan(
+    dataset: Any,
+    lengths: np.ndarray,
+    indices: np.ndarray,
+    c: int,
+    n: int = 1,
+    rank: int = 0,
+    packer: Optional[str] = None,
+    plan_dir: Optional[Path] = None,
+    meta: Optional[Dict[str, Any]] = None,
+    packing_cost: Optional[Sequence[float]] = None,
+) -> Tuple[List[np.ndarray], Any, int, int]:
+    """
+    Pack the samples in `indices` (in sampler order) into bins of `c` tokens, reusing
+    a persisted plan from `plan_dir` when one exists for the same inputs.
+    Returns the bins for `rank` as dataset indices, the total sequences per step and
+    the used/available token slots.
+    """
+    packer = packer or "multifit"
+    indices_hash = hash_indices(indices)
+    LOG.info(indices_hash)
+    plan_path = packing_plan_path(
+        plan_dir, dataset, indices_hash, packer_key(packer, packing_cost), c, n, rank
+    )
+    if plan_path and plan_path.exists():
+        LOG.info(f"loading packing plan from {plan_path}")
+        return load_packing_plan(plan_path)
+
+    sampled_lengths = lengths[indices]
+    batches, totseqs, total_used, total_slots = get_packer(packer, packing_cost)(
+        lengths=sampled_lengths,
+        lengths_cumsum=np.cumsum(sampled_lengths),
+        rank=rank,
+        c=c,
+        n=n,
+    )
+    batches = [indices[np.asarray(batch, dtype=np.int64)] for batch in batches]
+    if plan_path:
+        LOG.info(f"saving packing plan to {plan_path}")
+        save_packing_plan(
+            plan_path,
+            batches,
+            totseqs,
+            total_used,
+            total_slots,
+            meta={"num_samples": len(indices), **(meta or {})},
+        )
+    return batches, totseqs, total_used, total_slots
+
+
+def exact_epoch_indices(num_rows: int, seed: int, epoch: int) -> np.ndarray:
+    """
+    Sample order of `epoch` when packing with an exact epoch length. It is the same
+    on every rank, the packer splits the bins between ranks.
+    """
+    return np.random.default_rng([seed, epoch]).permutation(num_rows)
+
+
+def exact_num_batches(
+    dataset: Any,
+    lengths: np.ndarray,
+    c: int,
+    bins_per_batch: int = 1,
+    n: int = 1,
+    rank: int = 0,
+    seed: int = 42,
+    num_epochs: int = 1,
+    packer: Optional[str] = None,
+    plan_dir: Optional[Path] = None,
+    packing_cost: Optional[Sequence[float]] = None,
+) -> int:
+    """
+    Number of batches every rank gets in each of epochs 1..num_epochs, which is the
+    fewest batches any of those epochs packs into
+    """
+    num_batches = []
+    for epoch in range(1, num_epochs + 1):
+        batches, _, _, _ = generate_packing_plan(
+            dataset,
+            lengths,
+            exact_epoch_indices(len(lengths), seed, epoch),
+            c=c,
+            n=n,
+            rank=rank,
+            packer=packer,
+            plan_dir=plan_dir,
+            meta={"epoch": epoch, "seed": seed},
+            packing_cost=packing_cost,
+        )
+        num_batches.append(math.ceil(len(batches) / bins_per_batch))
+    return min(num_batches)
+
+
+def _flatten_list_column(column: Union[pa.Array, pa.ChunkedArray]) -> np.ndarray:
+    """
+    Return the flattened values of an arrow list column as a numpy array
+    """
+    chunks = column.chunks if isinstance(column, pa.ChunkedArray) else [column]
+    values = [chunk.flatten().to_numpy(zero_copy_only=False) for chunk in chunks]
+    if not values:
+        return np.empty((0,), dtype=np.int64)
+    if len(values) == 1:
+        return values[0]
+    return np.concatenate(values)
+
+
+class PackedBatchAssembler:
+    """
+    Builds the concatenated per-bin feature arrays for packed batches directly from the
+    dataset's arrow list columns. All rows of a group of bins are gathered with a single
+    bulk `take` per feature and split back into bins using the list offsets, so no
+    python objects are created per row.
+    """
+
+    def __init__(self, dataset: Any, features: Sequence[str] = None):
+        if features is None:
+            features = dataset.features.keys()
+        self.features = [feature for feature in features if feature != "length"]
+        # position_ids aren't materialized for packing, they're derived from the row
+        # lengths like the per-sample attention_mask numbering
+        self.derive_position_ids = (
+            "position_ids" not in self.features and "input_ids" in self.features
+        )
+        # token stores hand out the slices of their memory-mapped buffers directly
+        self.token_store = dataset if isinstance(dataset, TokenStore) else None
+        if self.token_store is not None:
+            return
+        self.columns = {
+            feature: dataset.data.column(feature) for feature in self.features
+        }
+        # respect any indices mapping left behind by shuffle/select
+        indices = getattr(dataset, "_indices", None)
+        self.indices_map = indices.column(0).to_numpy() if indices is not None else None
+
+    def __call__(self, bins: Sequence[Sequence[int]]) -> List[Dict[str, np.ndarray]]:
+        bin_sizes = np.fromiter((len(b) for b in bins), dtype=np.int64, count=len(bins))
+        rows = np.fromiter(
+            itertools.chain.from_iterable(bins),
+            dtype=np.int64,
+            count=int(bin_sizes.sum()),
+        )
+        bin_row_bounds = np.cumsum(bin_sizes)[:-1]
+        packed: List[Dict[str, np.ndarray]] = [{} for _ in bins]
+        if self.token_store is not None:
+            gathered = self.token_store.gather(rows)
+            lengths = gathered.pop("lengths")
+            if "attention_mask" in gathered:
+                gathered["attention_mask"] = np.repeat(
+                    np.arange(1, len(lengths) + 1, dtype=np.int64), lengths
+                )
+            split_at = np.cumsum(lengths)[bin_row_bounds - 1]
+            for feature in self.features:
+                for bin_data, bin_values in zip(
+                    packed, np.split(gathered[feature], split_at)
+                ):
+                    bin_data[feature] = bin_values
+            return packed
+
+        if self.indices_map is not None:
+            rows = self.indices_map[rows]
+        rows = pa.array(rows)
+        for feature, column in self.columns.items():
+            taken = column.take(rows)
+            lengths = pc.list_value_length(taken).to_numpy(zero_copy_only=False)
+            values = _flatten_list_column(taken).astype(np.int64, copy=False)
+            if feature == "attention_mask":
+                # number each sample sequentially across the whole group of bins
+                values = values * np.repeat(
+                    np.arange(1, len(lengths) + 1, dtype=np.int64), lengths
+                )
+            offsets = np.cumsum(lengths)
+            for bin_data, bin_values in zip(
+                packed, np.split(values, offsets[bin_row_bounds - 1])
+            ):
+                bin_data[feature] = bin_values
+            if feature == "input_ids" and self.derive_position_ids:
+                position_ids = np.arange(offsets[-1] if len(offsets) else 0) - (
+                    np.repeat(offsets - lengths, lengths)
+                )
+                for bin_data, bin_values in zip(
+                    packed, np.split(position_ids, offsets[bin_row_bounds - 1])
+                ):
+                    bin_data["position_ids"] = bin_values
+        return packed
+
+
+def _collate_worker(
+    assembler: PackedBatchAssembler,
+    collate_fn: Callable,
+    groups: List[Any],
+    worker_id: int,
+    num_workers: int,
+    out_queue: Any,
+    done_event: Any,
+):
+    """
+    Collate every `num_workers`-th group of bins, starting at `worker_id`. Tensors put on
+    the queue are moved to shared memory, and the put blocks while the queue is full.
+    An exception is put on the queue as a `CollateWorkerError` for the main process to
+    raise.
+    """
+    try:
+        for group in itertools.islice(groups, worker_id, None, num_workers):
+            out_queue.put(collate_fn(assembler(group)))
+    except Exception:  # pylint: disable=broad-except
+        out_queue.put(
+            CollateWorkerError(
+                f"collate worker {worker_id} failed:\n{traceback.format_exc()}"
+            )
+        )
+    # shared memory tensors are only valid while the producing process is alive
+    done_event.wait()
+
+
+class CollateWorkerError(RuntimeError):
+    """raised in the main process when a collate worker fails or dies"""
+
+
 class MultipackDistributedDataloader:
     """Unpadded data loading using Multipack.
     Adapted from https://github.com/imoneoi/openchat/blob/v3_fix_mle_loss/ochat/training_deepspeed/multipack_dataloader.py
@@ -154,15 +814,16 @@ class MultipackDistributedDataloader:
         device_count: int = 1,
         prefetch_max: int = 1000,
         num_epochs: int = 1,
+        num_workers: int = 0,
+        packing_plan_dir: Optional[Union[str, Path]] = None,
+        packer: Optional[str] = None,
+        exact_length: bool = False,
+        seed: Optional[int] = None,
+        packing_cost: Optional[Sequence[float]] = None,
     ):
         # Dataset
         self.dataset = dataset
-        self.lengths = (
-            dataset.data.column("position_ids")
-            .to_pandas()
-            .apply(lambda x: x[-1] + 1)
-            .values
-        )
+        self.lengths = get_dataset_lengths(dataset)
         assert isinstance(self.lengths, np.ndarray)
         assert batch_size % sample_packing_seq_len_multiplier == 0
         assert batch_size >= sample_packing_seq_len_multiplier
@@ -173,9 +834,23 @@ class MultipackDistributedDataloader:
         self.batch_max_length = batch_size * seq_max_length
         self.collate_fn = collate_fn
         self.num_epochs = num_epochs
+        self.packer = packer or "multifit"
+        self.packing_cost = packing_cost
+        get_packer(self.packer, packing_cost)
+        self.assembler = PackedBatchAssembler(dataset)
 
         self.num_replicas = 1
         self.rank = 0
+        # with an exact length every rank packs the same seeded order of the whole
+        # dataset, taking its own share of each step's bins, instead of packing what
+        # the sampler gives it
+        self.exact_length = exact_length
+        self.seed = seed if seed is not None else getattr(sampler, "seed", 42)
+        self.epoch = 0
+        self._exact_len: Optional[int] = None
+        if exact_length and isinstance(sampler, DistributedSampler):
+            self.num_replicas = sampler.num_replicas
+            self.rank = sampler.rank
 
         # statistics
         self.eff_total_used = 0
@@ -187,62 +862,122 @@ class MultipackDistributedDataloader:
         self.prefetch_max = prefetch_max
         self.queue: Queue = Queue(maxsize=prefetch_max)
         self.thread = None
+        # number of collation processes, 0 collates in a background thread
+        self.num_workers = num_workers
+        self.packing_plan_dir = (
+            Path(packing_plan_dir)
+            if packing_plan_dir
+            else default_packing_plan_dir(dataset)
+        )
+
+        # position of the consumer: the epoch of the current pass and the batches of
+        # it handed out so far, and where the next pass starts when resuming
+        self.iter_epoch = self.epoch if exact_length else getattr(sampler, "epoch", 0)
+        self.batches_yielded = 0
+        self._resume_start = 0
 
-    def _worker(self):
+    def _worker(self, first_epoch: int, start: int):
         LOG.info(
             f"[WORKER] Epochs: {self.num_epochs}, Samples: {self.len_w_stats()*self.batch_size}"
         )
         for epoch in range(self.num_epochs):
-            for sample in self._internal_batch_generator():
-                while True:
-                    if self.queue.full():
-                        time.sleep(1)
-                    else:
-                        break
+            for sample in self._internal_batch_generator(
+                first_epoch + epoch, start if epoch == 0 else 0
+            ):
+                # blocks until the consumer frees a slot
                 self.queue.put(sample)
 
             # stop the queue when epoch is done
             self.queue.put(None)
 
     def __iter__(self):
-        if hasattr(self.sampler, "set_epoch"):
-            new_epoch = self.sampler.epoch + 1
-            self.sampler.set_epoch(new_epoch)
-            LOG.info(f"calling sampler.set_epoch({new_epoch})")
+        epoch, start = self.iter_epoch + 1, self._resume_start
+        self.iter_epoch, self.batches_yielded, self._resume_start = epoch, start, 0
 
-        if self.thread is None:
-            self.thread = Thread(target=self._worker, daemon=True)
-            self.thread.start()
+        if self.num_workers > 0:
+            batches = self._internal_batch_generator(epoch, start)
+        else:
+            if self.thread is None:
+                self.thread = Thread(
+                    target=self._worker, args=(epoch, start), daemon=True
+                )
+                self.thread.start()
+            batches = iter(self.queue.get, None)
 
-        while True:
-            item = self.queue.get()
+        for batch in batches:
+            self.batches_yielded += 1
+            yield batch
 
-            if item is None:
-                break
-            yield item
+    def state_dict(self) -> Dict[str, Any]:
+        """
+        Position of the next batch, as the epoch and the batches of it already handed
+        out, to resume from without repacking or collating the skipped batches
+        """
+        epoch, batches = self.iter_epoch, self.batches_yielded
+        if batches == 0 or batches >= len(self):
+            # between passes
+            epoch, batches = epoch + 1, 0
+        return {
+            "epoch": epoch,
+            "batches": batches,
+            "seed": self.seed,
+            "sampler_seed": getattr(self.sampler, "seed", None),
+            "exact_length": self.exact_length,
+            "num_replicas": self.num_replicas,
+        }
+
+    def load_state_dict(self, state: Dict[str, Any]):
+        """resume the next pass at the position saved by `state_dict`"""
+        if self.thread is not None:
+            raise RuntimeError("can't resume a dataloader that's already iterating")
+        expected = {
+            "seed": self.seed,
+            "sampler_seed": getattr(self.sampler, "seed", None),
+            "exact_length": self.exact_length,
+            "num_replicas": self.num_replicas,
+        }
+        for key, value in expected.items():
+            if state.get(key) != value:
+                raise ValueError(
+                    f"dataloader state has {key}={state.get(key)}, expected {value}"
+                )
+        self.iter_epoch = state["epoch"] - 1
+        self._resume_start = state["batches"]
+        LOG.info(
+            f"resuming packed batches at epoch {state['epoch']}, "
+            f"batch {state['batches']}"
+        )
 
     def generate_batches(self, set_stats=False):
         LOG.info("generating packed batches")
-        if self.sampler:
-            indices = [idx for idx in self.sampler]
+        if self.exact_length:
+            indices = exact_epoch_indices(len(self.dataset), self.seed, self.epoch)
+        elif self.sampler:
+            indices = np.fromiter(self.sampler, dtype=np.int64)
         else:
-            indices = range(0, len(self.dataset))
-
-        LOG.info(hash_indices(indices))
-        lengths = self.lengths[indices]
-        lengths_cumsum = np.cumsum(lengths)
+            indices = np.arange(0, len(self.dataset), dtype=np.int64)
 
-        batches, totseqs, total_used, total_slots = allocate(
-            lengths=lengths,
-            lengths_cumsum=lengths_cumsum,
-            rank=self.rank,
+        batches, totseqs, total_used, total_slots = generate_packing_plan(
+            self.dataset,
+            self.lengths,
+            indices,
             # c=self.batch_max_length,
             c=self.seq_max_length * self.sample_packing_seq_len_multiplier,
             n=self.num_replicas,
+            rank=self.rank,
+            packer=self.packer,
+            plan_dir=self.packing_plan_dir,
+            meta=(
+                {"epoch": self.epoch, "seed": self.seed}
+                if self.exact_length
+                else {
+                    "epoch": getattr(self.sampler, "epoch", None),
+                    "seed": getattr(self.sampler, "seed", None),
+                }
+            ),
+            packing_cost=self.packing_cost,
         )
 
-        batches = [[indices[b_idx] for b_idx in batch] for batch in batches]
-
         # statistics
         if set_stats:
             self.eff_total_used += total_used
@@ -250,38 +985,99 @@ class MultipackDistributedDataloader:
 
         return batches, totseqs
 
-    def _internal_batch_generator(self):
+    def _multiprocess_collate(self, groups):
+        """
+        collate groups of bins in worker processes, yielding them back in order
+        """
+        ctx = mp.get_context()
+        maxsize = max(1, self.prefetch_max // self.num_workers)
+        queues = [ctx.Queue(maxsize=maxsize) for _ in range(self.num_workers)]
+        done_event = ctx.Event()
+        workers = [
+            ctx.Process(
+                target=_collate_worker,
+                args=(
+                    self.assembler,
+                    self.collate_fn,
+                    groups,
+                    worker_id,
+                    self.num_workers,
+                    queues[worker_id],
+                    done_event,
+                ),
+                daemon=True,
+            )
+            for worker_id in range(self.num_workers)
+        ]
+        for worker in workers:
+            worker.start()
+        try:
+            for idx in range(len(groups)):
+                worker_id = idx % self.num_workers
+                while True:
+                    try:
+                        batch = queues[worker_id].get(
+                            timeout=COLLATE_WORKER_POLL_INTERVAL
+                        )
+                        break
+                    except Empty:
+                        worker = workers[worker_id]
+                        # workers stay alive until done_event is set
+                        if not worker.is_alive():
+                            raise CollateWorkerError(
+                                f"collate worker {worker_id} exited unexpectedly "
+                                f"with exit code {worker.exitcode}"
+                            ) from None
+                if isinstance(batch, CollateWorkerError):
+                    raise batch
+                yield batch
+        finally:
+            done_event.set()
+            for worker in workers:
+                worker.join(timeout=5)
+                if worker.is_alive():
+                    worker.terminate()
+
+    def _internal_batch_generator(self, epoch: int, start: int = 0):
+        """
+        collated batches of `epoch`, from its `start`-th batch on. The skipped batches
+        are packed with the rest of the epoch but never assembled or collated.
+        """
+        if self.exact_length:
+            self.epoch = epoch
+        elif hasattr(self.sampler, "set_epoch"):
+            self.sampler.set_epoch(epoch)
+            LOG.info(f"calling sampler.set_epoch({epoch})")
         all_batches, _ = self.generate_batches(set_stats=True)
-        features = self.dataset.features.keys()
-        len_remaining = self._len_est()
-        for batches in chunk(
-            all_batches, self.batch_size // self.sample_packing_seq_len_multiplier
-        ):
-            chunked_data = []
-            attn_mask_cum_idx = 0
-            for batch in batches:
-                concatenated = {}
-                batched_data = [self.dataset[batch_idx] for batch_idx in batch]
-                for feature in features:
-                    if feature == "length":
-                        continue
-                    if feature == "attention_mask":
-                        arrays = [
-                            (attn_mask_cum_idx + idx + 1) * np.array(item[feature])
-                            for idx, item in enumerate(batched_data)
-                            if feature in item
-                        ]
-                        attn_mask_cum_idx += len(batched_data)
-                        concatenated[feature] = np.concatenate(arrays)
-                    else:
-                        arrays = [
-                            np.array(item[feature])
-                            for item in batched_data
-                            if feature in item
-                        ]
-                        concatenated[feature] = np.concatenate(arrays)
-                chunked_data.append(concatenated)
-            yield self.collate_fn(chunked_data)
+        len_remaining = len(self) if self.exact_length else self._len_est()
+        groups = list(
+            chunk(
+                all_batches, self.batch_size // self.sample_packing_seq_len_multiplier
+            )
+        )
+        if start:
+            groups = groups[start:]
+            len_remaining = max(len_remaining - start, 0)
+            if not len_remaining:
+                return
+        if self.exact_length:
+            # every epoch packs into at least len(self) batches, trim to that
+            groups = groups[:len_remaining]
+            collated = (
+                self._multiprocess_collate(groups)
+                if self.num_workers > 0
+                else (self.collate_fn(self.assembler(group)) for group in groups)
+            )
+            yield from collated
+            return
+        if self.num_workers > 0:
+            if len_remaining > 0:
+                groups = groups[:len_remaining]
+            collated = self._multiprocess_collate(groups)
+        else:
+            collated = (self.collate_fn(self.assembler(group)) for group in groups)
+        for batch in collated:
+            yield batch
             len_remaining -= 1
             if not len_remaining:
                 return
@@ -318,7 +1114,27 @@ class MultipackDistributedDataloader:
             - 1
         )
 
+    def _exact_num_batches(self) -> int:
+        if self._exact_len is None:
+            self._exact_len = exact_num_batches(
+                self.dataset,
+                self.lengths,
+                c=self.seq_max_length * self.sample_packing_seq_len_multiplier,
+                bins_per_batch=self.batch_size
+                // self.sample_packing_seq_len_multiplier,
+                n=self.num_replicas,
+                rank=self.rank,
+                seed=self.seed,
+                num_epochs=max(1, int(self.num_epochs)),
+                packer=self.packer,
+                plan_dir=self.packing_plan_dir,
+                packing_cost=self.packing_cost,
+            )
+        return self._exact_len
+
     def __len__(self):
+        if self.exact_length:
+            return self._exact_num_batches()
         # this doesn't return the actual length b/c with distributed samplers, not all dataloaders get
         # the same share of total tokens
         # if not self.eff_total_used:
@@ -330,6 +1146,8 @@ class MultipackDistributedDataloader:
         return max(1, self._len_est())
 
     def len_w_stats(self):
+        if self.exact_length:
+            return len(self)
         if not self.eff_total_used:
             batches, _ = self.generate_batches(set_stats=True)
         LOG.info(
@@ -340,3 +1158,123 @@ class MultipackDistributedDataloader:
 
     def efficiency(self):
         return self.eff_total_used / self.eff_total_slots
+
+
+@numba.njit
+def _split_token_budget(padded_lengths: np.ndarray, max_tokens: int):
+    # padded_lengths are ascending, so the last row of a batch sets its padded width
+    ends = []
+    count = 0
+    for idx, size in enumerate(padded_lengths):
+        if count and (count + 1) * size > max_tokens:
+            ends.append(idx)
+            count = 0
+        count += 1
+    ends.append(len(padded_lengths))
+    return np.array(ends, dtype=np.int64)
+
+
+def token_budget_batches(
+    lengths: np.ndarray,
+    max_tokens: int,
+    seed: int = 42,
+    epoch: int = 0,
+    bucket_size: int = 4096,
+    pad_to_multiple_of: int = 64,
+) -> List[np.ndarray]:
+    """
+    Variable-size batches of dataset indices whose padded size (rows x longest row,
+    rounded up to `pad_to_multiple_of`) fits in `max_tokens`. The rows are shuffled,
+    sorted by length within buckets of `bucket_size` rows so rows of similar length
+    share a batch, and the batches are shuffled again. The same on every rank.
+    """
+    rng = np.random.default_rng([seed, epoch])
+    lengths = np.asarray(lengths, dtype=np.int64)
+    padded = -(-lengths // pad_to_multiple_of) * pad_to_multiple_of
+    order = rng.permutation(len(lengths))
+    batches: List[np.ndarray] = []
+    for start in range(0, len(order), bucket_size):
+        bucket = order[start : start + bucket_size]
+        bucket = bucket[np.argsort(padded[bucket], kind="stable")]
+        ends = _split_token_budget(padded[bucket], max_tokens)
+        batches.extend(np.split(bucket, ends[:-1]))
+    return [batches[idx] for idx in rng.permutation(len(batches))]
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """
+    Batch sampler for unpacked training forming batches of as many rows as fit in a
+    budget of `max_tokens` padded tokens, so short rows aren't batched like long ones.
+
+    Every rank builds the same batches and takes every `num_replicas`-th one. The
+    batches are padded by repeating the first ones (or the remainder dropped with
+    `drop_last`), so all ranks step the same number of times. The epoch advances
+    after every full pass.
+    """
+
+    def __init__(
+        self,
+        lengths: np.ndarray,
+        max_tokens: int,
+        num_replicas: int = 1,
+        rank: int = 0,
+        seed: int = 42,
+        bucket_size: int = 4096,
+        pad_to_multiple_of: int = 64,
+        drop_last: bool = False,
+    ):
+        super().__init__()
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.max_tokens = max_tokens
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.bucket_size = bucket_size
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.drop_last = drop_last
+        self.epoch = 0
+        self._batches: Optional[Tuple[int, List[np.ndarray]]] = None
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def global_batches(self, epoch: Optional[int] = None) -> List[np.ndarray]:
+        """the batches of all ranks in `epoch`, padded or trimmed to split evenly"""
+        epoch = self.epoch if epoch is None else epoch
+        if self._batches is not None and self._batches[0] == epoch:
+            return self._batches[1]
+        batches = token_budget_batches(
+            self.lengths,
+            self.max_tokens,
+            seed=self.seed,
+            epoch=epoch,
+            bucket_size=self.bucket_size,
+            pad_to_multiple_of=self.pad_to_multiple_of,
+        )
+        remainder = len(batches) % self.num_replicas
+        if remainder and self.drop_last:
+            batches = batches[:-remainder]
+        elif remainder:
+            batches = batches + batches[: self.num_replicas - remainder]
+        self._batches = (epoch, batches)
+        return batches
+
+    def __iter__(self):
+        batches = self.global_batches()[self.rank :: self.num_replicas]
+        for batch in batches:
+            yield batch.tolist()
+        self.epoch += 1
+
+    def __len__(self):
+        return len(self.global_batches()) // self.num_replicas
+
+
+class TokenBudgetDataLoader(DataLoader):
+    """
+    DataLoader over a `TokenBudgetBatchSampler`. The trainer sets the epoch at the
+    start of every epoch, including the one a resumed run starts in, rather than
+    relying on every pass running to the end.
+    """
+
+    def set_epoch(self, epoch: int):
+        self.batch_sampler.set_epoch(epoch)
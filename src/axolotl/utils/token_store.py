@@ -0,0 +1,330 @@
+"""
+Flat memory-mapped token store, a compact alternative to `Dataset.save_to_disk`
+for tokenized datasets
+"""
+import hashlib
+import json
+import logging
+import shutil
+import uuid
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Union
+
+import numpy as np
+
+LOG = logging.getLogger("axolotl")
+
+IGNORE_INDEX = -100
+FEATURES = ("input_ids", "attention_mask", "labels", "position_ids")
+# label mask bits unpacked at a time when counting the supervised tokens of rows
+SUPERVISED_TOKENS_CHUNK = 1 << 26
+
+
+class TokenStore:
+    """
+    Tokenized rows stored as one flat buffer of token ids (`uint16` when the vocab
+    allows, else `int32`), a bitmap of the tokens that are trained on and an
+    offsets index, all memory-mapped.
+
+    Only `input_ids` and the label mask are stored: `labels` are the input ids
+    where the mask is set, `attention_mask` is all ones and `position_ids` count
+    up from 0 in every row, which is what the prompt strategies produce. Selections
+    (`select`, `shard`, `train_test_split`) are views through an indices array, the
+    same way `datasets` handles them.
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        indices: Optional[np.ndarray] = None,
+        features: Optional[Sequence[str]] = None,
+        fingerprint: Optional[str] = None,
+    ):
+        self.path = Path(path)
+        with open(self.path / "meta.json", encoding="utf-8") as fin:
+            self.meta = json.load(fin)
+        self.tokens = np.memmap(
+            self.path / "tokens.bin",
+            dtype=self.meta["dtype"],
+            mode="r",
+            shape=(self.meta["num_tokens"],),
+        )
+        self.label_mask = np.memmap(
+            self.path / "label_mask.bin",
+            dtype=np.uint8,
+            mode="r",
+            shape=((self.meta["num_tokens"] + 7) // 8,),
+        )
+        self.offsets = np.load(self.path / "offsets.npy", mmap_mode="r")
+        self._indices = indices
+        self.column_names = list(features or FEATURES)
+        self._fingerprint = fingerprint or self.meta["fingerprint"]
+
+    @classmethod
+    def exists(cls, path: Union[str, Path]) -> bool:
+        return (Path(path) / "meta.json").exists()
+
+    @classmethod
+    def save(
+        cls,
+        dataset,
+        path: Union[str, Path],
+        vocab_size: int,
+        batch_size: int = 10_000,
+    ) -> "TokenStore":
+        """
+        Write a tokenized `datasets.Dataset` as a token store. Raises a ValueError if
+        its labels or attention mask can't be derived from the input ids.
+        """
+        path = Path(path)
+        dtype = np.uint16 if vocab_size <= np.iinfo(np.uint16).max + 1 else np.int32
+        tmp_path = path.with_name(f"{path.name}.tmp-{uuid.uuid4().hex}")
+        tmp_path.mkdir(parents=True)
+        try:
+            cls._write(dataset, tmp_path, vocab_size, dtype, batch_size)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        try:
+            tmp_path.rename(path)
+        except OSError:
+            # another process published the same store first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        return cls(path)
+
+    @staticmethod
+    def _write(dataset, tmp_path: Path, vocab_size: int, dtype, batch_size: int):
+        lengths: List[np.ndarray] = []
+        num_tokens = 0
+        carry = np.zeros((0,), dtype=np.bool_)
+        with open(tmp_path / "tokens.bin", "wb") as tokens_out, open(
+            tmp_path / "label_mask.bin", "wb"
+        ) as mask_out:
+            for batch in dataset.with_format("arrow").iter(batch_size=batch_size):
+                input_ids = batch.column("input_ids").combine_chunks()
+                ids = input_ids.flatten().to_numpy(zero_copy_only=False)
+                offsets = input_ids.offsets.to_numpy()
+                if len(ids) and (ids.min() < 0 or ids.max() >= vocab_size):
+                    raise ValueError("input_ids outside of the tokenizer vocab")
+
+                labels = batch.column("labels").combine_chunks()
+                if not np.array_equal(labels.offsets.to_numpy(), offsets):
+                    raise ValueError("labels and input_ids differ in length")
+                label_values = labels.flatten().to_numpy(zero_copy_only=False)
+                supervised = label_values != IGNORE_INDEX
+                if not np.array_equal(label_values[supervised], ids[supervised]):
+                    raise ValueError("labels that are not the input ids or ignored")
+
+                if "attention_mask" in batch.column_names:
+                    attention_mask = batch.column("attention_mask").combine_chunks()
+                    if not np.all(
+                        attention_mask.flatten().to_numpy(zero_copy_only=False) == 1
+                    ):
+                        raise ValueError("attention_mask with masked out tokens")
+
+                tokens_out.write(ids.astype(dtype).tobytes())
+                # pack the mask bits in whole bytes, carrying the remainder over
+                bits = np.concatenate([carry, supervised])
+                whole = len(bits) - len(bits) % 8
+                mask_out.write(np.packbits(bits[:whole]).tobytes())
+                carry = bits[whole:]
+                lengths.append(np.diff(offsets))
+                num_tokens += len(ids)
+            mask_out.write(np.packbits(carry).tobytes())
+
+        lengths_arr = np.concatenate(lengths) if lengths else np.zeros((0,), np.int64)
+        offsets_arr = np.zeros((len(lengths_arr) + 1,), dtype=np.int64)
+        np.cumsum(lengths_arr, out=offsets_arr[1:])
+        np.save(tmp_path / "offsets.npy", offsets_arr)
+        with open(tmp_path / "meta.json", "w", encoding="utf-8") as fout:
+            json.dump(
+                {
+                    "version": 1,
+                    "dtype": np.dtype(dtype).name,
+                    "num_rows": len(lengths_arr),
+                    "num_tokens": num_tokens,
+                    "fingerprint": getattr(dataset, "_fingerprint", None)
+                    or uuid.uuid4().hex,
+                },
+                fout,
+            )
+
+    def __getstate__(self):
+        # reopen the memmaps instead of pickling their contents
+        return {
+            "path": self.path,
+            "indices": self._indices,
+            "features": self.column_names,
+            "fingerprint": self._fingerprint,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(  # pylint: disable=unnecessary-dunder-call
+            state["path"],
+            indices=state["indices"],
+            features=state["features"],
+            fingerprint=state["fingerprint"],
+        )
+
+    def __len__(self):
+        if self._indices is not None:
+            return len(self._indices)
+        return len(self.offsets) - 1
+
+    def __repr__(self):
+        return f"TokenStore(path={self.path}, num_rows={len(self)}, features={self.column_names})"
+
+    @property
+    def features(self) -> Dict[str, None]:
+        return dict.fromkeys(self.column_names)
+
+    @property
+    def cache_files(self) -> List[Dict[str, str]]:
+        # dataset stats and packing plans are kept next to the first cache file
+        return [{"filename": str(self.path / "tokens.bin")}]
+
+    def _rows(self, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        if rows is None:
+            rows = np.arange(len(self), dtype=np.int64)
+        rows = np.asarray(rows, dtype=np.int64)
+        if self._indices is not None:
+            rows = self._indices[rows]
+        return rows
+
+    def _view(self, rows: np.ndarray, suffix: str) -> "TokenStore":
+        fingerprint = hashlib.sha256(
+            f"{self._fingerprint}|{suffix}".encode("utf-8")
+        ).hexdigest()[:16]
+        return TokenStore(
+            self.path,
+            indices=self._rows(rows),
+            features=self.column_names,
+            fingerprint=fingerprint,
+        )
+
+    @property
+    def lengths(self) -> np.ndarray:
+        lengths = np.diff(self.offsets)
+        if self._indices is not None:
+            lengths = lengths[self._indices]
+        return lengths
+
+    def select(self, indices: Sequence[int]) -> "TokenStore":
+        rows = np.asarray(indices, dtype=np.int64)
+        digest = hashlib.sha256(rows.tobytes()).hexdigest()[:16]
+        return self._view(rows, f"select:{digest}")
+
+    def shard(self, num_shards: int, index: int) -> "TokenStore":
+        # same rows as `Dataset.shard(contiguous=False)`
+        return self._view(
+            np.arange(index, len(self), num_shards), f"shard:{num_shards}:{index}"
+        )
+
+    def filter_lengths(self, min_length: int = 1, max_length: Optional[int] = None):
+        """rows whose length is within [min_length, max_length]"""
+        lengths = self.lengths
+        keep = lengths >= min_length
+        if max_length is not None:
+            keep &= lengths <= max_length
+        if keep.all():
+            return self
+        return self._view(np.flatnonzero(keep), f"lengths:{min_length}:{max_length}")
+
+    def remove_columns(self, column_names: Union[str, Sequence[str]]) -> "TokenStore":
+        if isinstance(column_names, str):
+            column_names = [column_names]
+        store = TokenStore.__new__(TokenStore)
+        store.__dict__.update(self.__dict__)
+        store.column_names = [
+            name for name in self.column_names if name not in column_names
+        ]
+        return store
+
+    def train_test_split(
+        self,
+        test_size: Union[int, float],
+        shuffle: bool = False,
+        seed: Optional[int] = None,
+        train_new_fingerprint: Optional[str] = None,
+        test_new_fingerprint: Optional[str] = None,
+    ) -> Dict[str, "TokenStore"]:
+        """the unshuffled split of `Dataset.train_test_split`"""
+        if shuffle:
+            raise ValueError("TokenStore only supports train_test_split(shuffle=False)")
+        num_test = (
+            int(np.ceil(test_size * len(self)))
+            if isinstance(test_size, float)
+            else int(test_size)
+        )
+        num_train = len(self) - num_test
+        train = self._view(np.arange(num_train), f"train:{test_size}:{seed}")
+        test = self._view(np.arange(num_train, len(self)), f"test:{test_size}:{seed}")
+        if train_new_fingerprint:
+            train._fingerprint = train_new_fingerprint
+        if test_new_fingerprint:
+            test._fingerprint = test_new_fingerprint
+        return {"train": train, "test": test}
+
+    def supervised_tokens(self, shifted: bool = False) -> np.ndarray:
+        """
+        number of tokens with labels in each row, leaving out the first token of every
+        row if `shifted`
+        """
+        offsets = np.asarray(self.offsets, dtype=np.int64)
+        num_rows = len(offsets) - 1
+        per_row = np.zeros((num_rows,), dtype=np.int64)
+        row = 0
+        while row < num_rows:
+            # the rows starting within the next chunk of tokens, at least one
+            end = np.searchsorted(offsets, offsets[row] + SUPERVISED_TOKENS_CHUNK)
+            end = min(max(int(end), row + 1), num_rows)
+            first, last = offsets[row], offsets[end]
+            bit = first & 7
+            bits = np.unpackbits(self.label_mask[first >> 3 : (last + 7) >> 3])[
+                bit : bit + last - first
+            ]
+            nonempty = offsets[row + 1 : end + 1] > offsets[row:end]
+            starts = offsets[row:end][nonempty] - first
+            if len(starts):
+                # consecutive starts of non-empty rows bound each row's tokens
+                counts = np.add.reduceat(bits, starts, dtype=np.int64)
+                if shifted:
+                    counts -= bits[starts]
+                per_row[row:end][nonempty] = counts
+            row = end
+        if self._indices is not None:
+            per_row = per_row[self._indices]
+        return per_row
+
+    def gather(self, rows: Sequence[int]) -> Dict[str, np.ndarray]:
+        """
+        Concatenated features of `rows` with the row lengths, reading only the
+        slices of the memory-mapped buffers that belong to them
+        """
+        rows = self._rows(rows)
+        starts = np.asarray(self.offsets[rows], dtype=np.int64)
+        lengths = np.asarray(self.offsets[rows + 1], dtype=np.int64) - starts
+        # position of every output token within its row, and within the buffer
+        out_starts = np.cumsum(lengths) - lengths
+        position_ids = np.arange(int(lengths.sum()), dtype=np.int64) - np.repeat(
+            out_starts, lengths
+        )
+        positions = np.repeat(starts, lengths) + position_ids
+
+        input_ids = self.tokens[positions].astype(np.int64)
+        gathered = {"lengths": lengths}
+        if "input_ids" in self.column_names:
+            gathered["input_ids"] = input_ids
+        if "labels" in self.column_names:
+            bits = (self.label_mask[positions >> 3] >> (7 - (positions & 7))) & 1
+            gathered["labels"] = np.where(bits.astype(np.bool_), input_ids, -100)
+        if "attention_mask" in self.column_names:
+            gathered["attention_mask"] = np.ones_like(input_ids)
+        if "position_ids" in self.column_names:
+            gathered["position_ids"] = position_ids
+        return gathered
+
+    def __getitem__(self, idx: int) -> Dict[str, List[int]]:
+        gathered = self.gather([idx])
+        del gathered["lengths"]
+        return {feature: values.tolist() for feature, values in gathered.items()}
@@ -1,9 +1,10 @@
 """Module containing the Trainer class and related functions"""
+import json
 import math
 import os
 from contextlib import contextmanager
-from functools import partial
-from typing import List
+from pathlib import Path
+from typing import Any, Dict, List, Optional
 
 import numpy as np
 import torch
@@ -11,17 +12,24 @@ import torch.cuda
 import torch.distributed as dist
 from accelerate.logging import get_logger
 from datasets import set_caching_enabled
-from torch.utils.data import DistributedSampler, RandomSampler
+from torch.utils.data import DistributedSampler
 
 from axolotl.core.trainer_builder import HFCausalTrainerBuilder
-from axolotl.utils.collators import DataCollatorForSeq2Seq
-from axolotl.utils.dataloader import MultipackDistributedDataloader
+from axolotl.utils.dataloader import (
+    TokenBudgetBatchSampler,
+    default_packing_plan_dir,
+    exact_num_batches,
+    generate_packing_plan,
+    get_dataset_lengths,
+    packer_key,
+)
 from axolotl.utils.distributed import (
+    broadcast_dict,
     is_distributed,
     is_main_process,
     reduce_and_broadcast,
-    zero_first,
 )
+from axolotl.utils.token_store import TokenStore
 
 LOG = get_logger("axolotl")
 
@@ -88,20 +96,16 @@ def trainer_weighted_loss(model_output, labels, shift_labels=True):
     return weighted_cross_entropy(logits, labels, weights)
 
 
-def add_position_ids(sample):
-    sample_len = len(sample["input_ids"])
-    sample["position_ids"] = torch.arange(len(sample["input_ids"]))
-    sample["length"] = sample_len
-    return sample
-
-
-def add_length(sample):
-    sample["length"] = len(sample["input_ids"])
-    return sample
-
-
-def drop_long_seq(sample, sequence_len=2048):
-    return len(sample["input_ids"]) <= sequence_len and len(sample["input_ids"]) > 0
+def filter_dataset_lengths(dataset, min_length: int = 1, max_length: int = 2048):
+    """
+    Keep the rows whose length is within [min_length, max_length], selecting them from
+    the arrow list offsets instead of rewriting the dataset with a per-row filter
+    """
+    lengths = get_dataset_lengths(dataset)
+    keep = (lengths >= min_length) & (lengths <= max_length)
+    if keep.all():
+        return dataset
+    return dataset.select(np.flatnonzero(keep))
 
 
 @contextmanager
@@ -114,68 +118,165 @@ def disable_datasets_caching():
 
 
 def process_datasets_for_packing(cfg, train_dataset, eval_dataset, tokenizer):
-    drop_long = partial(drop_long_seq, sequence_len=cfg.sequence_len)
-    with zero_first(is_main_process()):
-        train_dataset = train_dataset.filter(drop_long, num_proc=cfg.dataset_processes)
+    if isinstance(train_dataset, TokenStore):
+        return process_token_stores_for_packing(
+            cfg, train_dataset, eval_dataset, tokenizer
+        )
+    # position_ids and length aren't materialized: the multipack dataloader and the
+    # length grouped sampler derive them from the input_ids offsets
+    train_dataset = filter_dataset_lengths(train_dataset, 1, cfg.sequence_len)
+    if eval_dataset:
+        eval_dataset = filter_dataset_lengths(eval_dataset, 1, cfg.sequence_len)
+
+    # Phi doesn't want the attention_mask feature when training
+    if "CodeGenTokenizer" in tokenizer.__class__.__name__ or (
+        cfg.is_mistral_derived_model and cfg.flash_attention
+    ):
+        train_dataset = train_dataset.remove_columns("attention_mask")
         if eval_dataset:
-            eval_dataset = eval_dataset.filter(
-                drop_long, num_proc=cfg.dataset_processes
-            )
-
-        if cfg.group_by_length:
-            train_dataset = train_dataset.map(
-                add_length, num_proc=cfg.dataset_processes
-            )
+            eval_dataset = eval_dataset.remove_columns("attention_mask")
 
-        if cfg.sample_packing:
-            train_dataset = train_dataset.map(
-                add_position_ids, num_proc=cfg.dataset_processes
-            )
-            if cfg.eval_sample_packing is not False:
-                if eval_dataset:
-                    eval_dataset = eval_dataset.map(
-                        add_position_ids, num_proc=cfg.dataset_processes
-                    )
+    return train_dataset, eval_dataset
 
-        # Phi doesn't want the attention_mask feature when training
-        if "CodeGenTokenizer" in tokenizer.__class__.__name__ or (
-            cfg.is_mistral_derived_model and cfg.flash_attention
-        ):
-            train_dataset = train_dataset.remove_columns("attention_mask")
-            if eval_dataset:
-                eval_dataset = eval_dataset.remove_columns("attention_mask")
 
+def process_token_stores_for_packing(cfg, train_dataset, eval_dataset, tokenizer):
+    """
+    process_datasets_for_packing for token stores, where lengths are read from the
+    offsets index and position_ids are always derived
+    """
+    drop_attention_mask = "CodeGenTokenizer" in tokenizer.__class__.__name__ or (
+        cfg.is_mistral_derived_model and cfg.flash_attention
+    )
+    train_dataset = train_dataset.filter_lengths(1, cfg.sequence_len)
+    if drop_attention_mask:
+        train_dataset = train_dataset.remove_columns("attention_mask")
+    if eval_dataset is not None:
+        eval_dataset = eval_dataset.filter_lengths(1, cfg.sequence_len)
+        if cfg.eval_sample_packing is False:
+            eval_dataset = eval_dataset.remove_columns("position_ids")
+        if drop_attention_mask:
+            eval_dataset = eval_dataset.remove_columns("attention_mask")
     return train_dataset, eval_dataset
 
 
+def get_dataset_supervised_tokens(dataset, shifted: bool = False) -> np.ndarray:
+    """
+    Number of labels that aren't IGNORE_INDEX per row, in one pass over the flattened
+    labels buffer. `shifted` leaves out the first label of every row, like the causal
+    lm loss does.
+    """
+    if isinstance(dataset, TokenStore):
+        return dataset.supervised_tokens(shifted=shifted)
+    per_row = []
+    for labels in dataset.data.column("labels").chunks:
+        offsets = labels.offsets.to_numpy()
+        offsets = offsets - offsets[0]
+        supervised = np.concatenate(
+            [[0], np.cumsum(labels.flatten().to_numpy(zero_copy_only=False) != -100)]
+        )
+        starts = offsets[:-1]
+        if shifted:
+            starts = np.minimum(starts + 1, offsets[1:])
+        per_row.append(supervised[offsets[1:]] - supervised[starts])
+    per_row_arr = np.concatenate(per_row) if per_row else np.zeros((0,), np.int64)
+    if dataset._indices is not None:  # pylint: disable=protected-access
+        per_row_arr = per_row_arr[
+            dataset._indices.column(0).to_numpy()  # pylint: disable=protected-access
+        ]
+    return per_row_arr
+
+
+def dataset_stats_path(dataset) -> Optional[Path]:
+    if not dataset.cache_files:
+        return None
+    return (
+        Path(dataset.cache_files[0]["filename"]).parent
+        / "dataset_stats"
+        / f"{dataset._fingerprint}.json"  # pylint: disable=protected-access
+    )
+
+
+def load_dataset_stats(dataset) -> Dict[str, Any]:
+    stats_path = dataset_stats_path(dataset)
+    if stats_path and stats_path.exists():
+        with open(stats_path, encoding="utf-8") as fin:
+            return json.load(fin)
+    return {}
+
+
+def save_dataset_stats(dataset, stats: Dict[str, Any]):
+    stats_path = dataset_stats_path(dataset)
+    if not stats_path or not is_main_process():
+        return
+    stats_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = stats_path.with_suffix(f".tmp-{os.getpid()}")
+    with open(tmp_path, "w", encoding="utf-8") as fout:
+        json.dump(stats, fout)
+    os.replace(tmp_path, stats_path)
+
+
 def calculate_total_num_steps(cfg, train_dataset, tokenizer):
+    # pylint: disable=unused-argument
     if cfg.sample_packing:
+        # token counts and packing efficiency are cached next to the dataset's arrow
+        # files, keyed by its fingerprint. Only the main process writes them, so the
+        # other ranks (possibly on other nodes) get its copy: the stats decide whether
+        # the collective packing efficiency estimate below runs at all
+        stats = broadcast_dict(
+            load_dataset_stats(train_dataset) if is_main_process() else {}
+        )
+        stats_updated = False
+
         # we have to drop anything longer then sequence len otherwise
         # flash attention with position ids fails
         if not cfg.total_num_tokens:
-            total_num_tokens = np.sum(
-                train_dataset.data.column("input_ids")
-                .to_pandas()
-                .apply(lambda x: len(x))  # pylint: disable=unnecessary-lambda
-                .values
-            )
+            if "total_num_tokens" not in stats:
+                stats["total_num_tokens"] = int(
+                    np.sum(get_dataset_lengths(train_dataset))
+                )
+                stats_updated = True
+            total_num_tokens = stats["total_num_tokens"]
             LOG.debug(f"total_num_tokens: {total_num_tokens}", main_process_only=True)
             cfg.total_num_tokens = total_num_tokens
 
         if not cfg.total_supervised_tokens:
-            total_supervised_tokens = (
-                train_dataset.data.column("labels")
-                .to_pandas()
-                .apply(lambda x: np.sum(np.array(x) != -100))
-                .sum()
-            )
+            if "total_supervised_tokens" not in stats:
+                stats["total_supervised_tokens"] = int(
+                    np.sum(get_dataset_supervised_tokens(train_dataset))
+                )
+                stats_updated = True
+            total_supervised_tokens = stats["total_supervised_tokens"]
             LOG.debug(
                 f"`total_supervised_tokens: {total_supervised_tokens}`",
                 main_process_only=True,
             )
             cfg.total_supervised_tokens = total_supervised_tokens
 
-        if cfg.sample_packing_eff_est:
+        if not cfg.sample_packing_eff_est and not cfg.sample_packing_exact_length:
+            seq_max_length = cfg.max_packed_sequence_len or cfg.sequence_len
+            eff_key = (
+                "sample_packing_eff_est:"
+                f"{packer_key(cfg.sample_packing_packer, cfg.sample_packing_cost)}:"
+                f"{seq_max_length}x{cfg.micro_batch_size}:"
+                f"{cfg.world_size}:{cfg.seed or 42}"
+            )
+            if eff_key not in stats:
+                stats[eff_key] = calc_sample_packing_eff_est(
+                    cfg, train_dataset, seq_max_length
+                )
+                stats_updated = True
+            cfg.sample_packing_eff_est = stats[eff_key]
+            LOG.debug(
+                f"sample_packing_eff_est: {cfg.sample_packing_eff_est}",
+                main_process_only=True,
+            )
+
+        if stats_updated:
+            save_dataset_stats(train_dataset, stats)
+
+        if cfg.sample_packing_exact_length:
+            total_num_steps = calc_exact_num_steps(cfg, train_dataset)
+        else:
             total_num_steps = (
                 # match count to len est in dataloader
                 (
@@ -191,59 +292,12 @@ def calculate_total_num_steps(cfg, train_dataset, tokenizer):
                 )
                 * cfg.num_epochs
             )
-            LOG.debug(
-                f"total_num_tokens: {cfg.total_num_tokens}, total_num_steps: {total_num_steps}",
-                main_process_only=True,
-            )
-        else:
-            if cfg.world_size > 1 and is_distributed():
-                sampler = DistributedSampler(
-                    train_dataset,
-                    num_replicas=cfg.world_size,
-                    rank=dist.get_rank(),
-                    seed=cfg.seed or 42,
-                )
-            else:
-                sampler = RandomSampler(train_dataset)
-
-            data_loader = MultipackDistributedDataloader(
-                train_dataset,
-                batch_size=cfg.micro_batch_size,
-                seq_max_length=cfg.max_packed_sequence_len or cfg.sequence_len,
-                collate_fn=DataCollatorForSeq2Seq(
-                    tokenizer,
-                    return_tensors="pt",
-                    padding="longest",
-                ),
-                sampler=sampler,
-                packing_efficiency_estimate=cfg.sample_packing_eff_est,
-                sample_packing_seq_len_multiplier=cfg.micro_batch_size,
-                device_count=int(os.environ.get("WORLD_SIZE", 1)),
-                num_epochs=cfg.num_epochs,
-            )
-            data_loader_len = data_loader.len_w_stats()
-            actual_eff = data_loader.efficiency()
-            LOG.debug(f"data_loader_len: {data_loader_len}", main_process_only=True)
-            # FIXME: is there a bug here somewhere? the total num steps depends
-            # on the agreed on value for sample_packing_eff_est
-            total_num_steps = int(math.floor(data_loader_len * cfg.num_epochs))
-
-            def calc_sample_packing_eff_est(estimates: List[float]):
-                LOG.info(f"sample_packing_eff_est across ranks: {repr(estimates)}")
-                return max(estimates)
-
-            sample_packing_actual_eff_all = reduce_and_broadcast(
-                lambda: actual_eff,
-                calc_sample_packing_eff_est,
-            )
-            sample_packing_eff_est = (
-                math.ceil(sample_packing_actual_eff_all * 100.0) / 100.0
-            )
-            cfg.sample_packing_eff_est = sample_packing_eff_est
-            LOG.debug(
-                f"sample_packing_eff_est: {cfg.sample_packing_eff_est}",
-                main_process_only=True,
-            )
+        LOG.debug(
+            f"total_num_tokens: {cfg.total_num_tokens}, total_num_steps: {total_num_steps}",
+            main_process_only=True,
+        )
+    elif cfg.batch_max_tokens:
+        total_num_steps = calc_token_budget_num_steps(cfg, train_dataset)
     else:
         total_num_steps = int(
             math.ceil(len(train_dataset) * cfg.num_epochs / cfg.batch_size)
@@ -252,6 +306,114 @@ def calculate_total_num_steps(cfg, train_dataset, tokenizer):
     return total_num_steps
 
 
+def calc_exact_num_steps(cfg, train_dataset) -> int:
+    """
+    Optimizer steps of the train dataloader with sample_packing_exact_length, counted
+    from the same packing plans it will use
+    """
+    world_size = cfg.world_size or 1
+    num_epochs = max(1, int(cfg.num_epochs or 1))
+    num_batches = exact_num_batches(
+        train_dataset,
+        get_dataset_lengths(train_dataset),
+        c=cfg.sequence_len * cfg.micro_batch_size,
+        n=world_size,
+        rank=dist.get_rank() if world_size > 1 and is_distributed() else 0,
+        seed=cfg.seed or 42,
+        num_epochs=num_epochs,
+        packer=cfg.sample_packing_packer,
+        plan_dir=default_packing_plan_dir(train_dataset),
+        packing_cost=cfg.sample_packing_cost,
+    )
+    LOG.info(
+        f"exact packed epoch length: {num_batches} batches per rank",
+        main_process_only=True,
+    )
+    return max(1, num_batches // (cfg.gradient_accumulation_steps or 1)) * num_epochs
+
+
+def calc_token_budget_num_steps(cfg, train_dataset) -> int:
+    """
+    Optimizer steps of the train dataloader with batch_max_tokens, counted from the
+    same batches its sampler builds. Also sets the mean label tokens per batch the
+    loss is normalized by.
+    """
+    pad_to_multiple_of = (
+        64 * math.ceil(cfg.sequence_len / 64) if cfg.pad_to_sequence_len else 64
+    )
+    sampler = TokenBudgetBatchSampler(
+        get_dataset_lengths(train_dataset),
+        cfg.batch_max_tokens,
+        num_replicas=cfg.world_size or 1,
+        seed=cfg.seed or 42,
+        bucket_size=cfg.batch_bucket_size or 4096,
+        pad_to_multiple_of=pad_to_multiple_of,
+        drop_last=bool(cfg.dataloader_drop_last),
+    )
+    # counted like the loss, which leaves out the first label of every row
+    loss_tokens = int(
+        np.sum(get_dataset_supervised_tokens(train_dataset, shifted=True))
+    )
+    cfg.batch_loss_tokens = loss_tokens / len(sampler.global_batches(0))
+    grad_accum = cfg.gradient_accumulation_steps or 1
+    total_num_steps = 0
+    for epoch in range(max(1, int(cfg.num_epochs or 1))):
+        sampler.set_epoch(epoch)
+        total_num_steps += max(1, len(sampler) // grad_accum)
+    LOG.debug(
+        f"batch_max_tokens: {len(sampler)} batches per rank, "
+        f"{cfg.batch_loss_tokens:.1f} label tokens per batch",
+        main_process_only=True,
+    )
+    return total_num_steps
+
+
+def calc_sample_packing_eff_est(cfg, train_dataset, seq_max_length) -> float:
+    """
+    Pack this rank's share of the dataset directly from the arrow lengths, and agree
+    on the worst packing efficiency across ranks
+    """
+    if cfg.world_size > 1 and is_distributed():
+        num_replicas, rank = cfg.world_size, dist.get_rank()
+    else:
+        num_replicas, rank = 1, 0
+    # the same seeded sampler as the trainer's, even on a single process
+    sampler = DistributedSampler(
+        train_dataset,
+        num_replicas=num_replicas,
+        rank=rank,
+        seed=cfg.seed or 42,
+    )
+    # the train dataloader bumps the epoch before its first pass, so use
+    # the same epoch here and its packing plan can be reused from disk
+    sampler.set_epoch(1)
+
+    _, _, total_used, total_slots = generate_packing_plan(
+        train_dataset,
+        get_dataset_lengths(train_dataset),
+        np.fromiter(sampler, dtype=np.int64),
+        c=seq_max_length * cfg.micro_batch_size,
+        packer=cfg.sample_packing_packer,
+        plan_dir=default_packing_plan_dir(train_dataset),
+        packing_cost=cfg.sample_packing_cost,
+        meta={
+            "epoch": getattr(sampler, "epoch", None),
+            "seed": getattr(sampler, "seed", None),
+        },
+    )
+    actual_eff = total_used / total_slots
+
+    def reduce_sample_packing_eff_est(estimates: List[float]):
+        LOG.info(f"sample_packing_eff_est across ranks: {repr(estimates)}")
+        return max(estimates)
+
+    sample_packing_actual_eff_all = reduce_and_broadcast(
+        lambda: actual_eff,
+        reduce_sample_packing_eff_est,
+    )
+    return math.ceil(sample_packing_actual_eff_all * 100.0) / 100.0
+
+
 def setup_fsdp_envs(cfg):
     os.environ["ACCELERATE_USE_FSDP"] = "true"
     if cfg.fsdp_config.fsdp_offload_params:
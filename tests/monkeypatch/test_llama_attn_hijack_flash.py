@@ -1,11 +1,75 @@
 """
 Unit tests for the monkeypatch utils
 """
+import inspect
 import unittest
 
 import torch
 
-from axolotl.monkeypatch.utils import get_cu_seqlens, get_cu_seqlens_from_pos_ids
+from axolotl.monkeypatch.utils import (
+    accepts_packed_seqlens,
+    forward_with_packed_seqlens,
+    get_cu_seqlens,
+    get_cu_seqlens_from_pos_ids,
+    get_packed_seqlens,
+)
+
+
+def rowwise_cu_seqlens_from_pos_ids(position_ids):
+    """reference per-row implementation the batched version must match"""
+    results = []
+    max_seq_lens = []
+    for row in position_ids:
+        padding_length = (row == 0).int().flip(dims=[0]).cumprod(dim=0).sum().item()
+        adjusted_row = row[:-padding_length] if padding_length else row.clone()
+        seq_starts = torch.cat([torch.tensor([True]), adjusted_row[1:] == 0])
+        start_indices = torch.cat(
+            [seq_starts.nonzero(as_tuple=True)[0], torch.tensor([len(adjusted_row)])]
+        )
+        cu_seqlens = torch.cat(
+            [torch.tensor([0]), (start_indices[1:] - start_indices[:-1]).cumsum(0)]
+        )
+        if padding_length:
+            cu_seqlens = torch.cat([cu_seqlens, torch.tensor([len(row)])])
+        results.append(cu_seqlens)
+        max_seq_lens.append((cu_seqlens[1:] - cu_seqlens[:-1]).max())
+    return torch.stack(results).to(dtype=torch.int32), torch.stack(max_seq_lens)
+
+
+def rowwise_cu_seqlens(attn_mask):
+    """reference per-row implementation the batched version must match"""
+    results = []
+    max_seq_lens = []
+    for row in attn_mask:
+        t_non_zeros = row[row != 0]
+        seq_change = torch.cat([torch.tensor([1]), t_non_zeros[1:] != t_non_zeros[:-1]])
+        change_indices = torch.cat(
+            [
+                (seq_change == 1).nonzero(as_tuple=True)[0],
+                torch.tensor([len(t_non_zeros)]),
+            ]
+        )
+        seq_lengths = change_indices[1:] - change_indices[:-1]
+        final_seq_length = len(row) - change_indices[-1]
+        if final_seq_length.item():
+            seq_lengths = torch.cat([seq_lengths, final_seq_length.view(1)])
+        cu_seqlens = torch.cat([torch.tensor([0]), seq_lengths.cumsum(0)])
+        results.append(cu_seqlens)
+        max_seq_lens.append((cu_seqlens[1:] - cu_seqlens[:-1]).max())
+    return torch.stack(results).to(dtype=torch.int32), torch.stack(max_seq_lens)
+
+
+def packed_rows(lengths_per_row, seq_len):
+    """build position ids and attention masks for rows of packed sequences"""
+    position_ids = torch.zeros((len(lengths_per_row), seq_len), dtype=torch.long)
+    attn_mask = torch.zeros((len(lengths_per_row), seq_len), dtype=torch.long)
+    for row, lengths in enumerate(lengths_per_row):
+        start = 0
+        for seq_id, length in enumerate(lengths, start=1):
+            position_ids[row, start : start + length] = torch.arange(length)
+            attn_mask[row, start : start + length] = seq_id
+            start += length
+    return position_ids, attn_mask
 
 
 class TestMonkeyPatchUtils(unittest.TestCase):
@@ -25,6 +89,125 @@ class TestMonkeyPatchUtils(unittest.TestCase):
             torch.allclose(get_cu_seqlens_from_pos_ids(position_ids)[0], target_res)
         )
 
+    def test_get_cu_seqlens_batched(self):
+        position_ids, attn_mask = packed_rows([[4, 3, 5, 2], [1, 6, 6, 2]], 16)
+        target_res = torch.tensor(
+            [[0, 4, 7, 12, 14, 16], [0, 1, 7, 13, 15, 16]], dtype=torch.int32
+        )
+        cu_seqlens, max_seqlen = get_cu_seqlens_from_pos_ids(position_ids)
+        self.assertTrue(torch.equal(cu_seqlens, target_res))
+        self.assertTrue(torch.equal(max_seqlen, torch.tensor([5, 6])))
+        cu_seqlens, max_seqlen = get_cu_seqlens(attn_mask)
+        self.assertTrue(torch.equal(cu_seqlens, target_res))
+        self.assertTrue(torch.equal(max_seqlen, torch.tensor([5, 6])))
+
+    def test_matches_rowwise_reference(self):
+        generator = torch.Generator().manual_seed(42)
+        seq_len = 64
+        for padding in (0, 1, 7, 63):
+            for num_seqs in (1, 3, 8):
+                total = seq_len - padding
+                if num_seqs > 1 and num_seqs >= total:
+                    continue
+                lengths_per_row = []
+                for _ in range(4):
+                    # keep the last sequence longer than a single token so its
+                    # trailing position id can't be mistaken for padding
+                    cuts = torch.randperm(max(total - 2, 0), generator=generator)
+                    cuts = (cuts[: num_seqs - 1] + 1).sort().values.tolist()
+                    bounds = [0] + cuts + [total]
+                    lengths_per_row.append(
+                        [end - start for start, end in zip(bounds[:-1], bounds[1:])]
+                    )
+                position_ids, attn_mask = packed_rows(lengths_per_row, seq_len)
+                for func, reference, inputs in (
+                    (
+                        get_cu_seqlens_from_pos_ids,
+                        rowwise_cu_seqlens_from_pos_ids,
+                        position_ids,
+                    ),
+                    (get_cu_seqlens, rowwise_cu_seqlens, attn_mask),
+                ):
+                    with self.subTest(
+                        func=func.__name__, padding=padding, num_seqs=num_seqs
+                    ):
+                        cu_seqlens, max_seqlen = func(inputs)
+                        ref_cu_seqlens, ref_max_seqlen = reference(inputs)
+                        self.assertEqual(cu_seqlens.dtype, torch.int32)
+                        self.assertTrue(torch.equal(cu_seqlens, ref_cu_seqlens))
+                        self.assertTrue(torch.equal(max_seqlen, ref_max_seqlen))
+
+    def test_mismatched_sequence_counts(self):
+        position_ids, attn_mask = packed_rows([[4, 4, 8], [8, 8]], 16)
+        with self.assertRaises(ValueError):
+            get_cu_seqlens_from_pos_ids(position_ids)
+        with self.assertRaises(ValueError):
+            get_cu_seqlens(attn_mask)
+
+
+class InnerModel(torch.nn.Module):
+    """stands in for the patched *Model.forward"""
+
+    def forward(self, position_ids=None):
+        return get_packed_seqlens(self, position_ids)
+
+
+class CausalLM(torch.nn.Module):
+    """stands in for a *ForCausalLM with a fixed forward signature"""
+
+    def __init__(self):
+        super().__init__()
+        self.model = InnerModel()
+
+    def forward(self, input_ids=None, position_ids=None):
+        return self.model(position_ids=position_ids)
+
+
+class TestForwardWithPackedSeqlens(unittest.TestCase):
+    """
+    Test handing the collator's cu_seqlens through a causal lm forward
+    """
+
+    def setUp(self):
+        self.forward = CausalLM.forward
+        CausalLM.forward = forward_with_packed_seqlens(CausalLM.forward)
+        self.position_ids = torch.tensor([[0, 1, 2, 3, 0, 1, 2, 0]])
+
+    def tearDown(self):
+        CausalLM.forward = self.forward
+
+    def test_uses_precomputed_seqlens(self):
+        model = CausalLM()
+        precomputed = torch.tensor([[0, 5, 8]], dtype=torch.int32)
+        cu_seqlens, max_seqlen = model(
+            input_ids=self.position_ids,
+            position_ids=self.position_ids,
+            cu_seqlens=precomputed,
+            max_seqlen=torch.tensor([5]),
+        )
+        self.assertTrue(torch.equal(cu_seqlens, precomputed[0]))
+        self.assertTrue(torch.equal(max_seqlen, torch.tensor([5])))
+        self.assertIsNone(model.model.packed_seqlens)
+
+    def test_falls_back_to_position_ids(self):
+        cu_seqlens, max_seqlen = CausalLM()(
+            input_ids=self.position_ids, position_ids=self.position_ids
+        )
+        self.assertTrue(
+            torch.equal(cu_seqlens, torch.tensor([0, 4, 7, 8], dtype=torch.int32))
+        )
+        self.assertTrue(torch.equal(max_seqlen, torch.tensor([4])))
+
+    def test_signature(self):
+        params = inspect.signature(CausalLM.forward).parameters
+        self.assertEqual(
+            list(params),
+            ["self", "input_ids", "position_ids", "cu_seqlens", "max_seqlen"],
+        )
+        self.assertIs(forward_with_packed_seqlens(CausalLM.forward), CausalLM.forward)
+        self.assertTrue(accepts_packed_seqlens(CausalLM()))
+        self.assertFalse(accepts_packed_seqlens(InnerModel()))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,193 @@
+"""
+Unit tests for the cache of collated eval batches
+"""
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+import torch
+from datasets import Dataset
+from tokenizers import Tokenizer
+from tokenizers.models import WordLevel
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+from axolotl.core.trainer_builder import AxolotlTrainer, AxolotlTrainingArguments
+from axolotl.utils.batch_cache import BatchCache
+from axolotl.utils.collators import DataCollatorForSeq2Seq
+
+
+def build_dataset(num_rows=64, max_len=32, seed=0):
+    rng = np.random.default_rng(seed)
+    rows = []
+    for _ in range(num_rows):
+        length = int(rng.integers(1, max_len))
+        input_ids = rng.integers(3, 60, size=length).tolist()
+        rows.append(
+            {
+                "input_ids": input_ids,
+                "labels": [-100] + input_ids[1:],
+                "attention_mask": [1] * length,
+                "position_ids": list(range(length)),
+            }
+        )
+    return Dataset.from_list(rows)
+
+
+def build_batches(num_batches=5, seed=0):
+    rng = np.random.default_rng(seed)
+    batches = []
+    for _ in range(num_batches):
+        width = int(rng.integers(4, 40))
+        batches.append(
+            {
+                "input_ids": torch.randint(0, 50_000, (2, width)),
+                "labels": torch.full((2, width), -100),
+                "attention_mask": torch.ones((2, width), dtype=torch.int64),
+                "max_seqlen": torch.tensor([width]),
+            }
+        )
+    return batches
+
+
+class TestBatchCache(unittest.TestCase):
+    """
+    Test that cached batches replay the collated batches they were built from
+    """
+
+    def setUp(self):
+        self.tmp_dir = (
+            tempfile.TemporaryDirectory()
+        )  # pylint: disable=consider-using-with
+        self.root = Path(self.tmp_dir.name)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def assert_same_batches(self, cache, batches):
+        self.assertEqual(len(cache), len(batches))
+        for cached, batch in zip(cache, batches):
+            self.assertEqual(cached.keys(), batch.keys())
+            for feature, tensor in batch.items():
+                self.assertEqual(cached[feature].dtype, tensor.dtype)
+                self.assertTrue(torch.equal(cached[feature], tensor))
+
+    def test_in_memory(self):
+        batches = build_batches()
+        cache = BatchCache.build(batches)
+        self.assert_same_batches(cache, batches)
+        # stored in the narrowest dtype holding the values
+        self.assertEqual(cache.buffers["input_ids"].dtype, np.int32)
+        self.assertEqual(cache.buffers["labels"].dtype, np.int8)
+        self.assertEqual(cache.buffers["attention_mask"].dtype, np.int8)
+
+    def test_memory_mapped(self):
+        batches = build_batches()
+        BatchCache.build(batches, path=self.root / "cache")
+        self.assertTrue(BatchCache.exists(self.root / "cache"))
+        cache = BatchCache.load(self.root / "cache")
+        self.assertIsInstance(cache.buffers["input_ids"], np.memmap)
+        self.assert_same_batches(cache, batches)
+
+    def test_pins_in_memory_batches_once(self):
+        batches = build_batches()
+        pinned = []
+
+        def pin_memory(tensor):
+            pinned.append(tensor)
+            return tensor
+
+        # no accelerator to pin memory for here
+        with mock.patch.object(torch.Tensor, "pin_memory", pin_memory):
+            cache = BatchCache.build(batches, pin_memory=True)
+            self.assertEqual(len(pinned), len(batches) * 4)
+            self.assert_same_batches(cache, batches)
+            self.assert_same_batches(cache, batches)
+        self.assertEqual(len(pinned), len(batches) * 4)
+
+    def test_rejects_mismatched_features(self):
+        batches = build_batches()
+        del batches[1]["max_seqlen"]
+        with self.assertRaises(ValueError):
+            BatchCache.build(batches)
+
+
+class TestCachedEvalDataloader(unittest.TestCase):
+    """
+    Test that the trainer packs the eval set once and replays it until it changes
+    """
+
+    def setUp(self):
+        self.tmp_dir = (
+            tempfile.TemporaryDirectory()
+        )  # pylint: disable=consider-using-with
+        self.root = Path(self.tmp_dir.name)
+        tokenizer = PreTrainedTokenizerFast(
+            tokenizer_object=Tokenizer(
+                WordLevel({"<pad>": 0, "<unk>": 1}, unk_token="<unk>")
+            ),
+            pad_token="<pad>",
+        )
+        model = LlamaForCausalLM(
+            LlamaConfig(
+                vocab_size=64,
+                hidden_size=16,
+                intermediate_size=32,
+                num_hidden_layers=1,
+                num_attention_heads=2,
+            )
+        )
+        self.eval_dataset = build_dataset()
+        self.trainer = AxolotlTrainer(
+            model=model,
+            args=AxolotlTrainingArguments(
+                output_dir=str(self.root / "out"),
+                sample_packing=True,
+                max_seq_length=64,
+                per_device_eval_batch_size=2,
+                eval_batch_cache="memory",
+                report_to=[],
+                use_cpu=True,
+            ),
+            train_dataset=build_dataset(seed=1),
+            eval_dataset=self.eval_dataset,
+            data_collator=DataCollatorForSeq2Seq(
+                tokenizer, pad_to_multiple_of=64, return_tensors="pt"
+            ),
+        )
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_replays_until_eval_set_changes(self):
+        expected = list(
+            self.trainer._get_packed_eval_dataloader(  # pylint: disable=protected-access
+                self.eval_dataset, num_epochs=1
+            )
+        )
+        with mock.patch.object(
+            self.trainer,
+            "_get_packed_eval_dataloader",
+            wraps=self.trainer._get_packed_eval_dataloader,  # pylint: disable=protected-access
+        ) as build_loader:
+            first = self.trainer.get_eval_dataloader()
+            second = self.trainer.get_eval_dataloader()
+            self.assertIs(first, second)
+            self.assertEqual(build_loader.call_count, 1)
+            self.assertEqual(len(first), len(expected))
+            for cached, batch in zip(first, expected):
+                for feature, tensor in batch.items():
+                    self.assertTrue(torch.equal(cached[feature], tensor))
+
+            self.trainer.get_eval_dataloader(self.eval_dataset.select(range(32)))
+            self.assertEqual(build_loader.call_count, 2)
+
+    def test_evaluate(self):
+        first = self.trainer.evaluate()
+        second = self.trainer.evaluate()
+        self.assertEqual(first["eval_loss"], second["eval_loss"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,151 @@
+"""
+Unit tests for the axolotl data collator
+"""
+import unittest
+
+import numpy as np
+import pyarrow as pa
+import torch
+from tokenizers import Tokenizer
+from tokenizers.models import WordLevel
+from transformers import PreTrainedTokenizerFast
+
+from axolotl.utils.collators import DataCollatorForSeq2Seq
+
+
+def build_tokenizer():
+    vocab = {"<pad>": 0, "<unk>": 1, "<s>": 2, "</s>": 3}
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=Tokenizer(WordLevel(vocab, unk_token="<unk>")),
+        pad_token="<pad>",
+        unk_token="<unk>",
+    )
+    return tokenizer
+
+
+def packed_feature(lengths):
+    input_ids = np.concatenate([np.arange(5, 5 + n) for n in lengths])
+    return {
+        "input_ids": input_ids,
+        "labels": input_ids.copy(),
+        "attention_mask": np.concatenate(
+            [np.full(n, i + 1) for i, n in enumerate(lengths)]
+        ),
+        "position_ids": np.concatenate([np.arange(n) for n in lengths]),
+    }
+
+
+class TestDataCollatorForSeq2Seq(unittest.TestCase):
+    """
+    Test the cu_seqlens emitted for packed batches
+    """
+
+    def setUp(self):
+        self.tokenizer = build_tokenizer()
+
+    def test_no_cu_seqlens_by_default(self):
+        collator = DataCollatorForSeq2Seq(self.tokenizer, pad_to_multiple_of=16)
+        batch = collator([packed_feature([4, 3, 5])])
+        self.assertNotIn("cu_seqlens", batch)
+        self.assertNotIn("max_seqlen", batch)
+
+    def test_cu_seqlens_for_packed_batch(self):
+        collator = DataCollatorForSeq2Seq(
+            self.tokenizer, pad_to_multiple_of=16, return_cu_seqlens=True
+        )
+        batch = collator([packed_feature([4, 3, 5])])
+        self.assertEqual(batch["position_ids"].shape, (1, 16))
+        self.assertTrue(
+            torch.equal(
+                batch["cu_seqlens"],
+                torch.tensor([[0, 4, 7, 12, 16]], dtype=torch.int32),
+            )
+        )
+        self.assertTrue(torch.equal(batch["max_seqlen"], torch.tensor([5])))
+
+    def test_cu_seqlens_unpadded(self):
+        collator = DataCollatorForSeq2Seq(
+            self.tokenizer, pad_to_multiple_of=8, return_cu_seqlens=True
+        )
+        batch = collator([packed_feature([2, 6])])
+        self.assertTrue(
+            torch.equal(
+                batch["cu_seqlens"], torch.tensor([[0, 2, 8]], dtype=torch.int32)
+            )
+        )
+        self.assertTrue(torch.equal(batch["max_seqlen"], torch.tensor([6])))
+
+
+class TestArrayFastPath(unittest.TestCase):
+    """
+    Test the NumPy/Arrow fast path matches padding through `tokenizer.pad`
+    """
+
+    # pylint: disable=protected-access
+
+    def setUp(self):
+        self.tokenizer = build_tokenizer()
+        rng = np.random.default_rng(0)
+        self.features = []
+        for length in (5, 12, 1, 9):
+            input_ids = rng.integers(4, 100, size=length)
+            self.features.append(
+                {
+                    "input_ids": input_ids,
+                    "attention_mask": np.ones(length, dtype=np.int64),
+                    "labels": np.where(rng.random(length) < 0.3, -100, input_ids),
+                    "position_ids": np.arange(length),
+                }
+            )
+
+    def as_lists(self, features):
+        return [{k: v.tolist() for k, v in feature.items()} for feature in features]
+
+    def assert_same_batch(self, collator, features):
+        expected = collator(self.as_lists(features))
+        actual = collator(features)
+        self.assertEqual(set(actual.keys()), set(expected.keys()))
+        for key in expected:
+            self.assertEqual(actual[key].dtype, torch.int64, key)
+            self.assertTrue(torch.equal(actual[key], expected[key]), key)
+
+    def test_right_padding(self):
+        collator = DataCollatorForSeq2Seq(self.tokenizer, pad_to_multiple_of=8)
+        self.assertTrue(collator._use_array_fast_path(self.features, "pt"))
+        self.assertFalse(
+            collator._use_array_fast_path(self.as_lists(self.features), "pt")
+        )
+        self.assert_same_batch(collator, self.features)
+
+    def test_left_padding(self):
+        self.tokenizer.padding_side = "left"
+        collator = DataCollatorForSeq2Seq(self.tokenizer)
+        self.assert_same_batch(collator, self.features)
+
+    def test_missing_attention_mask(self):
+        features = [
+            {k: v for k, v in feature.items() if k != "attention_mask"}
+            for feature in self.features
+        ]
+        collator = DataCollatorForSeq2Seq(self.tokenizer, pad_to_multiple_of=16)
+        self.assert_same_batch(collator, features)
+
+    def test_arrow_inputs(self):
+        collator = DataCollatorForSeq2Seq(self.tokenizer, pad_to_multiple_of=8)
+        expected = collator(self.as_lists(self.features))
+        actual = collator(
+            [{k: pa.array(v) for k, v in feature.items()} for feature in self.features]
+        )
+        for key in expected:
+            self.assertTrue(torch.equal(actual[key], expected[key]), key)
+
+    def test_falls_back_for_unknown_fields(self):
+        features = [
+            dict(feature, length=len(feature["input_ids"])) for feature in self.features
+        ]
+        collator = DataCollatorForSeq2Seq(self.tokenizer)
+        self.assertFalse(collator._use_array_fast_path(features, "pt"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,11 +1,266 @@
 """
 test module for the axolotl.utis.data module
 """
+import tempfile
 import unittest
 
-from transformers import LlamaTokenizer
+import numpy as np
+import torch
+from datasets import Dataset
+from tokenizers import Tokenizer
+from tokenizers.models import WordLevel
+from transformers import (
+    LlamaConfig,
+    LlamaForCausalLM,
+    LlamaTokenizer,
+    PreTrainedTokenizerFast,
+)
 
-from axolotl.utils.data import encode_pretraining, md5
+from axolotl.core.trainer_builder import AxolotlTrainer, AxolotlTrainingArguments
+from axolotl.datasets import StreamingMultipackDataset
+from axolotl.utils.collators import DataCollatorForSeq2Seq
+from axolotl.utils.data import (
+    block_shuffle_indices,
+    encode_pretraining,
+    md5,
+    pack_pretraining_sequences,
+    shuffle_merged_dataset,
+)
+from axolotl.utils.dict import DictDefault
+
+
+def pack_pretraining_reference(input_ids, attention_mask, max_tokens, eos, pad):
+    """
+    the original torch.cat based packing from encode_pretraining
+    """
+    new_input_ids = []
+    new_attention_mask = []
+    buffer_input_ids = torch.tensor([], dtype=torch.long)
+    buffer_attention_mask = torch.tensor([], dtype=torch.long)
+    for ids, mask in zip(input_ids, attention_mask):
+        ids = torch.cat((torch.tensor(ids), torch.tensor([eos, pad])), dim=0)
+        mask = torch.cat((torch.tensor(mask), torch.tensor([1, 0])), dim=0)
+        if buffer_input_ids.numel() + ids.numel() > max_tokens:
+            remainder = max_tokens - buffer_input_ids.numel()
+            new_input_ids.append(
+                torch.cat((buffer_input_ids, torch.full((remainder,), pad)))
+            )
+            new_attention_mask.append(
+                torch.cat((buffer_attention_mask, torch.zeros(remainder)))
+            )
+            buffer_input_ids = torch.tensor([], dtype=torch.long)
+            buffer_attention_mask = torch.tensor([], dtype=torch.long)
+        buffer_input_ids = torch.cat((buffer_input_ids, ids), dim=0)
+        buffer_attention_mask = torch.cat((buffer_attention_mask, mask), dim=0)
+    if buffer_input_ids.numel() > 0:
+        remainder = max_tokens - buffer_input_ids.numel()
+        new_input_ids.append(
+            torch.cat((buffer_input_ids, torch.full((remainder,), pad)))
+        )
+        new_attention_mask.append(
+            torch.cat((buffer_attention_mask, torch.zeros(remainder)))
+        )
+    return {
+        "input_ids": [seq.long().tolist() for seq in new_input_ids],
+        "labels": [seq.long().tolist() for seq in new_input_ids],
+        "attention_mask": [seq.long().tolist() for seq in new_attention_mask],
+    }
+
+
+class TestPackPretrainingSequences(unittest.TestCase):
+    """
+    test the vectorized pretraining packer against the original implementation
+    """
+
+    def test_matches_reference(self):
+        rng = np.random.default_rng(0)
+        max_tokens = 64
+        for num_samples in [0, 1, 7, 100]:
+            lengths = rng.integers(1, max_tokens - 1, size=num_samples)
+            input_ids = [rng.integers(3, 1000, size=n).tolist() for n in lengths]
+            attention_mask = [[1] * n for n in lengths]
+            expected = pack_pretraining_reference(
+                input_ids, attention_mask, max_tokens, eos=2, pad=0
+            )
+            actual = pack_pretraining_sequences(
+                input_ids, attention_mask, max_tokens, eos_token_id=2, pad_token_id=0
+            )
+            for key, value in expected.items():
+                self.assertEqual(actual[key].tolist(), value)
+            self.assertEqual(actual["input_ids"].dtype, np.int32)
+
+
+class TestStreamingMultipack(unittest.TestCase):
+    """
+    test best-fit packing of a stream of pretraining documents
+    """
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.max_tokens = 64
+        self.documents = [
+            {"input_ids": rng.integers(3, 1000, size=n).tolist()}
+            for n in rng.integers(1, 40, size=500)
+        ]
+
+    def test_packs_every_document_once(self):
+        dataset = StreamingMultipackDataset(
+            self.documents, seq_length=self.max_tokens, buffer_size=8
+        )
+        packed = list(dataset)
+        unpacked = []
+        for row in packed:
+            self.assertLessEqual(len(row["input_ids"]), self.max_tokens)
+            np.testing.assert_array_equal(row["labels"], row["input_ids"])
+            # documents are split back apart where the position_ids restart
+            starts = np.flatnonzero(row["position_ids"] == 0)
+            np.testing.assert_array_equal(
+                row["attention_mask"],
+                np.repeat(
+                    np.arange(1, len(starts) + 1),
+                    np.diff(np.append(starts, len(row["input_ids"]))),
+                ),
+            )
+            unpacked.extend(
+                chunk.tolist() for chunk in np.split(row["input_ids"], starts[1:])
+            )
+        self.assertEqual(
+            sorted(unpacked), sorted(doc["input_ids"] for doc in self.documents)
+        )
+        total = sum(len(doc["input_ids"]) for doc in self.documents)
+        self.assertAlmostEqual(
+            dataset.packing_efficiency, total / (len(packed) * self.max_tokens)
+        )
+
+    def test_beats_greedy_packing(self):
+        input_ids = [doc["input_ids"] for doc in self.documents]
+        greedy = pack_pretraining_sequences(
+            input_ids,
+            [[1] * len(ids) for ids in input_ids],
+            self.max_tokens,
+            eos_token_id=2,
+            pad_token_id=0,
+        )
+        packed = list(
+            StreamingMultipackDataset(
+                self.documents, seq_length=self.max_tokens, buffer_size=32
+            )
+        )
+        self.assertLess(len(packed), len(greedy["input_ids"]))
+
+    def test_skips_empty_and_overlong_documents(self):
+        documents = [{"input_ids": []}, {"input_ids": [5] * 65}, {"input_ids": [7]}]
+        packed = list(StreamingMultipackDataset(documents, seq_length=64))
+        self.assertEqual(len(packed), 1)
+        self.assertEqual(packed[0]["input_ids"].tolist(), [7])
+
+    def test_micro_batches_collate(self):
+        micro_batch_size = 4
+        # a single token document at the end of a row reads as padding in cu_seqlens
+        documents = [doc for doc in self.documents if len(doc["input_ids"]) > 1]
+        dataset = StreamingMultipackDataset(
+            documents,
+            seq_length=self.max_tokens,
+            buffer_size=8,
+            micro_batch_size=micro_batch_size,
+        )
+        tokenizer = PreTrainedTokenizerFast(
+            tokenizer_object=Tokenizer(
+                WordLevel({"<pad>": 0, "<unk>": 1}, unk_token="<unk>")
+            ),
+            pad_token="<pad>",
+        )
+        with tempfile.TemporaryDirectory() as output_dir:
+            trainer = AxolotlTrainer(
+                model=LlamaForCausalLM(
+                    LlamaConfig(
+                        vocab_size=1000,
+                        hidden_size=16,
+                        intermediate_size=32,
+                        num_hidden_layers=1,
+                        num_attention_heads=2,
+                    )
+                ),
+                args=AxolotlTrainingArguments(
+                    output_dir=output_dir,
+                    sample_packing=True,
+                    max_seq_length=self.max_tokens,
+                    per_device_train_batch_size=micro_batch_size,
+                    max_steps=1,
+                    report_to=[],
+                    use_cpu=True,
+                ),
+                train_dataset=dataset,
+                data_collator=DataCollatorForSeq2Seq(
+                    tokenizer,
+                    pad_to_multiple_of=self.max_tokens,
+                    return_cu_seqlens=True,
+                ),
+            )
+            batches = list(trainer.get_train_dataloader())
+
+        unpacked = []
+        for batch in batches:
+            # one row per micro batch, made of up to micro_batch_size sequences
+            self.assertEqual(batch["input_ids"].shape[0], 1)
+            self.assertLessEqual(
+                batch["input_ids"].shape[1], self.max_tokens * micro_batch_size
+            )
+            cu_seqlens = batch["cu_seqlens"].squeeze(0).tolist()
+            input_ids = batch["input_ids"][0]
+            num_tokens = int((batch["attention_mask"][0] > 0).sum())
+            # the padding after the last document is a sequence of its own
+            unpacked.extend(
+                input_ids[start:end].tolist()
+                for start, end in zip(cu_seqlens[:-1], cu_seqlens[1:])
+                if end <= num_tokens
+            )
+        self.assertEqual(
+            sorted(unpacked), sorted(doc["input_ids"] for doc in documents)
+        )
+        self.assertEqual(len(batches), -(-dataset.num_sequences // micro_batch_size))
+
+
+class TestShuffleMergedDataset(unittest.TestCase):
+    """
+    test the shuffle modes for merged datasets
+    """
+
+    def test_block_shuffle_indices(self):
+        indices = block_shuffle_indices(1003, 100, seed=42)
+        self.assertEqual(sorted(indices.tolist()), list(range(1003)))
+        # every run of 100 rows comes from a single block, the last one is short
+        blocks = indices // 100
+        boundaries = np.flatnonzero(np.diff(blocks)) + 1
+        self.assertEqual(len(boundaries), 10)
+        self.assertEqual(len(set(blocks.tolist())), 11)
+        self.assertNotEqual(indices.tolist(), sorted(indices.tolist()))
+        np.testing.assert_array_equal(
+            indices, block_shuffle_indices(1003, 100, seed=42)
+        )
+        self.assertEqual(len(block_shuffle_indices(0, 100, seed=42)), 0)
+
+    def test_modes(self):
+        dataset = Dataset.from_dict({"input_ids": [[idx] for idx in range(50)]})
+        random = shuffle_merged_dataset(dataset, DictDefault({}), seed=42)
+        flat = shuffle_merged_dataset(
+            dataset, DictDefault({"dataset_shuffle_mode": "flatten"}), seed=42
+        )
+        self.assertEqual(random["input_ids"], flat["input_ids"])
+        self.assertIsNotNone(random._indices)  # pylint: disable=protected-access
+        self.assertIsNone(flat._indices)  # pylint: disable=protected-access
+
+        block = shuffle_merged_dataset(
+            dataset,
+            DictDefault(
+                {"dataset_shuffle_mode": "block", "dataset_shuffle_block_size": 8}
+            ),
+            seed=42,
+        )
+        self.assertEqual(
+            block["input_ids"],
+            [[idx] for idx in block_shuffle_indices(50, 8, seed=42).tolist()],
+        )
 
 
 class TestEncodePretraining(unittest.TestCase):
@@ -0,0 +1,278 @@
+"""
+Unit tests for the vectorized dataset statistics used to compute the number of steps
+"""
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+from accelerate.state import PartialState
+from datasets import Dataset
+from torch.utils.data import DistributedSampler
+
+from axolotl.utils.dataloader import (
+    MultipackDistributedDataloader,
+    TokenBudgetBatchSampler,
+    default_packing_plan_dir,
+    get_dataset_lengths,
+)
+from axolotl.utils.dict import DictDefault
+from axolotl.utils.trainer import (
+    calculate_total_num_steps,
+    get_dataset_supervised_tokens,
+    load_dataset_stats,
+    process_datasets_for_packing,
+)
+
+
+def build_dataset(num_rows=200, seed=0):
+    rng = np.random.default_rng(seed)
+    rows = []
+    for _ in range(num_rows):
+        length = int(rng.integers(1, 64))
+        labels = rng.integers(0, 100, size=length)
+        labels[: int(rng.integers(0, length + 1))] = -100
+        rows.append(
+            {
+                "input_ids": rng.integers(0, 100, size=length).tolist(),
+                "labels": labels.tolist(),
+                "position_ids": list(range(length)),
+            }
+        )
+    return Dataset.from_list(rows)
+
+
+class TestDatasetStats(unittest.TestCase):
+    """
+    Test vectorized lengths and supervised token counts against per-row python
+    """
+
+    def assert_stats_match(self, dataset):
+        expected_lengths = [len(row["input_ids"]) for row in dataset]
+        expected_supervised = [
+            sum(1 for label in row["labels"] if label != -100) for row in dataset
+        ]
+        expected_shifted = [
+            sum(1 for label in row["labels"][1:] if label != -100) for row in dataset
+        ]
+        np.testing.assert_array_equal(get_dataset_lengths(dataset), expected_lengths)
+        np.testing.assert_array_equal(
+            get_dataset_supervised_tokens(dataset), expected_supervised
+        )
+        np.testing.assert_array_equal(
+            get_dataset_supervised_tokens(dataset, shifted=True), expected_shifted
+        )
+
+    def test_stats(self):
+        self.assert_stats_match(build_dataset())
+
+    def test_stats_with_indices_mapping(self):
+        self.assert_stats_match(build_dataset().shuffle(seed=42).select(range(50)))
+
+    def test_stats_on_sliced_table(self):
+        split = build_dataset().train_test_split(test_size=0.25, shuffle=False)
+        self.assert_stats_match(split["test"])
+
+    def test_length_filter(self):
+        dataset = build_dataset().shuffle(seed=42)
+        cfg = DictDefault({"sequence_len": 32, "sample_packing": True})
+        train, test = process_datasets_for_packing(cfg, dataset, dataset, None)
+        expected = dataset.filter(lambda row: 0 < len(row["input_ids"]) <= 32)
+        self.assertEqual(train["input_ids"], expected["input_ids"])
+        self.assertEqual(test["input_ids"], expected["input_ids"])
+        # no derived columns are written
+        self.assertEqual(train.column_names, dataset.column_names)
+        self.assert_stats_match(train)
+
+    def test_stats_are_cached(self):
+        PartialState()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            build_dataset().save_to_disk(tmp_dir)
+            dataset = Dataset.load_from_disk(tmp_dir)
+            cfg = DictDefault(
+                {
+                    "sample_packing": True,
+                    "sequence_len": 128,
+                    "micro_batch_size": 2,
+                    "batch_size": 2,
+                    "num_epochs": 1,
+                    "world_size": 1,
+                }
+            )
+            total_num_steps = calculate_total_num_steps(cfg, dataset, None)
+            stats = load_dataset_stats(dataset)
+            self.assertEqual(stats["total_num_tokens"], cfg.total_num_tokens)
+            self.assertEqual(
+                stats["total_supervised_tokens"], cfg.total_supervised_tokens
+            )
+
+            cached_cfg = DictDefault({**cfg, "total_num_tokens": None})
+            cached_cfg.sample_packing_eff_est = None
+            cached_cfg.total_supervised_tokens = None
+            self.assertEqual(
+                calculate_total_num_steps(cached_cfg, dataset, None), total_num_steps
+            )
+            self.assertEqual(
+                cached_cfg.sample_packing_eff_est, cfg.sample_packing_eff_est
+            )
+
+    def test_stats_come_from_main_process(self):
+        PartialState()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            build_dataset().save_to_disk(tmp_dir)
+            dataset = Dataset.load_from_disk(tmp_dir)
+            cfg = DictDefault(
+                {
+                    "sample_packing": True,
+                    "sequence_len": 128,
+                    "micro_batch_size": 2,
+                    "batch_size": 2,
+                    "num_epochs": 1,
+                    "world_size": 1,
+                }
+            )
+            calculate_total_num_steps(cfg, dataset, None)
+            stats = load_dataset_stats(dataset)
+
+            # a rank on another node without the stats file gets the main process'
+            # copy, and skips the packing efficiency estimate the same way
+            rank_cfg = DictDefault(
+                {
+                    **cfg,
+                    "total_num_tokens": None,
+                    "total_supervised_tokens": None,
+                    "sample_packing_eff_est": None,
+                }
+            )
+            with mock.patch(
+                "axolotl.utils.trainer.is_main_process", return_value=False
+            ), mock.patch(
+                "axolotl.utils.trainer.load_dataset_stats", return_value={}
+            ) as load_stats, mock.patch(
+                "axolotl.utils.trainer.broadcast_dict", return_value=dict(stats)
+            ) as broadcast, mock.patch(
+                "axolotl.utils.trainer.calc_sample_packing_eff_est"
+            ) as eff_est:
+                calculate_total_num_steps(rank_cfg, dataset, None)
+            load_stats.assert_not_called()
+            broadcast.assert_called_once_with({})
+            eff_est.assert_not_called()
+            self.assertEqual(
+                rank_cfg.sample_packing_eff_est, cfg.sample_packing_eff_est
+            )
+
+    def test_eff_est_plan_is_reused_by_the_dataloader(self):
+        PartialState()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            build_dataset().save_to_disk(tmp_dir)
+            dataset = Dataset.load_from_disk(tmp_dir)
+            cfg = DictDefault(
+                {
+                    "sample_packing": True,
+                    "sequence_len": 128,
+                    "micro_batch_size": 2,
+                    "batch_size": 2,
+                    "num_epochs": 1,
+                    "world_size": 1,
+                    "seed": 7,
+                }
+            )
+            calculate_total_num_steps(cfg, dataset, None)
+            plan_dir = default_packing_plan_dir(dataset)
+            plans = set(plan_dir.iterdir())
+            self.assertEqual(len(plans), 1)
+
+            # a single process trainer packs the first epoch in the same order
+            sampler = DistributedSampler(dataset, num_replicas=1, rank=0, seed=7)
+            loader = MultipackDistributedDataloader(
+                dataset,
+                collate_fn=lambda bins: bins,
+                seq_max_length=128,
+                batch_size=2,
+                sample_packing_seq_len_multiplier=2,
+                sampler=sampler,
+            )
+            sampler.set_epoch(1)
+            loader.generate_batches()
+            self.assertEqual(set(plan_dir.iterdir()), plans)
+
+    def test_exact_num_steps_match_dataloader(self):
+        PartialState()
+        dataset = build_dataset(num_rows=400)
+        cfg = DictDefault(
+            {
+                "sample_packing": True,
+                "sample_packing_exact_length": True,
+                "sequence_len": 64,
+                "micro_batch_size": 2,
+                "gradient_accumulation_steps": 2,
+                "batch_size": 4,
+                "num_epochs": 2,
+                "world_size": 1,
+                "seed": 3,
+            }
+        )
+        total_num_steps = calculate_total_num_steps(cfg, dataset, None)
+        loader = MultipackDistributedDataloader(
+            dataset,
+            collate_fn=lambda bins: bins,
+            seq_max_length=64,
+            batch_size=2,
+            sample_packing_seq_len_multiplier=2,
+            num_epochs=2,
+            exact_length=True,
+            seed=3,
+        )
+        self.assertEqual(total_num_steps, len(loader) // 2 * 2)
+        self.assertEqual(len(list(loader)), len(loader))
+
+    def test_token_budget_num_steps_match_sampler(self):
+        PartialState()
+        dataset = build_dataset(num_rows=400)
+        cfg = DictDefault(
+            {
+                "batch_max_tokens": 256,
+                "sequence_len": 64,
+                "micro_batch_size": 2,
+                "gradient_accumulation_steps": 2,
+                "batch_size": 4,
+                "num_epochs": 2,
+                "world_size": 1,
+                "seed": 3,
+            }
+        )
+        total_num_steps = calculate_total_num_steps(cfg, dataset, None)
+        sampler = TokenBudgetBatchSampler(
+            get_dataset_lengths(dataset), 256, seed=3, pad_to_multiple_of=64
+        )
+        num_batches = []
+        for _ in range(2):
+            num_batches.append(len(sampler))
+            self.assertEqual(len(list(sampler)), num_batches[-1])
+        self.assertEqual(total_num_steps, sum(num // 2 for num in num_batches))
+        # the loss counts the labels after the first of every row
+        loss_tokens = sum(
+            sum(1 for label in row["labels"][1:] if label != -100) for row in dataset
+        )
+        self.assertAlmostEqual(cfg.batch_loss_tokens, loss_tokens / num_batches[0])
+
+        # so does the dataloader when dropping the last incomplete batch
+        drop_last_cfg = DictDefault(
+            {**cfg, "dataloader_drop_last": True, "world_size": 3}
+        )
+        drop_last_sampler = TokenBudgetBatchSampler(
+            get_dataset_lengths(dataset),
+            256,
+            num_replicas=3,
+            seed=3,
+            pad_to_multiple_of=64,
+            drop_last=True,
+        )
+        self.assertEqual(
+            calculate_total_num_steps(drop_last_cfg, dataset, None),
+            len(drop_last_sampler) // 2 * 2,
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
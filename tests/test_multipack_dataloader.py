@@ -0,0 +1,646 @@
+"""
+Unit tests for the packed batch assembly in the multipack dataloader
+"""
+import os
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+import torch
+from datasets import Dataset
+from tokenizers import Tokenizer
+from tokenizers.models import WordLevel
+from torch.utils.data import DistributedSampler
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+from axolotl.core.trainer_builder import (
+    DATALOADER_STATE_NAME,
+    AxolotlTrainer,
+    AxolotlTrainingArguments,
+)
+from axolotl.utils import dataloader
+from axolotl.utils.collators import DataCollatorForSeq2Seq
+from axolotl.utils.dataloader import (
+    PACKERS,
+    CollateWorkerError,
+    MultipackDistributedDataloader,
+    PackedBatchAssembler,
+    TokenBudgetBatchSampler,
+    allocate_bfd,
+    bfd_pack,
+    get_packer,
+    packing_cost,
+    simulate_packing,
+)
+
+
+def build_dataset(num_rows=64, max_len=32, seed=0):
+    rng = np.random.default_rng(seed)
+    rows = []
+    for _ in range(num_rows):
+        length = int(rng.integers(1, max_len))
+        input_ids = rng.integers(3, 1000, size=length).tolist()
+        rows.append(
+            {
+                "input_ids": input_ids,
+                "labels": [-100] + input_ids[1:],
+                "attention_mask": [1] * length,
+                "position_ids": list(range(length)),
+                "length": length,
+            }
+        )
+    return Dataset.from_list(rows)
+
+
+def collate_input_ids(bins):
+    return {
+        "input_ids": torch.from_numpy(np.concatenate([b["input_ids"] for b in bins]))
+    }
+
+
+def assemble_bins_rowwise(dataset, bins):
+    """
+    reference implementation of PackedBatchAssembler that fetches one row at a time
+    """
+    features = dataset.features.keys()
+    chunked_data = []
+    attn_mask_cum_idx = 0
+    for batch in bins:
+        concatenated = {}
+        batched_data = [dataset[int(batch_idx)] for batch_idx in batch]
+        for feature in features:
+            if feature == "length":
+                continue
+            if feature == "attention_mask":
+                arrays = [
+                    (attn_mask_cum_idx + idx + 1) * np.array(item[feature])
+                    for idx, item in enumerate(batched_data)
+                    if feature in item
+                ]
+                attn_mask_cum_idx += len(batched_data)
+                concatenated[feature] = np.concatenate(arrays)
+            else:
+                arrays = [
+                    np.array(item[feature]) for item in batched_data if feature in item
+                ]
+                concatenated[feature] = np.concatenate(arrays)
+        if "position_ids" not in features:
+            concatenated["position_ids"] = np.concatenate(
+                [np.arange(len(item["input_ids"])) for item in batched_data]
+            )
+        chunked_data.append(concatenated)
+    return chunked_data
+
+
+def failing_collate(bins):
+    raise ValueError(f"can't collate {len(bins)} bins")
+
+
+def dying_collate(bins):  # pylint: disable=unused-argument
+    os._exit(3)  # pylint: disable=protected-access
+
+
+class TestPackedBatchAssembler(unittest.TestCase):
+    """
+    Test that the arrow assembler matches the row-by-row reference implementation
+    """
+
+    def assert_same_bins(self, dataset):
+        loader = MultipackDistributedDataloader(
+            dataset,
+            collate_fn=lambda x: x,
+            seq_max_length=64,
+            batch_size=4,
+            sample_packing_seq_len_multiplier=4,
+        )
+        all_batches, _ = loader.generate_batches()
+        bins = all_batches[:4]
+        expected = assemble_bins_rowwise(dataset, bins)
+        actual = PackedBatchAssembler(dataset)(bins)
+
+        self.assertEqual(len(expected), len(actual))
+        for expected_bin, actual_bin in zip(expected, actual):
+            self.assertEqual(expected_bin.keys(), actual_bin.keys())
+            self.assertNotIn("length", actual_bin)
+            for feature, values in expected_bin.items():
+                np.testing.assert_array_equal(values, actual_bin[feature])
+
+    def test_matches_rowwise(self):
+        self.assert_same_bins(build_dataset())
+
+    def test_matches_rowwise_with_indices_mapping(self):
+        self.assert_same_bins(build_dataset().shuffle(seed=42))
+
+    def test_derived_position_ids(self):
+        dataset = build_dataset()
+        bins = [[3, 1], [0], [5, 2, 4]]
+        expected = PackedBatchAssembler(dataset)(bins)
+        actual = PackedBatchAssembler(
+            dataset.remove_columns(["position_ids", "length"])
+        )(bins)
+        for expected_bin, actual_bin in zip(expected, actual):
+            self.assertEqual(set(expected_bin.keys()), set(actual_bin.keys()))
+            for feature, values in expected_bin.items():
+                np.testing.assert_array_equal(values, actual_bin[feature])
+        self.assert_same_bins(dataset.remove_columns(["position_ids", "length"]))
+
+    def test_attention_mask_numbering(self):
+        dataset = build_dataset(num_rows=4)
+        packed = PackedBatchAssembler(dataset)([[0, 1], [2, 3]])
+        lengths = dataset["length"]
+        expected = np.repeat([1, 2, 3, 4], lengths)
+        np.testing.assert_array_equal(
+            np.concatenate([p["attention_mask"] for p in packed]), expected
+        )
+
+
+class TestMultipackWorkers(unittest.TestCase):
+    """
+    Test collation in worker processes
+    """
+
+    def build_loader(self, num_workers, collate_fn=collate_input_ids):
+        return MultipackDistributedDataloader(
+            build_dataset(num_rows=256),
+            collate_fn=collate_fn,
+            seq_max_length=64,
+            batch_size=2,
+            sample_packing_seq_len_multiplier=2,
+            prefetch_max=4,
+            num_workers=num_workers,
+        )
+
+    def test_workers_preserve_order(self):
+        expected = list(self.build_loader(num_workers=0))
+        actual = list(self.build_loader(num_workers=3))
+        self.assertEqual(len(expected), len(actual))
+        for expected_batch, actual_batch in zip(expected, actual):
+            torch.testing.assert_close(
+                expected_batch["input_ids"], actual_batch["input_ids"]
+            )
+
+    def test_worker_exception_is_raised(self):
+        loader = self.build_loader(num_workers=2, collate_fn=failing_collate)
+        with self.assertRaisesRegex(CollateWorkerError, "can't collate"):
+            list(loader)
+
+    @mock.patch("axolotl.utils.dataloader.COLLATE_WORKER_POLL_INTERVAL", 0.1)
+    def test_dead_worker_is_detected(self):
+        loader = self.build_loader(num_workers=2, collate_fn=dying_collate)
+        with self.assertRaisesRegex(CollateWorkerError, "exit code 3"):
+            list(loader)
+
+
+class TestPackingPlanCache(unittest.TestCase):
+    """
+    Test persisting and reloading packing plans
+    """
+
+    def build_loader(self, dataset, plan_dir):
+        return MultipackDistributedDataloader(
+            dataset,
+            collate_fn=collate_input_ids,
+            seq_max_length=64,
+            batch_size=2,
+            sample_packing_seq_len_multiplier=2,
+            packing_plan_dir=plan_dir,
+        )
+
+    def test_plan_is_reused(self):
+        dataset = build_dataset(num_rows=128)
+        with tempfile.TemporaryDirectory() as plan_dir:
+            loader = self.build_loader(dataset, plan_dir)
+            expected, expected_totseqs = loader.generate_batches(set_stats=True)
+            self.assertEqual(len(list(Path(plan_dir).iterdir())), 1)
+
+            reloaded = self.build_loader(dataset, plan_dir)
+            actual, actual_totseqs = reloaded.generate_batches(set_stats=True)
+            self.assertEqual(len(expected), len(actual))
+            for expected_bin, actual_bin in zip(expected, actual):
+                np.testing.assert_array_equal(expected_bin, actual_bin)
+            np.testing.assert_array_equal(expected_totseqs, actual_totseqs)
+            self.assertEqual(loader.efficiency(), reloaded.efficiency())
+
+    def test_plan_keyed_on_dataset(self):
+        with tempfile.TemporaryDirectory() as plan_dir:
+            self.build_loader(build_dataset(seed=0), plan_dir).generate_batches()
+            self.build_loader(build_dataset(seed=1), plan_dir).generate_batches()
+            self.assertEqual(len(list(Path(plan_dir).iterdir())), 2)
+
+    def test_least_recently_used_plans_are_pruned(self):
+        datasets = [build_dataset(seed=seed) for seed in range(3)]
+        with tempfile.TemporaryDirectory() as plan_dir, mock.patch.object(
+            dataloader, "MAX_PACKING_PLANS", 2
+        ):
+            self.build_loader(datasets[0], plan_dir).generate_batches()
+            (first,) = Path(plan_dir).iterdir()
+            self.build_loader(datasets[1], plan_dir).generate_batches()
+            (second,) = set(Path(plan_dir).iterdir()) - {first}
+            os.utime(first, (0, 0))
+            os.utime(second, (1, 1))
+            # reloading the first plan marks it as used, so the second one goes
+            self.build_loader(datasets[0], plan_dir).generate_batches()
+            self.build_loader(datasets[2], plan_dir).generate_batches()
+            remaining = set(Path(plan_dir).iterdir())
+            self.assertEqual(len(remaining), 2)
+            self.assertIn(first, remaining)
+            self.assertNotIn(second, remaining)
+
+
+class TestExactLength(unittest.TestCase):
+    """
+    Test that exact length mode yields len() real batches every epoch on every rank
+    """
+
+    def build_loader(self, dataset, num_replicas=1, rank=0, num_workers=0):
+        return MultipackDistributedDataloader(
+            dataset,
+            collate_fn=lambda bins: bins,
+            seq_max_length=64,
+            batch_size=2,
+            sample_packing_seq_len_multiplier=2,
+            sampler=DistributedSampler(
+                dataset, num_replicas=num_replicas, rank=rank, seed=7
+            ),
+            num_epochs=3,
+            num_workers=num_workers,
+            exact_length=True,
+        )
+
+    def test_every_epoch_has_len_batches(self):
+        dataset = build_dataset(num_rows=256)
+        for num_workers in (0, 2):
+            loader = self.build_loader(dataset, num_workers=num_workers)
+            epochs = [list(loader) for _ in range(3)]
+            for epoch in epochs:
+                self.assertEqual(len(epoch), len(loader))
+                for batch in epoch:
+                    # no padding batches, every bin holds real rows
+                    for packed_bin in batch:
+                        self.assertGreater(len(packed_bin["input_ids"]), 1)
+                        self.assertLessEqual(len(packed_bin["input_ids"]), 128)
+            # the epochs are packed from different orders
+            self.assertFalse(
+                np.array_equal(
+                    epochs[0][0][0]["input_ids"], epochs[1][0][0]["input_ids"]
+                )
+            )
+
+    def test_ranks_agree(self):
+        dataset = build_dataset(num_rows=256)
+        loaders = [self.build_loader(dataset, 2, rank) for rank in range(2)]
+        self.assertEqual(len(loaders[0]), len(loaders[1]))
+        rows = [np.concatenate(loader.generate_batches()[0]) for loader in loaders]
+        self.assertEqual(len(np.intersect1d(rows[0], rows[1])), 0)
+        for loader in loaders:
+            self.assertEqual(len(list(loader)), len(loader))
+
+
+class TestResume(unittest.TestCase):
+    """
+    Test resuming the packed batches mid-epoch from a saved dataloader state
+    """
+
+    def build_loader(
+        self, dataset, exact_length, num_workers, collate_fn=None, num_epochs=3
+    ):
+        return MultipackDistributedDataloader(
+            dataset,
+            collate_fn=collate_fn or collate_input_ids,
+            seq_max_length=64,
+            batch_size=2,
+            sample_packing_seq_len_multiplier=2,
+            sampler=DistributedSampler(dataset, num_replicas=1, rank=0, seed=7),
+            num_epochs=num_epochs,
+            num_workers=num_workers,
+            exact_length=exact_length,
+        )
+
+    def assert_same_batches(self, expected, actual):
+        self.assertEqual(len(expected), len(actual))
+        for expected_batch, actual_batch in zip(expected, actual):
+            torch.testing.assert_close(
+                expected_batch["input_ids"], actual_batch["input_ids"]
+            )
+
+    def test_resume_mid_epoch(self):
+        dataset = build_dataset(num_rows=256)
+        for exact_length in (False, True):
+            for num_workers in (0, 2):
+                with self.subTest(exact_length=exact_length, num_workers=num_workers):
+                    loader = self.build_loader(dataset, exact_length, num_workers)
+                    epochs = [list(loader) for _ in range(3)]
+
+                    interrupted = self.build_loader(dataset, exact_length, num_workers)
+                    list(interrupted)
+                    batches = iter(interrupted)
+                    for _ in range(5):
+                        next(batches)
+                    state = interrupted.state_dict()
+                    self.assertEqual(state["epoch"], 2)
+                    self.assertEqual(state["batches"], 5)
+
+                    resumed = self.build_loader(dataset, exact_length, num_workers)
+                    resumed.load_state_dict(state)
+                    self.assert_same_batches(epochs[1][5:], list(resumed))
+                    self.assert_same_batches(epochs[2], list(resumed))
+
+    def test_skipped_batches_are_not_collated(self):
+        dataset = build_dataset(num_rows=256)
+        collated = []
+
+        def collate(bins):
+            collated.append(bins)
+            return collate_input_ids(bins)
+
+        loader = self.build_loader(dataset, True, 0, collate_fn=collate, num_epochs=1)
+        loader.load_state_dict({**loader.state_dict(), "batches": 5})
+        self.assertEqual(len(list(loader)), len(loader) - 5)
+        self.assertEqual(len(collated), len(loader) - 5)
+
+    def test_state_between_epochs(self):
+        dataset = build_dataset(num_rows=256)
+        loader = self.build_loader(dataset, exact_length=True, num_workers=0)
+        self.assertEqual(loader.state_dict()["epoch"], 1)
+        list(loader)
+        state = loader.state_dict()
+        self.assertEqual((state["epoch"], state["batches"]), (2, 0))
+
+        mismatched = MultipackDistributedDataloader(
+            dataset,
+            collate_fn=collate_input_ids,
+            seq_max_length=64,
+            batch_size=2,
+            sample_packing_seq_len_multiplier=2,
+            exact_length=True,
+            seed=8,
+        )
+        with self.assertRaises(ValueError):
+            mismatched.load_state_dict(state)
+
+    def test_trainer_resumes_from_checkpoint(self):
+        dataset = build_dataset(num_rows=128)
+        tokenizer = PreTrainedTokenizerFast(
+            tokenizer_object=Tokenizer(
+                WordLevel({"<pad>": 0, "<unk>": 1}, unk_token="<unk>")
+            ),
+            pad_token="<pad>",
+        )
+
+        def train(output_dir, resume_from_checkpoint=None):
+            torch.manual_seed(0)
+            trainer = AxolotlTrainer(
+                model=LlamaForCausalLM(
+                    LlamaConfig(
+                        vocab_size=1024,
+                        hidden_size=16,
+                        intermediate_size=32,
+                        num_hidden_layers=1,
+                        num_attention_heads=2,
+                    )
+                ),
+                args=AxolotlTrainingArguments(
+                    output_dir=output_dir,
+                    sample_packing=True,
+                    max_seq_length=64,
+                    per_device_train_batch_size=2,
+                    sample_packing_seq_len_multiplier=2,
+                    gradient_accumulation_steps=2,
+                    num_train_epochs=2,
+                    save_steps=3,
+                    seed=7,
+                    report_to=[],
+                    use_cpu=True,
+                ),
+                train_dataset=dataset,
+                data_collator=DataCollatorForSeq2Seq(
+                    tokenizer, pad_to_multiple_of=64, return_tensors="pt"
+                ),
+                num_epochs=2,
+            )
+            seen = []
+            training_step = trainer.training_step
+
+            def record(model, inputs):
+                seen.append(inputs["input_ids"].clone())
+                return training_step(model, inputs)
+
+            with mock.patch.object(trainer, "training_step", side_effect=record):
+                trainer.train(resume_from_checkpoint=resume_from_checkpoint)
+            return seen
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            expected = train(output_dir)
+            checkpoint = Path(output_dir) / "checkpoint-3"
+            self.assertTrue((checkpoint / DATALOADER_STATE_NAME).exists())
+            # holds numpy rng state that newer torch won't load with weights_only
+            (checkpoint / "rng_state.pth").unlink()
+            actual = train(output_dir, resume_from_checkpoint=str(checkpoint))
+        # three optimizer steps of two micro batches each were already trained
+        self.assertEqual(len(actual), len(expected) - 6)
+        for expected_batch, actual_batch in zip(expected[6:], actual):
+            torch.testing.assert_close(expected_batch, actual_batch)
+
+
+class TestPackers(unittest.TestCase):
+    """
+    Test the pluggable bin packing allocators
+    """
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.lengths = rng.integers(1, 512, size=4000).astype(np.int64)
+        self.lengths_cumsum = np.cumsum(self.lengths)
+
+    def test_bins_are_valid(self):
+        capacity, num_ranks = 2048, 4
+        for name, packer in PACKERS.items():
+            with self.subTest(packer=name):
+                per_rank = [
+                    packer(self.lengths, self.lengths_cumsum, rank, capacity, num_ranks)
+                    for rank in range(num_ranks)
+                ]
+                # every rank agrees on the number of steps and their stats
+                self.assertEqual(len({len(result[0]) for result in per_rank}), 1)
+                self.assertEqual(len({result[2] for result in per_rank}), 1)
+
+                packed = np.concatenate(
+                    [np.concatenate(result[0]) for result in per_rank]
+                )
+                self.assertEqual(len(packed), len(np.unique(packed)))
+                for result in per_rank:
+                    for batch in result[0]:
+                        self.assertGreater(len(batch), 0)
+                        self.assertLessEqual(self.lengths[batch].sum(), capacity)
+
+                _, totseqs, total_used, total_slots = per_rank[0]
+                self.assertEqual(sum(totseqs), len(packed))
+                self.assertEqual(total_used, self.lengths[packed].sum())
+                self.assertGreater(total_used / total_slots, 0.95)
+
+    def test_bfd_matches_sorting_every_group(self):
+        # reference that sorts each whole group of deferred and fresh items
+        # pylint: disable=protected-access
+        capacity, num_ranks, rank = 2048, 4, 1
+        pending = np.empty((0,), dtype=np.int64)
+        pos = 0
+        expected = []
+        while True:
+            pool, pos = dataloader._next_pool(
+                self.lengths, pending, pos, capacity * num_ranks + capacity
+            )
+            if not len(pool):
+                break
+            assignment = bfd_pack(self.lengths, pool, capacity, num_ranks)
+            rank_bin, pending, all_bins_used, _ = dataloader._collect_rank(
+                pool, assignment, rank, num_ranks
+            )
+            if not all_bins_used:
+                break
+            expected.append(rank_bin)
+        actual, _, _, _ = allocate_bfd(
+            self.lengths, self.lengths_cumsum, rank, capacity, num_ranks
+        )
+        self.assertEqual(len(actual), len(expected))
+        for expected_bin, actual_bin in zip(expected, actual):
+            np.testing.assert_array_equal(actual_bin, expected_bin)
+
+    def test_balanced_packer_evens_out_compute(self):
+        # mostly short samples with a few long ones, which lpt by tokens alone piles up
+        rng = np.random.default_rng(1)
+        lengths = np.where(
+            rng.random(6000) < 0.05,
+            rng.integers(1500, 2048, size=6000),
+            rng.integers(16, 256, size=6000),
+        ).astype(np.int64)
+        cost = (1.0, 1.0 / 512)
+        bfd = simulate_packing(lengths, 4096, 8, packer="bfd", cost=cost)
+        balanced = simulate_packing(lengths, 4096, 8, packer="balanced", cost=cost)
+        self.assertLess(balanced["imbalance_mean"], bfd["imbalance_mean"])
+        self.assertLess(balanced["idle_fraction"], bfd["idle_fraction"])
+        self.assertGreater(balanced["efficiency"], 0.9)
+        # the step costs account for every sample
+        self.assertAlmostEqual(
+            balanced["step_costs"].sum() / packing_cost(lengths, cost).sum(), 1.0
+        )
+
+    def test_unknown_packer(self):
+        self.assertIs(get_packer(None), PACKERS["multifit"])
+        with self.assertRaises(ValueError):
+            get_packer("first_fit")
+
+
+class TestTokenBudgetBatchSampler(unittest.TestCase):
+    """
+    Test the variable-size batches of the unpacked training path
+    """
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.lengths = rng.integers(1, 1024, size=3000).astype(np.int64)
+
+    def build_sampler(self, num_replicas=1, rank=0, **kwargs):
+        return TokenBudgetBatchSampler(
+            self.lengths, 4096, num_replicas=num_replicas, rank=rank, seed=7, **kwargs
+        )
+
+    def test_batches_fit_the_budget(self):
+        sampler = self.build_sampler()
+        batches = list(sampler)
+        self.assertEqual(len(batches), len(sampler))
+        rows = np.concatenate(batches)
+        np.testing.assert_array_equal(np.sort(rows), np.arange(len(self.lengths)))
+        for batch in batches:
+            padded = -(-self.lengths[batch].max() // 64) * 64
+            self.assertLessEqual(len(batch) * padded, 4096)
+        # far fewer batches than a fixed batch size fitting the longest rows
+        self.assertLess(len(batches), len(self.lengths) / 4)
+
+    def test_epochs_reshuffle(self):
+        sampler = self.build_sampler()
+        first = list(sampler)
+        second = list(sampler)
+        self.assertEqual(sampler.epoch, 2)
+        self.assertNotEqual(first[0], second[0])
+        sampler.set_epoch(0)
+        self.assertEqual(list(sampler), first)
+
+    def test_ranks_agree(self):
+        for drop_last in (False, True):
+            samplers = [
+                self.build_sampler(num_replicas=3, rank=rank, drop_last=drop_last)
+                for rank in range(3)
+            ]
+            self.assertEqual(len({len(sampler) for sampler in samplers}), 1)
+            batches = [list(sampler) for sampler in samplers]
+            self.assertEqual(len({len(rank_batches) for rank_batches in batches}), 1)
+            rows = np.concatenate([np.concatenate(b) for b in batches])
+            if drop_last:
+                self.assertEqual(len(rows), len(np.unique(rows)))
+            else:
+                self.assertEqual(len(np.unique(rows)), len(self.lengths))
+
+    def test_trainer_resumes_in_a_later_epoch(self):
+        dataset = build_dataset(num_rows=128)
+        tokenizer = PreTrainedTokenizerFast(
+            tokenizer_object=Tokenizer(
+                WordLevel({"<pad>": 0, "<unk>": 1}, unk_token="<unk>")
+            ),
+            pad_token="<pad>",
+        )
+
+        def train(output_dir, resume_from_checkpoint=None):
+            torch.manual_seed(0)
+            trainer = AxolotlTrainer(
+                model=LlamaForCausalLM(
+                    LlamaConfig(
+                        vocab_size=1024,
+                        hidden_size=16,
+                        intermediate_size=32,
+                        num_hidden_layers=1,
+                        num_attention_heads=2,
+                    )
+                ),
+                args=AxolotlTrainingArguments(
+                    output_dir=output_dir,
+                    batch_max_tokens=256,
+                    gradient_accumulation_steps=2,
+                    num_train_epochs=2,
+                    save_steps=20,
+                    seed=7,
+                    report_to=[],
+                    use_cpu=True,
+                ),
+                train_dataset=dataset,
+                data_collator=DataCollatorForSeq2Seq(
+                    tokenizer, pad_to_multiple_of=64, return_tensors="pt"
+                ),
+            )
+            seen = []
+            training_step = trainer.training_step
+
+            def record(model, inputs):
+                seen.append(inputs["input_ids"].clone())
+                return training_step(model, inputs)
+
+            with mock.patch.object(trainer, "training_step", side_effect=record):
+                trainer.train(resume_from_checkpoint=resume_from_checkpoint)
+            return seen
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            expected = train(output_dir)
+            checkpoint = Path(output_dir) / "checkpoint-20"
+            # holds numpy rng state that newer torch won't load with weights_only
+            (checkpoint / "rng_state.pth").unlink()
+            actual = train(output_dir, resume_from_checkpoint=str(checkpoint))
+        # the checkpoint is past the 16 optimizer steps of the first epoch
+        self.assertEqual(len(expected), 64)
+        self.assertEqual(len(actual), len(expected) - 40)
+        for expected_batch, actual_batch in zip(expected[40:], actual):
+            torch.testing.assert_close(expected_batch, actual_batch)
+
+
+if __name__ == "__main__":
+    unittest.main()
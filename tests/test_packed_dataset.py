@@ -6,7 +6,12 @@ from pathlib import Path
 from datasets import Dataset, load_dataset
 from transformers import AutoTokenizer
 
-from axolotl.datasets import ConstantLengthDataset, TokenizedPromptDataset
+from axolotl.datasets import (
+    ConstantLengthDataset,
+    TokenizedPromptDataset,
+    constant_length_features,
+    pack_constant_length_shards,
+)
 from axolotl.prompt_tokenizers import AlpacaPromptTokenizingStrategy
 from axolotl.prompters import AlpacaPrompter
 
@@ -64,6 +69,38 @@ class TestPacking(unittest.TestCase):
         assert example["position_ids"][next_bos_index] == 0
         assert example["position_ids"][next_bos_index + 1] == 1
 
+    def test_streaming_pack_matches_constant_length_dataset(self):
+        prompter = AlpacaPrompter("chat")
+        strat = AlpacaPromptTokenizingStrategy(
+            prompter,
+            self.tokenizer,
+            False,
+            2048,
+        )
+        dateset = load_dataset(
+            "json",
+            data_files=str(Path(__file__).parent / "fixtures/alpaca/alpaca.json"),
+        )["train"]
+        dataset = Dataset.from_list(list(TokenizedPromptDataset(strat, dateset)))
+
+        expected = list(ConstantLengthDataset(self.tokenizer, [dataset], 2048))
+        packed_dataset = Dataset.from_generator(
+            pack_constant_length_shards,
+            features=constant_length_features(self.tokenizer),
+            gen_kwargs={
+                "shard_indices": [0],
+                "dataset": dataset,
+                "tokenizer": self.tokenizer,
+                "seq_length": 2048,
+                "num_shards": 1,
+            },
+        )
+
+        assert len(packed_dataset) == len(expected)
+        for example, packed in zip(expected, packed_dataset):
+            for key, value in example.items():
+                assert value.tolist() == packed[key]
+
 
 if __name__ == "__main__":
     unittest.main()
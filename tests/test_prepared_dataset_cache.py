@@ -0,0 +1,430 @@
+"""
+Unit tests for the per-dataset prepared dataset cache and concurrent preparation
+"""
+import copy
+import json
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from tokenizers import Tokenizer
+from tokenizers.models import WordLevel
+from transformers import PreTrainedTokenizerFast
+
+from axolotl.utils import data
+from axolotl.utils.dict import DictDefault
+from axolotl.utils.token_store import TokenStore
+
+
+def build_tokenizer():
+    vocab = {"<pad>": 0, "<unk>": 1, "<s>": 2, "</s>": 3}
+    return PreTrainedTokenizerFast(
+        tokenizer_object=Tokenizer(WordLevel(vocab, unk_token="<unk>")),
+        pad_token="<pad>",
+        unk_token="<unk>",
+    )
+
+
+def write_tokenized_rows(path: Path, num_rows: int, offset: int = 0):
+    with open(path, "w", encoding="utf-8") as fout:
+        for idx in range(offset, offset + num_rows):
+            input_ids = [2, 4 + idx % 7, 5 + idx % 11, 3]
+            row = {
+                "input_ids": input_ids,
+                "attention_mask": [1] * len(input_ids),
+                "labels": input_ids,
+            }
+            fout.write(json.dumps(row) + "\n")
+
+
+class TestPreparedDatasetCache(unittest.TestCase):
+    """
+    Test that only changed dataset entries are reprocessed
+    """
+
+    def setUp(self):
+        self.tmp_dir = (
+            tempfile.TemporaryDirectory()
+        )  # pylint: disable=consider-using-with
+        self.root = Path(self.tmp_dir.name)
+        self.tokenizer = build_tokenizer()
+        self.files = []
+        for idx, num_rows in enumerate((8, 5)):
+            path = self.root / f"ds_{idx}.jsonl"
+            write_tokenized_rows(path, num_rows, offset=idx * 100)
+            self.files.append(path)
+        self.cfg = DictDefault(
+            {
+                "sequence_len": 64,
+                "seed": 42,
+                "local_rank": 0,
+                "dataset_prepared_path": str(self.root / "prepared"),
+                "datasets": [{"path": str(path)} for path in self.files],
+            }
+        )
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def load(self):
+        with mock.patch.object(
+            data, "load_raw_dataset", wraps=data.load_raw_dataset
+        ) as load_raw:
+            dataset, _ = data.load_tokenized_prepared_datasets(
+                self.tokenizer, self.cfg, str(self.root / "default")
+            )
+        loaded = [call.args[0].path for call in load_raw.call_args_list]
+        return dataset, loaded
+
+    def test_only_changed_entries_are_reprocessed(self):
+        dataset, loaded = self.load()
+        self.assertEqual(len(dataset), 13)
+        self.assertEqual(loaded, [str(path) for path in self.files])
+        entries = list((self.root / "prepared" / "datasets").iterdir())
+        self.assertEqual(len(entries), 2)
+
+        # the merged dataset is reused as is
+        _, loaded = self.load()
+        self.assertEqual(loaded, [])
+
+        # editing one file only re-tokenizes that entry
+        write_tokenized_rows(self.files[1], 6, offset=100)
+        dataset, loaded = self.load()
+        self.assertEqual(len(dataset), 14)
+        self.assertEqual(loaded, [str(self.files[1])])
+
+        # so does adding a new entry
+        new_file = self.root / "ds_2.jsonl"
+        write_tokenized_rows(new_file, 3, offset=200)
+        self.cfg.datasets = self.cfg.datasets + [DictDefault({"path": str(new_file)})]
+        dataset, loaded = self.load()
+        self.assertEqual(len(dataset), 17)
+        self.assertEqual(loaded, [str(new_file)])
+
+    def test_token_store_format(self):
+        # the rows use ids beyond the bare test vocab
+        self.tokenizer.add_tokens([f"w{idx}" for idx in range(16)])
+        self.cfg.dataset_prepared_format = "token_store"
+        dataset, loaded = self.load()
+        self.assertIsInstance(dataset, TokenStore)
+        self.assertEqual(len(dataset), 13)
+        self.assertEqual(dataset[0]["input_ids"], [2, 4, 5, 3])
+
+        # the store replaces the merged arrow dataset and is reused as is
+        stores = list((self.root / "prepared").glob("*-tokens"))
+        self.assertEqual(len(stores), 1)
+        self.assertFalse((self.root / "prepared" / stores[0].name[:-7]).exists())
+        dataset, loaded = self.load()
+        self.assertIsInstance(dataset, TokenStore)
+        self.assertEqual(loaded, [])
+
+    def test_cached_entries_keep_their_prompters(self):
+        for idx, path in enumerate(self.files):
+            with open(path, "w", encoding="utf-8") as fout:
+                for row in range(3 + idx):
+                    fout.write(
+                        json.dumps(
+                            {"instruction": f"say {row}", "input": "", "output": "ok"}
+                        )
+                        + "\n"
+                    )
+        self.cfg.datasets = [
+            DictDefault({"path": str(path), "type": "alpaca:chat"})
+            for path in self.files
+        ]
+        _, prompters = data.load_tokenized_prepared_datasets(
+            self.tokenizer, self.cfg, str(self.root / "default")
+        )
+        # one entry changes, the other one is loaded from its cache
+        with open(self.files[1], "a", encoding="utf-8") as fout:
+            fout.write(json.dumps({"instruction": "hi", "input": "", "output": "ok"}))
+        _, cached_prompters = data.load_tokenized_prepared_datasets(
+            self.tokenizer, self.cfg, str(self.root / "default")
+        )
+        self.assertEqual(len(cached_prompters), 2)
+        for prompter, cached_prompter in zip(prompters, cached_prompters):
+            self.assertIs(type(cached_prompter), type(prompter))
+
+    def test_entries_are_only_cached_with_a_prepared_path(self):
+        self.cfg.dataset_prepared_path = None
+        self.load()
+        self.assertFalse((self.root / "default" / "datasets").exists())
+
+    def test_hub_fingerprint_covers_revision(self):
+        config_dataset = DictDefault({"path": "org/dataset"})
+        with mock.patch.object(data, "HfApi") as hf_api:
+            hf_api.return_value.dataset_info.return_value.sha = "abc"
+            first = data.get_dataset_source_fingerprint(config_dataset)
+            hf_api.return_value.dataset_info.return_value.sha = "def"
+            second = data.get_dataset_source_fingerprint(config_dataset)
+        self.assertEqual(first, "hub:org/dataset@abc")
+        self.assertNotEqual(first, second)
+
+    def test_hub_fingerprint_falls_back_to_cached_revision(self):
+        config_dataset = DictDefault({"path": "org/dataset"})
+        ref_path = self.root / "hub" / "datasets--org--dataset" / "refs" / "main"
+        ref_path.parent.mkdir(parents=True)
+        ref_path.write_text("abc", encoding="utf-8")
+        with mock.patch.object(
+            data.hub_constants, "HUGGINGFACE_HUB_CACHE", str(self.root / "hub")
+        ), mock.patch.object(data, "HfApi") as hf_api:
+            with mock.patch.object(data.hub_constants, "HF_HUB_OFFLINE", True):
+                offline = data.get_dataset_source_fingerprint(config_dataset)
+            hf_api.assert_not_called()
+            hf_api.return_value.dataset_info.side_effect = OSError("rate limited")
+            unreachable = data.get_dataset_source_fingerprint(config_dataset)
+        self.assertEqual(offline, "hub:org/dataset@abc")
+        self.assertEqual(unreachable, offline)
+
+    def test_sources_are_resolved_on_the_main_process(self):
+        sources = {
+            data.get_dataset_source_key(config_dataset): f"source-{idx}"
+            for idx, config_dataset in enumerate(self.cfg.datasets)
+        }
+        with mock.patch.object(
+            data, "is_main_process", return_value=False
+        ), mock.patch.object(
+            data, "broadcast_dict", return_value=sources
+        ), mock.patch.object(
+            data, "get_dataset_source_fingerprint"
+        ) as fingerprint:
+            self.cfg.dataset_source_fingerprints = data.resolve_dataset_sources(
+                self.cfg
+            )
+            data.get_prepared_dataset_hashes(self.cfg, self.tokenizer, 42)
+        fingerprint.assert_not_called()
+
+    def test_tokenizer_change_invalidates_entries(self):
+        self.load()
+        self.tokenizer.add_tokens(["<new>"])
+        _, loaded = self.load()
+        self.assertEqual(loaded, [str(path) for path in self.files])
+
+    def test_entry_hash_covers_options(self):
+        fingerprint = data.get_tokenizer_fingerprint(self.tokenizer)
+        config_dataset = DictDefault({"path": str(self.files[0]), "type": "alpaca"})
+        base = data.get_dataset_entry_hash(config_dataset, self.cfg, fingerprint, 42)
+        self.assertEqual(
+            base, data.get_dataset_entry_hash(config_dataset, self.cfg, fingerprint, 7)
+        )
+        for changed in (
+            DictDefault({"path": str(self.files[0]), "type": "alpaca:chat"}),
+            DictDefault({"path": str(self.files[0]), "type": "alpaca", "shards": 2}),
+        ):
+            self.assertNotEqual(
+                base, data.get_dataset_entry_hash(changed, self.cfg, fingerprint, 42)
+            )
+        cfg = DictDefault({**self.cfg, "sequence_len": 128})
+        self.assertNotEqual(
+            base, data.get_dataset_entry_hash(config_dataset, cfg, fingerprint, 42)
+        )
+
+
+class TestConcurrentDatasetPreparation(unittest.TestCase):
+    """
+    Test loading and tokenizing dataset entries concurrently
+    """
+
+    def setUp(self):
+        self.tmp_dir = (
+            tempfile.TemporaryDirectory()
+        )  # pylint: disable=consider-using-with
+        self.root = Path(self.tmp_dir.name)
+        self.tokenizer = build_tokenizer()
+        self.files = []
+        for idx, num_rows in enumerate((7, 3, 11, 5)):
+            path = self.root / f"ds_{idx}.jsonl"
+            write_tokenized_rows(path, num_rows, offset=idx * 100)
+            self.files.append(path)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def load(self, dataset_processes):
+        cfg = DictDefault(
+            {
+                "sequence_len": 64,
+                "seed": 42,
+                "local_rank": 0,
+                "dataset_processes": dataset_processes,
+                "datasets": [{"path": str(path)} for path in self.files],
+            }
+        )
+        prepared = self.root / f"prepared_{dataset_processes}"
+        with mock.patch.object(data, "dataset_exists_on_hub") as on_hub:
+            dataset, _ = data.load_tokenized_prepared_datasets(
+                self.tokenizer, cfg, str(prepared)
+            )
+        on_hub.assert_not_called()
+        return dataset
+
+    def test_matches_sequential_order(self):
+        sequential = self.load(dataset_processes=1)
+        concurrent = self.load(dataset_processes=4)
+        self.assertEqual(len(concurrent), 26)
+        self.assertEqual(sequential["input_ids"], concurrent["input_ids"])
+
+    def test_process_budget(self):
+        budget = data.ProcessBudget(3)
+        in_use = []
+        peak = []
+        lock = threading.Lock()
+
+        def work(count):
+            with budget.reserve(count) as reserved:
+                with lock:
+                    in_use.append(reserved)
+                    peak.append(sum(in_use))
+                time.sleep(0.01)
+                with lock:
+                    in_use.remove(reserved)
+            return reserved
+
+        threads = [
+            threading.Thread(target=work, args=(count,)) for count in (1, 2, 5, 1, 3)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertLessEqual(max(peak), 3)
+        self.assertEqual(budget.available, 3)
+
+    def test_process_budget_shares_slots(self):
+        budget = data.ProcessBudget(3)
+        # both reservations must be held at once to get past the barrier
+        barrier = threading.Barrier(2, timeout=5)
+        reserved = []
+
+        def work(count):
+            with budget.reserve(count) as processes:
+                reserved.append(processes)
+                barrier.wait()
+
+        threads = [threading.Thread(target=work, args=(count,)) for count in (2, 1)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertFalse(barrier.broken)
+        self.assertEqual(sorted(reserved), [1, 2])
+        self.assertEqual(budget.available, 3)
+
+
+class TestDistributedDatasetPreparation(unittest.TestCase):
+    """
+    Test tokenizing shards of the dataset entries on several ranks
+    """
+
+    def setUp(self):
+        self.tmp_dir = (
+            tempfile.TemporaryDirectory()
+        )  # pylint: disable=consider-using-with
+        self.root = Path(self.tmp_dir.name)
+        self.tokenizer = build_tokenizer()
+        self.files = []
+        for idx, num_rows in enumerate((9, 2, 13)):
+            path = self.root / f"ds_{idx}.jsonl"
+            write_tokenized_rows(path, num_rows, offset=idx * 100)
+            self.files.append(path)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def cfg(self, prepared_path):
+        return DictDefault(
+            {
+                "sequence_len": 64,
+                "seed": 42,
+                "local_rank": 0,
+                "dataset_processes": 1,
+                "dataset_prepared_path": str(prepared_path),
+                "datasets": [{"path": str(path)} for path in self.files],
+            }
+        )
+
+    def prepare_on_ranks(self, cfg, world_size, run_id="run"):
+        errors = []
+
+        def work(rank):
+            try:
+                data.prepare_dataset_shards(
+                    copy.deepcopy(self.tokenizer),
+                    cfg,
+                    "unused",
+                    rank=rank,
+                    world_size=world_size,
+                    run_id=run_id,
+                )
+            except Exception as err:  # pylint: disable=broad-except
+                errors.append(err)
+
+        with mock.patch.object(data, "ROWS_PER_PREPROCESS_PROCESS", 4):
+            threads = [
+                threading.Thread(target=work, args=(rank,))
+                for rank in range(world_size)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(errors, [])
+
+    def test_matches_single_rank_preparation(self):
+        expected, _ = data.load_tokenized_prepared_datasets(
+            self.tokenizer, self.cfg(self.root / "single"), "unused"
+        )
+
+        cfg = self.cfg(self.root / "shared")
+        self.prepare_on_ranks(cfg, world_size=3)
+        entries = self.root / "shared" / "datasets"
+        manifests = sorted(entries.glob("*/manifest.json"))
+        self.assertEqual(len(manifests), 3)
+        num_shards = sorted(
+            len(json.loads(path.read_text(encoding="utf-8"))["shards"])
+            for path in manifests
+        )
+        self.assertEqual(num_shards, [1, 3, 3])
+        # every shard was tokenized exactly once
+        self.assertEqual(len(list(entries.glob("*-shards/*.run.lock"))), 7)
+
+        with mock.patch.object(data, "load_raw_dataset") as load_raw:
+            dataset, _ = data.load_tokenized_prepared_datasets(
+                self.tokenizer, cfg, "unused"
+            )
+        load_raw.assert_not_called()
+        self.assertEqual(dataset["input_ids"], expected["input_ids"])
+
+    def test_locks_from_other_runs_are_ignored(self):
+        cfg = self.cfg(self.root / "shared")
+        self.prepare_on_ranks(cfg, world_size=2, run_id="crashed")
+        for manifest in (self.root / "shared" / "datasets").glob("*/manifest.json"):
+            manifest.unlink()
+            manifest.parent.rmdir()
+        for shard in (self.root / "shared" / "datasets").glob("*-shards/*-of-*[0-9]"):
+            shutil.rmtree(shard)
+
+        self.prepare_on_ranks(cfg, world_size=2, run_id="retry")
+        manifests = list((self.root / "shared" / "datasets").glob("*/manifest.json"))
+        self.assertEqual(len(manifests), 3)
+
+    def test_missing_shards_time_out(self):
+        shards_dir = self.root / "shards"
+        shards_dir.mkdir()
+        shard_paths = [shards_dir / f"{index:05d}-of-00002" for index in range(2)]
+        shard_paths[0].mkdir()
+        self.assertTrue(data.claim_prepared_shard(shard_paths[1], "run"))
+        with self.assertRaises(TimeoutError) as raised:
+            data.wait_for_prepared_shards(
+                shard_paths, "run", timeout=0.05, poll_interval=0.01
+            )
+        self.assertIn(str(shard_paths[1]), str(raised.exception))
+        self.assertNotIn(str(shard_paths[0]), str(raised.exception))
+
+
+if __name__ == "__main__":
+    unittest.main()
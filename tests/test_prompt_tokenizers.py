@@ -1,27 +1,57 @@
 """Module for testing prompt tokenizers."""
+import copy
 import json
 import logging
+import pickle
 import unittest
 from pathlib import Path
 from typing import Optional
 
 import pytest
-from transformers import AutoTokenizer, LlamaTokenizer
+from tokenizers import SentencePieceBPETokenizer, Tokenizer
+from tokenizers.models import WordLevel
+from tokenizers.pre_tokenizers import Whitespace
+from tokenizers.processors import TemplateProcessing
+from transformers import (
+    AutoTokenizer,
+    LlamaTokenizer,
+    LlamaTokenizerFast,
+    PreTrainedTokenizerFast,
+)
 
 from axolotl.prompt_strategies.alpaca_chat import NoSystemPrompter
 from axolotl.prompt_strategies.alpaca_w_system import (
     InstructionWSystemPromptTokenizingStrategy,
     SystemDataPrompter,
 )
+from axolotl.prompt_strategies.completion import load as load_completion
 from axolotl.prompt_strategies.llama2_chat import (
     Llama2ChatPrompter,
     LLama2ChatTokenizingStrategy,
 )
+from axolotl.prompt_strategies.metharme import (
+    MetharmePrompter,
+    MetharmePromptTokenizingStrategy,
+)
+from axolotl.prompt_strategies.sharegpt import load as load_sharegpt
+from axolotl.prompt_strategies.user_defined import UserDefinedDatasetConfig
+from axolotl.prompt_strategies.user_defined import load as load_user_defined
 from axolotl.prompt_tokenizers import (
     AlpacaPromptTokenizingStrategy,
+    JeopardyPromptTokenizingStrategy,
+    OpenAssistantPromptTokenizingStrategy,
+    PromptTokenizingStrategy,
     ShareGPTPromptTokenizingStrategy,
+    TokenizationCache,
 )
-from axolotl.prompters import AlpacaPrompter, PromptStyle, ShareGPTPrompterV2
+from axolotl.prompters import (
+    IGNORE_TOKEN_ID,
+    AlpacaPrompter,
+    JeopardyPrompter,
+    PromptStyle,
+    ShareGPTPrompterV2,
+)
+from axolotl.utils.dict import DictDefault
 
 LOG = logging.getLogger("axolotl")
 
@@ -318,5 +348,371 @@ If a question does not make any sense, or is not factually coherent, explain why
         )
 
 
+def word_level_tokenizer(words):
+    """offline tokenizer that adds a bos token like llama"""
+    vocab = {"<pad>": 0, "<s>": 1, "</s>": 2, "<unk>": 3}
+    vocab.update({word: idx + 4 for idx, word in enumerate(dict.fromkeys(words))})
+    backend = Tokenizer(WordLevel(vocab, unk_token="<unk>"))
+    backend.pre_tokenizer = Whitespace()
+    backend.post_processor = TemplateProcessing(
+        single="<s> $A", special_tokens=[("<s>", 1)]
+    )
+    return PreTrainedTokenizerFast(
+        tokenizer_object=backend,
+        bos_token="<s>",
+        eos_token="</s>",
+        pad_token="<pad>",
+        unk_token="<unk>",
+    )
+
+
+class BatchedInstructionTokenizationTest(unittest.TestCase):
+    """
+    The batched instruction path must match tokenize_prompt row by row
+    """
+
+    words = (
+        "SYSTEM USER ASSISTANT : hello how can I help you today the answer is "
+        "what a question category below instruction response write summary"
+    ).split()
+
+    def setUp(self) -> None:
+        self.tokenizer = word_level_tokenizer(self.words)
+
+    def rows(self, **fields):
+        rows = []
+        for idx in range(12):
+            row = {}
+            for name, kind in fields.items():
+                count = (idx * 7) % 23 if kind == "long" else idx % 5 + 1
+                row[name] = " ".join(
+                    self.words[(idx + j) % len(self.words)] for j in range(count)
+                )
+            rows.append(row)
+        # no response at all, and a response ending in eos already
+        rows[1][list(fields)[-1]] = ""
+        rows[2][list(fields)[-1]] += " </s>"
+        return rows
+
+    def assert_batched_matches(self, strat, rows):
+        self.assertTrue(strat.supports_batched)
+        expected = [dict(strat.tokenize_prompt(dict(row))) for row in rows]
+        batch = {key: [row[key] for row in rows] for key in rows[0]}
+        res = strat.tokenize_batch(batch)
+        self.assertEqual(set(res.keys()), set(expected[0].keys()))
+        for idx, row in enumerate(expected):
+            for key, val in row.items():
+                self.assertEqual(res[key][idx], val, f"row {idx} {key}")
+
+    def test_alpaca(self):
+        for train_on_inputs in (False, True):
+            for sequence_len in (2048, 16):
+                strat = AlpacaPromptTokenizingStrategy(
+                    AlpacaPrompter(PromptStyle.CHAT.value),
+                    self.tokenizer,
+                    train_on_inputs,
+                    sequence_len,
+                )
+                rows = self.rows(instruction="long", input="short", output="long")
+                with self.subTest(train_on_inputs=train_on_inputs, seq=sequence_len):
+                    self.assert_batched_matches(strat, rows)
+
+    def test_other_instruction_strategies(self):
+        strat = JeopardyPromptTokenizingStrategy(
+            JeopardyPrompter(), self.tokenizer, False, 32
+        )
+        self.assert_batched_matches(
+            strat, self.rows(question="long", category="short", answer="short")
+        )
+        strat = OpenAssistantPromptTokenizingStrategy(
+            AlpacaPrompter(PromptStyle.INSTRUCT.value), self.tokenizer, False, 32
+        )
+        self.assert_batched_matches(
+            strat, self.rows(INSTRUCTION="long", RESPONSE="long")
+        )
+
+    def test_system_prompt_strategies(self):
+        strat = InstructionWSystemPromptTokenizingStrategy(
+            SystemDataPrompter(PromptStyle.CHAT.value), self.tokenizer, False, 2048
+        )
+        self.assert_batched_matches(
+            strat, self.rows(system="short", instruction="long", output="long")
+        )
+        strat = load_user_defined(
+            self.tokenizer,
+            DictDefault({"train_on_inputs": False, "sequence_len": 24}),
+            UserDefinedDatasetConfig(
+                system_prompt="what",
+                field_instruction="question",
+                field_output="answer",
+                format="USER : {instruction} {input} ASSISTANT :",
+                no_input_format="USER : {instruction} ASSISTANT :",
+            ),
+        )
+        self.assert_batched_matches(strat, self.rows(question="long", answer="long"))
+
+    def test_custom_tokenize_stays_per_row(self):
+        strat = MetharmePromptTokenizingStrategy(
+            MetharmePrompter(), self.tokenizer, False, 2048
+        )
+        self.assertFalse(strat.supports_batched)
+        strat = load_completion(
+            self.tokenizer, DictDefault({"train_on_inputs": False, "sequence_len": 8})
+        )
+        batch = {"text": ["hello how can I help you today the answer is"] * 2}
+        self.assertEqual(strat.tokenize_batch(batch), strat.tokenize_prompt(batch))
+
+
+class TokenizationCacheTest(unittest.TestCase):
+    """
+    Test the fragment cache used for constant prompt text
+    """
+
+    # pylint: disable=protected-access
+
+    def test_lru_eviction(self):
+        cache = TokenizationCache(maxsize=2)
+        cache.put("a", {"input_ids": (1,)})
+        cache.put("b", {"input_ids": (2,)})
+        cache.get("a")
+        cache.put("c", {"input_ids": (3,)})
+        assert cache.get("b") is None
+        assert cache.get("a") == {"input_ids": (1,)}
+        assert len(cache) == 2
+
+    def test_pickle_drops_entries(self):
+        cache = TokenizationCache(maxsize=8)
+        cache.put("a", {"input_ids": (1,)})
+        restored = pickle.loads(pickle.dumps(cache))
+        assert restored.maxsize == 8
+        assert len(restored) == 0
+
+    def test_cached_matches_tokenize(self):
+        strat = AlpacaPromptTokenizingStrategy(
+            AlpacaPrompter(), word_level_tokenizer(["USER", ":"]), False, 2048
+        )
+        for kwargs in (
+            {"add_eos_token": False, "strip_bos_token": False},
+            {"add_eos_token": True, "strip_bos_token": True},
+        ):
+            first = strat._tokenize_cached("USER :", **kwargs)
+            first["input_ids"].append(-1)
+            assert strat._tokenize_cached("USER :", **kwargs) == strat._tokenize(
+                "USER :", **kwargs
+            )
+        assert len(strat.token_cache) == 2
+
+    def test_sharegpt_with_cache(self):
+        tokenizer = word_level_tokenizer(
+            "A chat between curious user and an artificial intelligence assistant . "
+            "USER ASSISTANT : hello how can I help you".split()
+        )
+        strat = ShareGPTPromptTokenizingStrategy(
+            ShareGPTPrompterV2(), tokenizer, False, 2048
+        )
+        conversation = {
+            "conversations": [
+                {"from": "human", "value": "hello"},
+                {"from": "gpt", "value": "how can I help you"},
+                {"from": "human", "value": "help"},
+                {"from": "gpt", "value": "hello"},
+            ]
+        }
+        first = strat.tokenize_prompt(copy.deepcopy(conversation))
+        # system prompt and assistant role are served from the cache now
+        assert len(strat.token_cache) == 2
+        assert strat.tokenize_prompt(copy.deepcopy(conversation)) == first
+        uncached = ShareGPTPromptTokenizingStrategy(
+            ShareGPTPrompterV2(), tokenizer, False, 2048
+        )
+        uncached._tokenize_cached = uncached._tokenize
+        assert uncached.tokenize_prompt(copy.deepcopy(conversation)) == first
+
+
+def sentencepiece_bpe_tokenizer(texts):
+    """offline llama-style tokenizer, a SentencePiece BPE trained on `texts`"""
+    backend = SentencePieceBPETokenizer()
+    backend.train_from_iterator(
+        texts,
+        vocab_size=400,
+        min_frequency=1,
+        special_tokens=["<unk>", "<s>", "</s>"],
+    )
+    tokenizer = LlamaTokenizerFast(
+        tokenizer_object=backend._tokenizer,  # pylint: disable=protected-access
+        bos_token="<s>",
+        eos_token="</s>",
+        unk_token="<unk>",
+    )
+    tokenizer.pad_token = "<unk>"
+    return tokenizer
+
+
+class ShareGPTSinglePassTest(unittest.TestCase):
+    """
+    Single pass sharegpt tokenization must match the per-turn path
+    """
+
+    def setUp(self) -> None:
+        self.tokenizer = sentencepiece_bpe_tokenizer(
+            [
+                "A chat between a curious user and an artificial intelligence "
+                "assistant. The assistant gives helpful, detailed, and polite "
+                "answers to the user's questions.",
+                "USER: hello ASSISTANT: how can I help you? USER: tell me a joke "
+                "ASSISTANT: sure, why did the chicken cross the road?",
+                "<|im_start|>system You are helpful.<|im_end|> user assistant "
+                "[INST] <<SYS>> hello <</SYS>> [/INST]",
+            ]
+            * 20
+        )
+        self.conversation = {
+            "conversations": [
+                {"from": "system", "value": "You are helpful."},
+                {"from": "human", "value": "hello"},
+                {"from": "gpt", "value": "how can I help you?"},
+                {"from": "human", "value": "tell me a joke"},
+                {"from": "gpt", "value": "sure, why did the chicken cross the road?"},
+            ]
+        }
+
+    def test_turn_boundaries_change_tokens(self):
+        # the per-turn dummy prefixes and merges are what single pass has to keep
+        whole = self.tokenizer("USER: hello ASSISTANT: sure")["input_ids"]
+        turns = self.tokenizer(["USER: hello ", "ASSISTANT: sure"])["input_ids"]
+        assert len(whole) != sum(len(ids) for ids in turns)
+
+    def assert_single_pass_matches(self, conversation, template, max_length=2048):
+        strat = ShareGPTPromptTokenizingStrategy(
+            ShareGPTPrompterV2(conversation=template),
+            self.tokenizer,
+            False,
+            max_length,
+        )
+        expected = strat.tokenize_prompt(copy.deepcopy(conversation))
+        strat.single_pass = True
+        res = strat.tokenize_prompt(copy.deepcopy(conversation))
+        assert res == expected
+        # something is trained on, and not everything
+        assert any(label != IGNORE_TOKEN_ID for label in res["labels"])
+        assert any(label == IGNORE_TOKEN_ID for label in res["labels"])
+
+    def test_vicuna(self):
+        self.assert_single_pass_matches(self.conversation, "vicuna_v1.1")
+
+    def test_chatml(self):
+        self.assert_single_pass_matches(self.conversation, "chatml")
+        # no system message renders an empty first turn without a bos token
+        no_system = {"conversations": self.conversation["conversations"][1:]}
+        self.assert_single_pass_matches(no_system, "chatml")
+
+    def test_llama2(self):
+        self.assert_single_pass_matches(self.conversation, "llama-2")
+
+    def test_truncates_each_turn(self):
+        self.assert_single_pass_matches(self.conversation, "vicuna_v1.1", 8)
+
+    def test_loader_option(self):
+        strat = load_sharegpt(
+            self.tokenizer,
+            DictDefault({"train_on_inputs": False, "sequence_len": 2048}),
+            {"conversation": "chatml", "single_pass": True},
+        )
+        assert strat.single_pass
+
+
+class PrefixSplicingTest(unittest.TestCase):
+    """
+    Splicing the cached ids of prompt prefixes must match tokenizing the whole text
+    """
+
+    # pylint: disable=protected-access
+
+    def setUp(self) -> None:
+        self.tokenizer = sentencepiece_bpe_tokenizer(
+            [
+                "Below is an instruction that describes a task. Write a response "
+                "that appropriately completes the request.\n\n### Instruction:\n"
+                "hello there, what is 12 + 30?\n\n### Response:\n42",
+                "USER: hello ASSISTANT: how can I help you? USER: tell me a joke",
+            ]
+            * 20
+        )
+
+    def unspliced(self, strat):
+        strat._encode = lambda texts, prefixes=None: PromptTokenizingStrategy._encode(
+            strat, texts
+        )
+        return strat
+
+    def test_alpaca(self):
+        rows = [
+            {"instruction": instruction, "input": "", "output": "42"}
+            for instruction in ["hello there", " what is 12", "12 + 30?", "\n\nhello"]
+            * 3
+        ]
+        for sequence_len in (2048, 24):
+            strat = AlpacaPromptTokenizingStrategy(
+                AlpacaPrompter(), self.tokenizer, False, sequence_len
+            )
+            plain = self.unspliced(
+                AlpacaPromptTokenizingStrategy(
+                    AlpacaPrompter(), self.tokenizer, False, sequence_len
+                )
+            )
+            for row in rows:
+                assert strat.tokenize_prompt(dict(row)) == plain.tokenize_prompt(
+                    dict(row)
+                )
+            batch = {key: [row[key] for row in rows] for key in rows[0]}
+            assert strat.tokenize_batch(batch) == plain.tokenize_batch(batch)
+            # the template header was cached and spliced onto the instructions
+            (entry,) = [
+                entry
+                for key, entry in strat.prefix_cache._entries.items()
+                if key != "special_tokens"
+            ]
+            assert True in entry["splices"].values()
+
+    def test_merged_boundary_is_not_spliced(self):
+        strat = AlpacaPromptTokenizingStrategy(
+            AlpacaPrompter(), self.tokenizer, False, 2048
+        )
+        texts = ["USER: hel", "USER: hello", "USER: hello", "USER: hello"]
+        prefixes = ["USER: hel"] * len(texts)
+        # "hel" + "lo" tokenizes differently from "hello", so the splice is rejected
+        assert strat._encode(texts, prefixes) == self.tokenizer(texts)
+        assert strat.prefix_cache.get(("prefix", "USER: hel"))["splices"] == {
+            ("", "Ll"): False
+        }
+
+    def test_sharegpt_turns(self):
+        conversation = {
+            "conversations": [
+                {"from": "human", "value": "hello"},
+                {"from": "gpt", "value": "how can I help you?"},
+                {"from": "human", "value": "tell me a joke"},
+                {"from": "gpt", "value": "hello"},
+            ]
+        }
+        for single_pass in (False, True):
+            strat = ShareGPTPromptTokenizingStrategy(
+                ShareGPTPrompterV2(), self.tokenizer, False, 2048
+            )
+            strat.single_pass = single_pass
+            plain = self.unspliced(
+                ShareGPTPromptTokenizingStrategy(
+                    ShareGPTPrompterV2(), self.tokenizer, False, 2048
+                )
+            )
+            plain._tokenize_prefixed = lambda prompt, prefix, **kwargs: plain._tokenize(
+                prompt, **kwargs
+            )
+            for _ in range(3):
+                assert strat.tokenize_prompt(
+                    copy.deepcopy(conversation)
+                ) == plain.tokenize_prompt(copy.deepcopy(conversation))
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,177 @@
+"""
+Unit tests for the memory-mapped token store
+"""
+import pickle
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+from datasets import Dataset
+
+from axolotl.utils import token_store
+from axolotl.utils.dataloader import (
+    MultipackDistributedDataloader,
+    PackedBatchAssembler,
+    get_dataset_lengths,
+)
+from axolotl.utils.dict import DictDefault
+from axolotl.utils.token_store import TokenStore
+from axolotl.utils.trainer import (
+    get_dataset_supervised_tokens,
+    process_datasets_for_packing,
+)
+
+
+def build_dataset(num_rows=64, max_len=32, seed=0):
+    rng = np.random.default_rng(seed)
+    rows = []
+    for _ in range(num_rows):
+        length = int(rng.integers(1, max_len))
+        input_ids = rng.integers(3, 1000, size=length).tolist()
+        prompt_len = int(rng.integers(0, length + 1))
+        rows.append(
+            {
+                "input_ids": input_ids,
+                "labels": [-100] * prompt_len + input_ids[prompt_len:],
+                "attention_mask": [1] * length,
+                "position_ids": list(range(length)),
+            }
+        )
+    return Dataset.from_list(rows)
+
+
+class TestTokenStore(unittest.TestCase):
+    """
+    Test that a token store reads back the rows of the dataset it was saved from
+    """
+
+    def setUp(self):
+        self.tmp_dir = (
+            tempfile.TemporaryDirectory()
+        )  # pylint: disable=consider-using-with
+        self.root = Path(self.tmp_dir.name)
+        self.dataset = build_dataset()
+        # small batches so the label bitmap is written across byte boundaries
+        self.store = TokenStore.save(
+            self.dataset, self.root / "store", vocab_size=1024, batch_size=7
+        )
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def assert_same_rows(self, store, dataset):
+        self.assertEqual(len(store), len(dataset))
+        for idx in range(len(dataset)):
+            self.assertEqual(store[idx], dataset[idx])
+
+    def test_round_trip(self):
+        self.assertTrue(TokenStore.exists(self.root / "store"))
+        self.assertEqual(self.store.meta["dtype"], "uint16")
+        self.assert_same_rows(TokenStore(self.root / "store"), self.dataset)
+
+    def test_wide_vocab(self):
+        store = TokenStore.save(self.dataset, self.root / "wide", vocab_size=100_000)
+        self.assertEqual(store.meta["dtype"], "int32")
+        self.assert_same_rows(store, self.dataset)
+
+    def test_lengths_and_supervised_tokens(self):
+        np.testing.assert_array_equal(
+            get_dataset_lengths(self.store), get_dataset_lengths(self.dataset)
+        )
+        np.testing.assert_array_equal(
+            get_dataset_supervised_tokens(self.store),
+            get_dataset_supervised_tokens(self.dataset),
+        )
+        np.testing.assert_array_equal(
+            get_dataset_supervised_tokens(self.store, shifted=True),
+            get_dataset_supervised_tokens(self.dataset, shifted=True),
+        )
+
+    def test_supervised_tokens_in_chunks(self):
+        # empty rows, also at the end, don't take the counts of their neighbours
+        empty = {
+            "input_ids": [],
+            "labels": [],
+            "attention_mask": [],
+            "position_ids": [],
+        }
+        dataset = Dataset.from_list([empty] + self.dataset.to_list()[:40] + [empty] * 3)
+        store = TokenStore.save(dataset, self.root / "empty_rows", vocab_size=1024)
+        expected = get_dataset_supervised_tokens(dataset)
+        expected_shifted = get_dataset_supervised_tokens(dataset, shifted=True)
+        # chunks that split rows at every bit offset within a byte
+        for chunk in (1, 5, 64, 1 << 26):
+            with self.subTest(chunk=chunk), mock.patch.object(
+                token_store, "SUPERVISED_TOKENS_CHUNK", chunk
+            ):
+                np.testing.assert_array_equal(store.supervised_tokens(), expected)
+                np.testing.assert_array_equal(
+                    store.supervised_tokens(shifted=True), expected_shifted
+                )
+
+    def test_views(self):
+        self.assert_same_rows(
+            self.store.select([5, 1, 9]), self.dataset.select([5, 1, 9])
+        )
+        self.assert_same_rows(self.store.shard(3, 1), self.dataset.shard(3, 1))
+        split = self.store.train_test_split(test_size=0.1)
+        expected = self.dataset.train_test_split(test_size=0.1, shuffle=False)
+        self.assert_same_rows(split["train"], expected["train"])
+        self.assert_same_rows(split["test"], expected["test"])
+        np.testing.assert_array_equal(
+            get_dataset_supervised_tokens(split["test"]),
+            get_dataset_supervised_tokens(expected["test"]),
+        )
+        self.assertNotEqual(
+            split["train"]._fingerprint,  # pylint: disable=protected-access
+            self.store._fingerprint,  # pylint: disable=protected-access
+        )
+
+    def test_filter_and_remove_columns(self):
+        cfg = DictDefault({"sequence_len": 16})
+        train, _ = process_datasets_for_packing(cfg, self.store, None, None)
+        self.assertTrue(np.all(train.lengths <= 16))
+        self.assertEqual(len(train), int(np.sum(self.store.lengths <= 16)))
+        no_mask = train.remove_columns("attention_mask")
+        self.assertNotIn("attention_mask", no_mask[0])
+        self.assertIn("attention_mask", train[0])
+
+    def test_pickle(self):
+        view = self.store.shard(2, 0).remove_columns("position_ids")
+        restored = pickle.loads(pickle.dumps(view))
+        self.assertEqual(restored.column_names, view.column_names)
+        self.assert_same_rows(
+            restored, self.dataset.shard(2, 0).remove_columns("position_ids")
+        )
+
+    def test_packed_bins_match_arrow(self):
+        loader = MultipackDistributedDataloader(
+            self.dataset,
+            collate_fn=lambda x: x,
+            seq_max_length=64,
+            batch_size=4,
+            sample_packing_seq_len_multiplier=4,
+        )
+        all_batches, _ = loader.generate_batches()
+        bins = all_batches[:4]
+        expected = PackedBatchAssembler(self.dataset)(bins)
+        actual = PackedBatchAssembler(self.store)(bins)
+        self.assertEqual(len(expected), len(actual))
+        for expected_bin, actual_bin in zip(expected, actual):
+            self.assertEqual(expected_bin.keys(), actual_bin.keys())
+            for feature, values in expected_bin.items():
+                np.testing.assert_array_equal(values, actual_bin[feature])
+
+    def test_rejects_labels_that_are_not_input_ids(self):
+        dataset = Dataset.from_list(
+            [{"input_ids": [4, 5, 6], "labels": [4, 7, 6], "attention_mask": [1] * 3}]
+        )
+        with self.assertRaises(ValueError):
+            TokenStore.save(dataset, self.root / "bad", vocab_size=16)
+        self.assertFalse(TokenStore.exists(self.root / "bad"))
+
+
+if __name__ == "__main__":
+    unittest.main()
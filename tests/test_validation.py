@@ -649,3 +649,124 @@ class ValidationTest(unittest.TestCase):
         )
 
         validate_config(cfg)
+
+    def test_distributed_dataset_preparation_needs_prepared_path(self):
+        cfg = DictDefault(
+            {
+                "distributed_dataset_preparation": True,
+            }
+        )
+
+        with pytest.raises(
+            ValueError,
+            match=r".*requires dataset_prepared_path.*",
+        ):
+            validate_config(cfg)
+
+        cfg = DictDefault(
+            {
+                "distributed_dataset_preparation": True,
+                "dataset_prepared_path": "/shared/prepared",
+            }
+        )
+
+        validate_config(cfg)
+
+    def test_token_store_needs_sample_packing(self):
+        cfg = DictDefault(
+            {
+                "dataset_prepared_format": "token_store",
+            }
+        )
+
+        with pytest.raises(ValueError, match=r".*requires sample_packing.*"):
+            validate_config(cfg)
+
+        cfg = DictDefault(
+            {
+                "dataset_prepared_format": "token_store",
+                "sample_packing": True,
+                "max_packed_sequence_len": 2048,
+            }
+        )
+
+        with pytest.raises(ValueError, match=r".*max_packed_sequence_len.*"):
+            validate_config(cfg)
+
+        cfg = DictDefault(
+            {
+                "dataset_prepared_format": "token_store",
+                "sample_packing": True,
+            }
+        )
+
+        validate_config(cfg)
+
+    def test_balanced_packer_needs_exact_length(self):
+        cfg = DictDefault(
+            {
+                "sample_packing": True,
+                "sample_packing_packer": "balanced",
+            }
+        )
+
+        with pytest.raises(ValueError, match=r".*sample_packing_exact_length.*"):
+            validate_config(cfg)
+
+        cfg = DictDefault(
+            {
+                "sample_packing": True,
+                "sample_packing_packer": "balanced",
+                "sample_packing_exact_length": True,
+                "sample_packing_cost": [1.0],
+            }
+        )
+
+        with pytest.raises(ValueError, match=r".*sample_packing_cost.*"):
+            validate_config(cfg)
+
+        cfg.sample_packing_cost = [1.0, 0.001]
+        validate_config(cfg)
+
+    def test_batch_max_tokens(self):
+        cfg = DictDefault(
+            {
+                "batch_max_tokens": 4096,
+                "sample_packing": True,
+            }
+        )
+
+        with pytest.raises(ValueError, match=r".*sample_packing.*"):
+            validate_config(cfg)
+
+        cfg = DictDefault(
+            {
+                "batch_max_tokens": 1024,
+                "sequence_len": 2048,
+            }
+        )
+
+        with pytest.raises(ValueError, match=r".*at least sequence_len.*"):
+            validate_config(cfg)
+
+        cfg.batch_max_tokens = 8192
+        validate_config(cfg)
+
+    def test_eval_batch_cache_needs_packed_eval(self):
+        cfg = DictDefault(
+            {
+                "eval_batch_cache": "memory",
+            }
+        )
+
+        with pytest.raises(ValueError, match=r".*requires sample_packing.*"):
+            validate_config(cfg)
+
+        cfg.sample_packing = True
+        cfg.eval_sample_packing = False
+
+        with pytest.raises(ValueError, match=r".*requires sample_packing.*"):
+            validate_config(cfg)
+
+        cfg.eval_sample_packing = None
+        validate_config(cfg)